@@ -1,14 +1,29 @@
+import json
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
 
+try:
+    import orjson  # JSON 列写入时使用 C 实现的编码器（工作流步骤的输出数据可能很大）
+except ImportError:
+    orjson = None
+
+
+def _json_serializer(obj) -> str:
+    """JSON 列的序列化函数"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+
 # 根据数据库类型选择不同的连接参数
 if settings.db_url.startswith("sqlite"):
     # SQLite 配置
     engine = create_engine(
         settings.db_url, 
-        connect_args={"check_same_thread": False}
+        connect_args={"check_same_thread": False},
+        json_serializer=_json_serializer
     )
 else:
     # PostgreSQL 配置
@@ -16,7 +31,8 @@ else:
         settings.db_url,
         pool_pre_ping=True,
         pool_size=10,
-        max_overflow=20
+        max_overflow=20,
+        json_serializer=_json_serializer
     )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -4,7 +4,7 @@ from datetime import datetime
 from sqlalchemy import Float, Text
 import uuid
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import func
+from sqlalchemy import func, event
 from app.core.config import settings
 from app.db.database import Base
 from sqlalchemy.orm import remote
@@ -151,6 +151,25 @@ class Customer(Base):
     ai_analyses = relationship("AIAnalysis", back_populates="customer")
 
 
+def _clear_customer_all_json(target, *args):
+    """清除工作流 {{customer.all}} 在实例上缓存的 JSON 文本"""
+    target.__dict__.pop('_all_json', None)
+
+def _clear_customer_snapshot(target, *args):
+    """清除工作流在实例上缓存的字段快照（连同 JSON 文本）"""
+    target.__dict__.pop('_snapshot', None)
+    target.__dict__.pop('_all_json', None)
+
+# 任一列被赋值、custom_fields 原地修改或实例刷新时，缓存的快照和 JSON 失效；
+# 提交后的过期不改变字段值，快照保留，只清除基于已加载列生成的 JSON
+for _column in Customer.__table__.columns:
+    event.listen(getattr(Customer, _column.key), 'set', _clear_customer_snapshot)
+event.listen(Customer.custom_fields, 'modified', _clear_customer_snapshot)
+for _event_name in ('refresh', 'refresh_flush'):
+    event.listen(Customer, _event_name, _clear_customer_snapshot)
+event.listen(Customer, 'expire', _clear_customer_all_json)
+
+
 class Message(Base):
     __tablename__ = "messages"
 
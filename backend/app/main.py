@@ -1,6 +1,17 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# 日志经队列交给后台线程写出，避免 stdout 写入阻塞事件循环
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
 from fastapi import FastAPI, Request, status
@@ -232,6 +243,12 @@ async def on_shutdown(): # Add shutdown event
         await telegram_listener_instance.stop_listening_all_users()
         logger.info("✅ Telegram listener stopped successfully")
 
+    # 断开工作流复用的 Telegram 客户端和 HTTP 连接池
+    from app.services.workflow_engine import close_telegram_clients, close_httpx_client
+    await close_telegram_clients()
+    await close_httpx_client()
+    logger.info("✅ Workflow Telegram clients and HTTP client closed")
+
 # ✅ 健康检查端点，可以用来手动触发监听器恢复
 @app.get("/health/telegram")
 async def telegram_health_check():
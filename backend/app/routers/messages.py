@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from sqlalchemy.orm import Session
 from app.db.database import SessionLocal
 from app.db import models
@@ -10,6 +10,7 @@ from app.metrics import metrics
 from fastapi.responses import StreamingResponse
 import json
 import asyncio
+from contextlib import asynccontextmanager
 from app.events import subscribers, publish_event
 from app.middleware.auth import get_current_user
 from app.core.config import settings
@@ -37,6 +38,17 @@ def get_db():
 # ✅ 收消息入口
 @router.post("/inbox", response_model=MessageOut)
 async def receive_message(data: dict, db: Session = Depends(get_db)):
+    message, _ = await _store_inbound_message(data, db)
+    return message
+
+
+async def _store_inbound_message(data: dict, db: Session, run_workflows: bool = True):
+    """
+    保存一条入站消息并发送 SSE 事件，返回 (MessageOut, 待执行的工作流)
+    
+    run_workflows 为 True 时在当前请求中依次执行工作流，返回的待执行工作流为 None；
+    为 False 时不执行，返回 (工作流 ID 列表, 触发数据) 交由调用方在后台执行。
+    """
     print(f"⏱️ {datetime.now()} - 收到消息推送: {data}")
     
     # 🔧 新增：消息去重检查，防止历史消息重复触发工作流
@@ -337,17 +349,21 @@ async def receive_message(data: dict, db: Session = Depends(get_db)):
 
         # 🔧 新增：检查是否应该跳过工作流触发（历史消息）
         skip_workflow = data.get("skip_workflow", False)
+        deferred_workflows = None
         if skip_workflow:
             print(f"⚠️ {datetime.now()} - 跳过历史消息的工作流触发")
+        elif not run_workflows:
+            deferred_workflows = ([workflow.id for workflow in workflows], trigger_data)
         else:
-            # 对每条消息都触发工作流
-            for workflow in workflows:
-                try:
-                    print(f"🔄 {datetime.now()} - 触发工作流 {workflow.id}")
-                    await workflow_engine.execute_workflow(workflow.id, trigger_data)
-                except Exception as e:
-                    print(f"❌ {datetime.now()} - 工作流 {workflow.id} 执行失败: {str(e)}")
-                    # 不要中断消息处理，继续执行其他工作流
+            # 对每条消息都触发工作流；与同一会话在后台执行的工作流互斥，保证回复顺序
+            async with _conversation_lock(_conversation_key(trigger_data)):
+                for workflow in workflows:
+                    try:
+                        print(f"🔄 {datetime.now()} - 触发工作流 {workflow.id}")
+                        await workflow_engine.execute_workflow(workflow.id, trigger_data)
+                    except Exception as e:
+                        print(f"❌ {datetime.now()} - 工作流 {workflow.id} 执行失败: {str(e)}")
+                        # 不要中断消息处理，继续执行其他工作流
 
         # 总是返回消息对象
         return MessageOut(
@@ -360,7 +376,7 @@ async def receive_message(data: dict, db: Session = Depends(get_db)):
             channel=db_msg.channel, # 修复：添加缺失的 channel 字段
             media_type=db_msg.media_type, # 新增
             transcription=db_msg.transcription # 新增
-        )
+        ), deferred_workflows
     except Exception as e:
         db.rollback()
         error_msg = f"❌ Error processing message: {str(e)}"
@@ -368,6 +384,86 @@ async def receive_message(data: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=error_msg)
 
 
+# 批量入站消息在后台执行工作流时，同时处理的会话数上限
+_BATCH_WORKFLOW_CONCURRENCY = 4
+
+# 会话 -> [锁, 使用者数量]；同一会话的工作流跨请求依次执行，无人使用时移除
+_conversation_locks = {}
+
+
+def _conversation_key(trigger_data: dict):
+    """工作流按会话串行执行的键：用户 + chat_id（没有时用 phone）"""
+    return (trigger_data.get("user_id"), trigger_data.get("chat_id") or trigger_data.get("phone"))
+
+
+@asynccontextmanager
+async def _conversation_lock(key):
+    """持有会话锁期间执行该会话的工作流；asyncio.Lock 按等待顺序唤醒，先到的消息先执行"""
+    entry = _conversation_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _conversation_locks.pop(key, None)
+
+
+async def _run_deferred_workflows(deferred: list):
+    """
+    在后台执行批量消息触发的工作流
+    
+    同一会话（用户 + chat_id/phone）的消息按到达顺序依次执行，并通过会话锁与其他请求中
+    同一会话的工作流互斥，保证回复顺序；不同会话并发执行，最多 _BATCH_WORKFLOW_CONCURRENCY 个。
+    每个会话使用独立的数据库会话。
+    """
+    from app.services.workflow_engine import WorkflowEngine
+
+    conversations = {}
+    for workflow_ids, trigger_data in deferred:
+        conversations.setdefault(_conversation_key(trigger_data), []).append((workflow_ids, trigger_data))
+
+    semaphore = asyncio.Semaphore(_BATCH_WORKFLOW_CONCURRENCY)
+
+    async def run_conversation(key, items):
+        # 先排队取得会话锁，再占用并发名额，等待中的会话不占名额
+        async with _conversation_lock(key), semaphore:
+            db = SessionLocal()
+            try:
+                workflow_engine = WorkflowEngine(db)
+                for workflow_ids, trigger_data in items:
+                    for workflow_id in workflow_ids:
+                        try:
+                            print(f"🔄 {datetime.now()} - 触发工作流 {workflow_id}")
+                            await workflow_engine.execute_workflow(workflow_id, trigger_data)
+                        except Exception as e:
+                            print(f"❌ {datetime.now()} - 工作流 {workflow_id} 执行失败: {str(e)}")
+            finally:
+                db.close()
+
+    await asyncio.gather(*(run_conversation(key, items) for key, items in conversations.items()))
+
+
+# ✅ 批量收消息入口：网关把短时间内的多条消息合并为一次请求。
+# 先逐条保存消息并返回各条结果，工作流在响应之后于后台执行，慢工作流不会拖住整批消息
+@router.post("/inbox/batch")
+async def receive_message_batch(data: dict, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    results = []
+    deferred = []
+    for item in data.get("batch") or []:
+        try:
+            msg, pending = await _store_inbound_message(item, db, run_workflows=False)
+            results.append({"status": "ok", "message_id": msg.id})
+            if pending and pending[0]:
+                deferred.append(pending)
+        except HTTPException as e:
+            results.append({"status": "error", "status_code": e.status_code, "detail": e.detail})
+    if deferred:
+        background_tasks.add_task(_run_deferred_workflows, deferred)
+    return {"results": results}
+
+
 # ✅ 发消息入口
 @router.post("/send", response_model=MessageOut)
 def send_message(
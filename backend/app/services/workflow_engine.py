@@ -20,12 +20,17 @@ Workflow Engine - 基于用户提供的 MVP 架构实现
 import asyncio
 import json
 import logging
+import sys
 import random # 修复: 导入 random 模块
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Union
+from typing import Callable, Dict, Any, List, Optional, Union
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
+from functools import lru_cache
+from collections.abc import Mapping
+from urllib.parse import urlsplit
 import traceback
 from app.db.models import (
     Workflow, WorkflowExecution, WorkflowStepExecution, 
@@ -43,20 +48,51 @@ import time
 import base64
 import tempfile
 import os
+import atexit
+import hashlib
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.errors.rpcerrorlist import RPCError
+from telethon.errors import AuthKeyError, UnauthorizedError
 from fastapi import HTTPException
 import httpx # 新增: 导入 httpx
 
 logger = logging.getLogger(__name__)
 
+try:
+    import cryptg  # noqa: F401  安装后 Telethon 自动使用 C 实现的 AES-IGE 加解密
+except ImportError:
+    logger.warning("cryptg 未安装，Telethon 将使用纯 Python 加密，Telegram 媒体上传会明显变慢")
+
+try:
+    import ahocorasick  # 屏蔽词多模式匹配
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson  # C 实现的 JSON 编解码，用于客户数据的解析与序列化
+except ImportError:
+    orjson = None
+
+def _format_traceback(exc: BaseException) -> str:
+    """
+    格式化异常堆栈，结果缓存在异常对象上
+    
+    节点失败时异常会继续抛到工作流层，两层都要记录 error_details，同一异常只格式化一次。
+    """
+    formatted = getattr(exc, '_formatted_traceback', None)
+    if formatted is None:
+        formatted = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        try:
+            exc._formatted_traceback = formatted
+        except AttributeError:  # 部分内置异常不允许设置属性
+            pass
+    return formatted
+
 def serialize_for_json(obj):
     """将对象序列化为 JSON 兼容的格式"""
-    import uuid
-    
-    if obj is None:
-        return None
+    if obj is None or isinstance(obj, (str, int, float, bool)):  # 最常见的叶子值，直接返回
+        return obj
     elif isinstance(obj, uuid.UUID):  # 处理 UUID 对象
         return str(obj)
     elif hasattr(obj, '__dict__'):
@@ -144,8 +180,147 @@ async def _ensure_client_connect(client: TelegramClient, max_retries: int = 3, d
             else:
                 raise
 
+class _CachedTelegramClient:
+    """缓存的用户 TelegramClient 及其会话指纹、正在使用它的发送数"""
+    __slots__ = ('client', 'fingerprint', 'users', 'stale')
+
+    def __init__(self, client: TelegramClient, fingerprint: str):
+        self.client = client
+        self.fingerprint = fingerprint
+        self.users = 0
+        self.stale = False  # 已从缓存移除，最后一个使用者结束后断开
+
+
+# 每个用户复用一个长连接 TelegramClient，避免每条消息都重新握手 MTProto
+_telegram_clients: Dict[int, _CachedTelegramClient] = {}
+_telegram_client_locks: Dict[int, asyncio.Lock] = {}
+# 说明连接或授权已失效的异常，出现时丢弃客户端；实体错误、FloodWait 等不影响其他发送
+_TELEGRAM_CONNECTION_ERRORS = (ConnectionError, AuthKeyError, UnauthorizedError)
+# 已写入磁盘的 session 文件，键为解码后内容的 blake2b 哈希，同一内容只写一次
+_SESSION_FILE_CACHE: Dict[str, str] = {}
+
+def _write_session_file(data: bytes) -> str:
+    """将 session 数据写入临时文件（按内容去重），返回文件路径"""
+    h = hashlib.blake2b(data, digest_size=16).hexdigest()
+    path = _SESSION_FILE_CACHE.get(h)
+    if path and os.path.exists(path):
+        return path
+    path = os.path.join(tempfile.gettempdir(), f"crm_tg_{h}.session")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    _SESSION_FILE_CACHE[h] = path
+    return path
+
+@atexit.register
+def _cleanup_session_files():
+    """进程退出时清理所有临时 session 文件"""
+    for path in _SESSION_FILE_CACHE.values():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove temp session file {path}: {e}")
+    _SESSION_FILE_CACHE.clear()
+
+def _telegram_session_fingerprint(db: Session, user_id: int) -> str:
+    """用户已保存会话的指纹（取加密后的原值，不解密）；重新登录后指纹变化，缓存的客户端随之重建"""
+    rows = db.query(models.Setting.key, models.Setting.value).filter(
+        models.Setting.user_id == user_id,
+        models.Setting.key.in_(('telegram_string_session', 'telegram_session_file')),
+    ).all()
+    digest = hashlib.blake2b(digest_size=16)
+    for key, value in sorted(rows):
+        digest.update(f"{key}={value or ''}\n".encode())
+    return digest.hexdigest()
+
+async def _disconnect_client(user_id: int, client: TelegramClient):
+    if client.is_connected():
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.warning(f"Failed to disconnect Telegram client for user {user_id}: {e}")
+
+def _retire_client(user_id: int, entry: _CachedTelegramClient):
+    """把客户端移出缓存；之后的发送会新建客户端，正在进行的发送继续使用原客户端"""
+    if _telegram_clients.get(user_id) is entry:
+        _telegram_clients.pop(user_id)
+    entry.stale = True
+
+@asynccontextmanager
+async def _user_telegram_client(user_id: int, fingerprint: str, session_factory, api_id: int, api_hash: str):
+    """
+    借用用户的长连接 TelegramClient，不存在或会话指纹变化时调用 session_factory 构建会话并连接
+    
+    只有连接或授权错误才丢弃客户端；被丢弃的客户端在所有正在使用它的发送结束后才断开。
+    """
+    lock = _telegram_client_locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        entry = _telegram_clients.get(user_id)
+        if entry is not None and entry.fingerprint != fingerprint:
+            # 用户重新登录，旧会话的客户端不再使用
+            _retire_client(user_id, entry)
+            if entry.users == 0:
+                await _disconnect_client(user_id, entry.client)
+            entry = None
+        if entry is None:
+            session_param = session_factory()
+            if isinstance(session_param, bytes):
+                # SQLite session 内容：文件写入放到线程池，避免阻塞事件循环
+                session_param = await asyncio.to_thread(_write_session_file, session_param)
+            entry = _CachedTelegramClient(TelegramClient(session_param, api_id, api_hash), fingerprint)
+            _telegram_clients[user_id] = entry
+        try:
+            await _ensure_client_connect(entry.client)
+        except Exception:
+            if entry.users == 0:
+                _retire_client(user_id, entry)
+            raise
+        entry.users += 1
+    try:
+        yield entry.client
+    except _TELEGRAM_CONNECTION_ERRORS:
+        _retire_client(user_id, entry)
+        raise
+    finally:
+        entry.users -= 1
+        if entry.stale and entry.users == 0:
+            await _disconnect_client(user_id, entry.client)
+
+async def close_telegram_clients():
+    """断开所有缓存的 TelegramClient（应用关闭时调用）"""
+    for user_id, entry in list(_telegram_clients.items()):
+        _telegram_clients.pop(user_id, None)
+        await _disconnect_client(user_id, entry.client)
+
+# Telegram 对同一会话的发送频率约为每秒 1 条：按会话预约发送时间，
+# 只等待距上次发送的剩余间隔（媒体上传耗时已超过间隔时仅让出一次事件循环）
+_TELEGRAM_CHAT_SEND_INTERVAL = 1.0
+_telegram_next_send_at: Dict[str, float] = {}
+
+async def _pace_telegram_send(chat_key):
+    """在向同一会话发送前按最小间隔等待"""
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    if len(_telegram_next_send_at) > 1024:
+        # 清理已过期的预约，避免会话数增长导致字典无限膨胀
+        for key in [k for k, t in _telegram_next_send_at.items() if t <= now]:
+            del _telegram_next_send_at[key]
+    send_at = max(now, _telegram_next_send_at.get(chat_key, 0.0))
+    _telegram_next_send_at[chat_key] = send_at + _TELEGRAM_CHAT_SEND_INTERVAL
+    await asyncio.sleep(send_at - now)
+
 class WorkflowContext:
     """工作流执行上下文"""
+    # 每个节点都会多次读取上下文，固定属性布局，省去实例 __dict__
+    __slots__ = (
+        'variables', 'chat', 'actor', 'db', 'versions', 'scheduled_at',
+        'message_id', 'sent_at', 'ai', 'records', 'processors',
+    )
+
     def __init__(self):
         self.variables = {}
         self.chat = {}
@@ -156,6 +331,8 @@ class WorkflowContext:
         self.message_id = None
         self.sent_at = None
         self.ai = {} # 新增 ai 上下文
+        self.records = {} # 本次执行内已查询的 CustomEntityRecord，键为 (entity_type_id, record_id)
+        self.processors = {} # 绑定到本上下文、可复用的无状态处理器，键为处理器类
 
     def set(self, key: str, value: Any):
         self.variables[key] = value
@@ -166,21 +343,109 @@ class WorkflowContext:
     def update_from_dict(self, data: Dict[str, Any]):
         self.variables.update(data)
 
+    # fork/merge_fork 处理的属性：字典逐键合并，其余按值整体替换
+    _DICT_SLOTS = ('variables', 'chat', 'actor', 'db', 'versions', 'ai', 'records')
+    _VALUE_SLOTS = ('scheduled_at', 'message_id', 'sent_at')
+
+    def fork(self) -> "WorkflowContext":
+        """
+        为并行分支创建上下文副本
+        
+        节点只对各字典做顶层键赋值，浅拷贝即可隔离各分支的写入；
+        分支结束后由 merge_fork 合并回原上下文。
+        """
+        child = WorkflowContext.__new__(WorkflowContext)
+        for name in self._DICT_SLOTS:
+            setattr(child, name, dict(getattr(self, name)))
+        for name in self._VALUE_SLOTS:
+            setattr(child, name, getattr(self, name))
+        child.processors = {}  # 处理器绑定各自的上下文，分支不复用父上下文的实例
+        return child
+
+    def merge_fork(self, branch: "WorkflowContext", base: "WorkflowContext"):
+        """
+        把分支上下文相对分叉时快照 base 的改动合并回来
+        
+        只合并分支新增、修改或删除的键；多个分支写同一个键时，后合并的分支生效。
+        """
+        for name in self._DICT_SLOTS:
+            target, before, after = getattr(self, name), getattr(base, name), getattr(branch, name)
+            for key, value in after.items():
+                if key not in before or before[key] is not value:
+                    target[key] = value
+            for key in before:
+                if key not in after:
+                    target.pop(key, None)
+        for name in self._VALUE_SLOTS:
+            value = getattr(branch, name)
+            if value is not getattr(base, name):
+                setattr(self, name, value)
+
     def to_dict(self) -> Dict[str, Any]:
         """返回上下文的字典表示"""
         return self.variables
 
+# JSON 请求体模板中的 {{variable}} 占位符
+_JSON_BODY_VAR_RE = re.compile(r'\{\{([^}]+)\}\}')
+
+# 会话的当前事务中是否已有 flush 到数据库但未提交的写入（db.new/dirty/deleted 不包含这些写入）
+_FLUSHED_WRITES_KEY = '_workflow_flushed_writes'
+
+def _mark_flushed_writes(session, flush_context):
+    session.info[_FLUSHED_WRITES_KEY] = True
+
+def _clear_flushed_writes(session):
+    session.info.pop(_FLUSHED_WRITES_KEY, None)
+
+event.listen(Session, 'after_flush', _mark_flushed_writes)
+event.listen(Session, 'after_commit', _clear_flushed_writes)
+event.listen(Session, 'after_rollback', _clear_flushed_writes)
+
+def release_db_connection(db: Session):
+    """
+    在耗时的外部调用（LLM、HTTP）之前结束只读事务，把连接归还连接池
+    
+    会话在首次查询时占用连接，直到提交或回滚才释放；若在等待外部响应期间一直持有，
+    并发执行的工作流会耗尽连接池。存在未提交的写入（包括已 flush 的）时不做处理，避免提前提交半成品数据。
+    """
+    if db.in_transaction() and not (db.new or db.dirty or db.deleted or db.info.get(_FLUSHED_WRITES_KEY)):
+        db.commit()
+
 class NodeProcessor:
     """节点处理器基类"""
+
+    # 执行过程中是否读写数据库会话（提交、回滚或写入）；并行分支共享同一个 Session，
+    # 这类节点逐个执行，只有标记为 False 的节点才会与其他分支并发执行
+    USES_DB = True
+    # 不在实例上保存执行期间的状态；为 True 时同一上下文内同类型节点复用一个实例
+    STATELESS = False
     
     def __init__(self, db: Session, context: WorkflowContext):
         self.db = db
         self.context = context
+        # 并行分支中由引擎设置：其他分支独占会话时持有该锁
+        self.db_lock: Optional[asyncio.Lock] = None
+
+    def _release_db_connection(self):
+        """外部调用前归还连接；其他分支正在使用会话时跳过，避免提前提交其未完成的写入"""
+        if self.db_lock is not None and self.db_lock.locked():
+            return
+        release_db_connection(self.db)
         
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """执行节点并返回输出"""
         raise NotImplementedError
 
+    def _get_custom_entity_record(self, entity_type_id: int, record_id: Any) -> Optional[CustomEntityRecord]:
+        """获取自定义实体记录，同一次工作流执行内只查询一次数据库"""
+        key = (entity_type_id, record_id)
+        if key not in self.context.records:
+            self.context.records[key] = self.db.query(CustomEntityRecord).filter(
+                CustomEntityRecord.entity_type_id == entity_type_id,
+                CustomEntityRecord.id == record_id
+            ).first()
+        return self.context.records[key]
+
     def _resolve_variable_from_context(self, variable_path: str, default: Any = None) -> Any:
         """解析上下文中的变量"""
         # 支持: trigger.X, db.customer.field, ai.field, api.response.field, settings.field
@@ -204,118 +469,10 @@ class NodeProcessor:
             logger.warning(f"解析变量 '{variable_path}' 失败: {e}")
             return default
 
-    def _resolve_json_body_from_context(self, json_string: str) -> Any:
-        """解析 JSON 字符串中的所有变量"""
-        def replace_var(match):
-            var_path = match.group(1)
-            print(f"      🔍 JSON Body 中解析变量: {var_path}")
-            
-            # 使用与 _resolve_text_variables 相同的逻辑
-            resolved_value = None
-            
-            # 1. 优先尝试 'trigger' 相关变量
-            if var_path.startswith("trigger."):
-                trigger_data = self.context.get("trigger_data", {})
-                field_name = var_path.replace("trigger.", "")
-                resolved_value = trigger_data.get(field_name)
-                if resolved_value is not None:
-                    print(f"        ✅ 从 trigger 解析: {var_path} -> {resolved_value}")
-                else:
-                    print(f"        ❌ trigger 中未找到: {var_path}")
-            
-            # 2. 尝试 'db.customer' 相关变量
-            elif var_path.startswith("db.customer."):
-                customer = self.context.db.get("customer")
-                if customer:
-                    field_name = var_path.replace("db.customer.", "")
-                    if hasattr(customer, field_name):
-                        resolved_value = getattr(customer, field_name)
-                        print(f"        ✅ 从 db.customer 解析: {var_path} -> {resolved_value}")
-                    else:
-                        print(f"        ❌ customer 对象没有字段: {field_name}")
-                else:
-                    print(f"        ❌ 上下文中没有 customer 对象")
-            
-            # 3. 尝试 'custom_fields' 相关变量
-            elif var_path.startswith("custom_fields."):
-                customer = self.context.db.get("customer")
-                if customer and hasattr(customer, 'custom_fields'):
-                    field_name = var_path.replace("custom_fields.", "")
-                    custom_fields = customer.custom_fields or {}
-                    resolved_value = custom_fields.get(field_name)
-                    if resolved_value is not None:
-                        print(f"        ✅ 从 custom_fields 解析: {var_path} -> {resolved_value}")
-                    else:
-                        print(f"        ❌ custom_fields 中未找到: {field_name}")
-                else:
-                    print(f"        ❌ customer 对象没有 custom_fields")
-            
-            # 4. 尝试从 AI 输出中解析
-            elif var_path.startswith("ai."):
-                ai_data = self.context.ai
-                field_name = var_path.replace("ai.", "")
-                resolved_value = ai_data.get(field_name) if ai_data else None
-                if resolved_value is not None:
-                    print(f"        ✅ 从 ai 解析: {var_path} -> {resolved_value}")
-                else:
-                    print(f"        ❌ ai 中未找到: {var_path}")
-            
-            # 5. 尝试从 API 响应中解析
-            elif var_path.startswith("api."):
-                api_data = self.context.get("api.response", {})
-                field_name = var_path.replace("api.", "")
-                resolved_value = api_data.get(field_name) if api_data else None
-                if resolved_value is not None:
-                    print(f"        ✅ 从 api.response 解析: {var_path} -> {resolved_value}")
-                else:
-                    print(f"        ❌ api.response 中未找到: {var_path}")
-            
-            # 6. 尝试 'customer' 相关变量（兼容格式）
-            elif var_path.startswith("customer."):
-                customer = self.context.db.get("customer")
-                if customer:
-                    field_name = var_path.replace("customer.", "")
-                    
-                    # 特殊处理一些常见的字段映射
-                    if field_name == "last_message":
-                        # 获取最后一条消息内容
-                        trigger_data = self.context.get("trigger_data", {})
-                        resolved_value = trigger_data.get("message")
-                        if resolved_value is not None:
-                            print(f"        ✅ 从 customer.last_message (trigger) 解析: {var_path} -> {resolved_value}")
-                        else:
-                            print(f"        ❌ customer.last_message 未找到触发消息")
-                    elif hasattr(customer, field_name):
-                        resolved_value = getattr(customer, field_name)
-                        print(f"        ✅ 从 customer 解析: {var_path} -> {resolved_value}")
-                    else:
-                        print(f"        ❌ customer 对象没有字段: {field_name}")
-                else:
-                    print(f"        ❌ 上下文中没有 customer 对象")
-            
-            # 7. 直接从上下文变量中查找
-            else:
-                resolved_value = self.context.get(var_path)
-                if resolved_value is not None:
-                    print(f"        ✅ 从 context 解析: {var_path} -> {resolved_value}")
-                else:
-                    print(f"        ❌ context 中未找到: {var_path}")
-            
-            # 对于 JSON 字符串中的变量替换，我们需要返回字符串内容而不是 JSON 值
-            # 这样多个变量可以连接在一起形成一个完整的字符串
-            if resolved_value is None:
-                print(f"        ⚠️ 变量未解析，使用空字符串: {var_path}")
-                return ""  # 返回空字符串，这样可以与其他字符串连接
-            else:
-                print(f"        📝 变量解析为字符串: {var_path} -> {resolved_value}")
-                return str(resolved_value)  # 直接返回字符串值，不进行 JSON 编码
-
-        # 首先进行变量替换，得到处理后的字符串
-        processed_json_string = re.sub(r'\{\{([^}]+)\}\}', replace_var, json_string)
-        print(f"    变量替换后的 JSON 字符串: {processed_json_string}")
-        
+    @staticmethod
+    def _parse_json_body(processed_json_string: str) -> Any:
+        """将变量替换后的字符串解析为 JSON 对象"""
         try:
-            # 重新解析为 JSON 对象
             return json.loads(processed_json_string)
         except json.JSONDecodeError as e:
             logger.error(f"无法解析 JSON 请求体，可能包含无效变量或格式错误: {e}")
@@ -324,6 +481,8 @@ class NodeProcessor:
 
 class MessageTriggerProcessor(NodeProcessor):
     """消息触发器节点"""
+
+    STATELESS = True
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """处理消息触发"""
@@ -453,6 +612,8 @@ class MessageTriggerProcessor(NodeProcessor):
 
 class DbTriggerProcessor(NodeProcessor):
     """数据库触发器节点 - 监听数据库字段变化"""
+
+    STATELESS = True
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """处理数据库触发"""
@@ -830,6 +991,88 @@ class DbTriggerProcessor(NodeProcessor):
         else:
             return False
 
+# AI prompt 中的 {{variable}} 占位符
+_PROMPT_VAR_RE = re.compile(r'\{\{([^}]+)\}\}')
+
+# 以下解析函数供 AI 节点的 prompt 变量替换使用，参数 rest 为去掉首段后的路径；
+# 返回 None 表示未解析（保留原始占位符），返回 _PROMPT_VAR_UNHANDLED 表示交由上下文变量查找
+_PROMPT_VAR_UNHANDLED = object()
+
+# prompt 中 customer.* 可直接读取的客户列；其余字段名直接查 custom_fields
+_PROMPT_CUSTOMER_ATTRS = frozenset(column.key for column in Customer.__table__.columns)
+
+
+def _resolve_prompt_trigger_var(rest: str, trigger_data, customer, ai_data, api_data):
+    # 字段映射处理: content -> message
+    if rest == "content":
+        rest = "message"
+    return trigger_data.get(rest)
+
+
+def _resolve_prompt_customer_var(rest: str, trigger_data, customer, ai_data, api_data):
+    if not customer:
+        return None
+    # 特殊处理 last_message
+    if rest == "last_message":
+        return trigger_data.get("message", "")
+    # 标准客户字段
+    if rest in _PROMPT_CUSTOMER_ATTRS:
+        value = _customer_snapshot(customer).get(rest)
+        if value is not None:
+            return value
+    # 尝试从客户自定义字段中获取
+    if hasattr(customer, 'custom_fields'):
+        return _parse_custom_fields(customer).get(rest)
+    return None
+
+
+def _resolve_prompt_custom_field_var(rest: str, trigger_data, customer, ai_data, api_data):
+    if customer and hasattr(customer, 'custom_fields'):
+        return _parse_custom_fields(customer).get(rest)
+    return None
+
+
+def _resolve_prompt_db_var(rest: str, trigger_data, customer, ai_data, api_data):
+    # 仅支持 db.customer.*（兼容旧格式），其他 db.* 交由上下文变量查找
+    if not rest.startswith("customer."):
+        return _PROMPT_VAR_UNHANDLED
+    field = rest[9:]
+    if customer and field in _PROMPT_CUSTOMER_ATTRS:
+        return _customer_snapshot(customer).get(field)
+    return None
+
+
+def _resolve_prompt_ai_var(rest: str, trigger_data, customer, ai_data, api_data):
+    return _get_nested_value(ai_data, rest)
+
+
+def _resolve_prompt_api_var(rest: str, trigger_data, customer, ai_data, api_data):
+    return _get_nested_value(api_data, rest)
+
+
+_PROMPT_VAR_RESOLVERS = {
+    "trigger": _resolve_prompt_trigger_var,
+    "customer": _resolve_prompt_customer_var,
+    "custom_fields": _resolve_prompt_custom_field_var,
+    "db": _resolve_prompt_db_var,
+    "ai": _resolve_prompt_ai_var,
+    "api": _resolve_prompt_api_var,
+}
+
+
+@lru_cache(maxsize=1024)
+def _parse_prompt_var(raw_path: str):
+    """
+    拆分 prompt 占位符内的路径，返回 (变量路径, 解析函数, 剩余路径)
+    
+    同一 prompt 模板会对大量消息反复求值，路径拆分和分派结果只计算一次；
+    首段无对应解析函数时解析函数为 None，由调用方从上下文变量中查找。
+    """
+    var_path = raw_path.strip()
+    head, sep, rest = var_path.partition('.')
+    resolver = _PROMPT_VAR_RESOLVERS.get(head) if sep else None
+    return var_path, resolver, rest
+
 class AIProcessor(NodeProcessor):
     """AI 节点 - 集成分析和回复生成"""
     
@@ -1216,6 +1459,7 @@ Remember: Return ONLY the JSON. No markdown, no explanations, just valid JSON.""
                     media_matches = re.findall(media_pattern, system_prompt)
                     print(f"  🖼️ System Prompt 中发现媒体 UUID: {media_matches}")
                     
+                    self._release_db_connection()
                     llm_response = await self.ai_service.generate_combined_response(
                         system_prompt=system_prompt,
                         user_prompt=resolved_user_prompt,
@@ -1449,154 +1693,44 @@ Remember: Return ONLY the JSON. No markdown, no explanations, just valid JSON.""
         """
         if not prompt:
             return ""
+        if '{{' not in prompt: # 无变量的 prompt 直接返回，跳过正则替换
+            return prompt
             
-        print(f"  🔍 AI Prompt 变量解析开始...")
-        print(f"    原始 Prompt: {prompt[:100]}...")
+        logger.debug("🔍 AI Prompt 变量解析开始...")
+        logger.debug("原始 Prompt: %s...", prompt[:100])
         
         try:
-            # 使用正则表达式找到所有 {{variable}} 格式的变量
-            import re
-            pattern = r'\{\{([^}]+)\}\}'
+            # 获取上下文数据（整个 prompt 只取一次，而不是每个变量各取一次）
+            trigger_data = self.context.get("trigger_data", {})
+            customer = self.context.get("ctx.db.customer")
+            ai_data = self.context.get("ai", {})
+            api_data = self.context.get("api", {})
             
             def replace_variable(match):
-                var_path = match.group(1).strip()
-                print(f"    🔍 解析变量: {var_path}")
-                
-                # 获取上下文数据
-                trigger_data = self.context.get("trigger_data", {})
-                customer = self.context.get("ctx.db.customer")
-                ai_data = self.context.get("ai", {})
-                api_data = self.context.get("api", {})
-                
-                # 1. 触发器变量
-                if var_path.startswith("trigger."):
-                    field = var_path[8:]  # 移除 "trigger." 前缀
-                    
-                    # 字段映射处理
-                    if field == "content":
-                        field = "message"  # content -> message
-                    elif field == "user_id":
-                        field = "user_id"
-                    
-                    value = trigger_data.get(field)
-                    if value is not None:
-                        print(f"      ✅ 从 trigger 解析: {var_path} -> {value}")
-                        return str(value)
-                    else:
-                        print(f"      ❌ trigger 中未找到: {var_path}")
-                
-                # 2. 客户基础信息变量
-                elif var_path.startswith("customer."):
-                    field = var_path[9:]  # 移除 "customer." 前缀
-                    
-                    if customer:
-                        # 特殊处理 last_message
-                        if field == "last_message":
-                            value = trigger_data.get("message", "")
-                            print(f"      ✅ 客户最后消息: {var_path} -> {value}")
-                            return str(value)
-                        
-                        # 标准客户字段
-                        value = getattr(customer, field, None)
-                        if value is not None:
-                            print(f"      ✅ 从 customer 解析: {var_path} -> {value}")
-                            return str(value)
-                        
-                        # 尝试从客户自定义字段中获取
-                        if hasattr(customer, 'custom_fields') and customer.custom_fields:
-                            custom_value = customer.custom_fields.get(field)
-                            if custom_value is not None:
-                                print(f"      ✅ 从客户自定义字段解析: {var_path} -> {custom_value}")
-                                return str(custom_value)
-                    
-                    print(f"      ❌ customer 中未找到: {var_path}")
-                
-                # 3. 客户自定义字段变量
-                elif var_path.startswith("custom_fields."):
-                    field = var_path[14:]  # 移除 "custom_fields." 前缀
-                    
-                    if customer and hasattr(customer, 'custom_fields') and customer.custom_fields:
-                        value = customer.custom_fields.get(field)
-                        if value is not None:
-                            print(f"      ✅ 从自定义字段解析: {var_path} -> {value}")
-                            return str(value)
-                    
-                    print(f"      ❌ 自定义字段中未找到: {var_path}")
-                
-                # 4. 数据库客户字段变量 (兼容旧格式)
-                elif var_path.startswith("db.customer."):
-                    field = var_path[12:]  # 移除 "db.customer." 前缀
-                    
-                    if customer:
-                        value = getattr(customer, field, None)
-                        if value is not None:
-                            print(f"      ✅ 从 db.customer 解析: {var_path} -> {value}")
-                            return str(value)
-                    
-                    print(f"      ❌ db.customer 中未找到: {var_path}")
-                
-                # 5. AI 输出变量
-                elif var_path.startswith("ai."):
-                    path_parts = var_path.split('.')
-                    current = ai_data
-                    
-                    try:
-                        for part in path_parts[1:]:  # 跳过 "ai"
-                            if isinstance(current, dict):
-                                current = current[part]
-                            else:
-                                current = getattr(current, part)
-                        
-                        if current is not None:
-                            print(f"      ✅ 从 AI 数据解析: {var_path} -> {current}")
-                            return str(current)
-                    except (KeyError, AttributeError):
-                        pass
-                    
-                    print(f"      ❌ AI 数据中未找到: {var_path}")
-                
-                # 6. API 响应变量
-                elif var_path.startswith("api."):
-                    path_parts = var_path.split('.')
-                    current = api_data
-                    
-                    try:
-                        for part in path_parts[1:]:  # 跳过 "api"
-                            if isinstance(current, dict):
-                                current = current[part]
-                            else:
-                                current = getattr(current, part)
-                        
-                        if current is not None:
-                            print(f"      ✅ 从 API 数据解析: {var_path} -> {current}")
-                            return str(current)
-                    except (KeyError, AttributeError):
-                        pass
-                    
-                    print(f"      ❌ API 数据中未找到: {var_path}")
+                var_path, resolver, rest = _parse_prompt_var(match.group(1))
+                logger.debug("🔍 解析变量: %s", var_path)
                 
-                # 7. 其他上下文变量
-                else:
-                    # 尝试直接从上下文获取
+                # 按首段分派到对应的数据源；无匹配的首段从上下文变量中查找
+                value = resolver(rest, trigger_data, customer, ai_data, api_data) if resolver else _PROMPT_VAR_UNHANDLED
+                if value is _PROMPT_VAR_UNHANDLED:
                     value = self.context.get(var_path)
-                    if value is not None:
-                        print(f"      ✅ 从上下文解析: {var_path} -> {value}")
-                        return str(value)
-                    
-                    print(f"      ❌ 上下文中未找到: {var_path}")
+                if value is not None:
+                    logger.debug("✅ 解析成功: %s -> %s", var_path, value)
+                    # 触发数据和客户字段大多已是字符串，无需再转换
+                    return value if type(value) is str else str(value)
                 
                 # 如果都找不到，返回原始变量
-                print(f"      ⚠️ 变量未解析，保持原样: {var_path}")
-                return f"{{{{{var_path}}}}}"
+                logger.debug("⚠️ 变量未解析，保持原样: %s", var_path)
+                return "{{" + var_path + "}}"
             
             # 执行变量替换
-            resolved_prompt = re.sub(pattern, replace_variable, prompt)
+            resolved_prompt = _PROMPT_VAR_RE.sub(replace_variable, prompt)
             
-            print(f"  ✅ AI Prompt 变量解析完成: {resolved_prompt[:100]}...")
+            logger.debug("✅ AI Prompt 变量解析完成: %s...", resolved_prompt[:100])
             return resolved_prompt
             
         except Exception as err:
-            print(f"  ⚠️ 解析 AI prompt 变量失败: {err}")
+            logger.warning("⚠️ 解析 AI prompt 变量失败: %s", err)
             return prompt
     
     async def _simulate_ai_response(self, system_prompt: str, user_prompt: str, model_config: dict) -> str:
@@ -1646,6 +1780,8 @@ Remember: Return ONLY the JSON. No markdown, no explanations, just valid JSON.""
 
 class UpdateDBProcessor(NodeProcessor):
     """数据库更新节点"""
+
+    STATELESS = True
     
     async def _resolve_match_value(self, match_value: str) -> str:
         """解析匹配值中的变量"""
@@ -2213,6 +2349,9 @@ class UpdateDBProcessor(NodeProcessor):
 
 class DelayProcessor(NodeProcessor):
     """延迟节点 - 控制工作时段和限频"""
+
+    USES_DB = False
+    STATELESS = True
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """计算延迟时间"""
@@ -2260,6 +2399,179 @@ class DelayProcessor(NodeProcessor):
         
         return {"ctx.scheduled_at": scheduled_at.isoformat()}
 
+_CUSTOM_OBJECT_FIELD_RE = re.compile(r"(\d+)\.(\d+)\.([a-zA-Z0-9_.]+)")
+_CUSTOM_OBJECT_ALL_RE = re.compile(r"(\d+)\.all")
+
+
+_MISSING = object()
+
+
+@lru_cache(maxsize=1024)
+def _compile_path(path: str) -> Callable[[Any], Any]:
+    """将点分路径编译为取值函数，模板中的路径固定不变，同一路径只拆分一次"""
+    parts = tuple(path.split('.'))
+
+    def accessor(data):
+        # 缺失字段很常见，逐级 get 取值并在遇到 None 时直接返回，不走异常路径
+        current = data
+        for part in parts:
+            if isinstance(current, dict):
+                current = current.get(part)
+            else:
+                current = getattr(current, part, None)
+            if current is None:
+                return None
+        return current
+    return accessor
+
+
+def _get_nested_value(data, path: str):
+    """按点分路径逐级访问 dict 键或对象属性，任一级不存在时返回 None"""
+    return _compile_path(path)(data)
+
+
+# 以下解析函数供发送节点的 {{variable}} 替换使用，参数 rest 为去掉首段后的路径；
+# 返回 None 表示未解析，调用方继续尝试通用上下文变量
+
+def _resolve_trigger_text_var(processor: "NodeProcessor", rest: str):
+    return _get_nested_value(processor.context.get("trigger_data", {}), rest)
+
+
+def _resolve_actor_text_var(processor: "NodeProcessor", rest: str):
+    return _get_nested_value(processor.context.get("actor", {}), rest)
+
+
+def _resolve_db_text_var(processor: "NodeProcessor", rest: str):
+    if not rest.startswith("customer."):
+        return None
+    customer_obj = processor.context.db.get("customer", None)
+    if not customer_obj:
+        return None
+    return _get_nested_value(customer_obj, rest[len("customer."):])
+
+
+def _customer_snapshot(customer) -> Dict[str, Any]:
+    """
+    客户各列取值的快照，缓存在实例上
+    
+    每个步骤提交后 ORM 实例会过期，之后再 getattr 会触发重新加载；快照不受过期影响，
+    仅在字段被赋值、custom_fields 原地修改或实例刷新时由模型事件清除。
+    """
+    snapshot = customer.__dict__.get('_snapshot')
+    if snapshot is None:
+        snapshot = {column.key: getattr(customer, column.key, None) for column in customer.__table__.columns}
+        customer._snapshot = snapshot
+    return snapshot
+
+
+def _customer_field(customer, field_name: str):
+    """读取客户字段：优先取快照，非列属性（如关系）回退到 ORM 对象"""
+    value = _customer_snapshot(customer).get(field_name, _MISSING)
+    if value is _MISSING:
+        return getattr(customer, field_name, None)
+    return value
+
+
+def _parse_custom_fields(customer) -> Dict[str, Any]:
+    """解析客户的 custom_fields；为字符串时按原始文本把解析结果缓存在实例上"""
+    raw = _customer_snapshot(customer).get('custom_fields')
+    if not isinstance(raw, str):
+        return raw or {}
+    if not raw:
+        return {}
+    cached = getattr(customer, '_cf_parsed', None)
+    if cached is not None and cached[0] == raw:
+        return cached[1]
+    parsed = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    customer._cf_parsed = (raw, parsed)
+    return parsed
+
+
+def _dumps_indented(data) -> str:
+    """序列化为缩进 2 的 JSON 文本（保留非 ASCII 字符）"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2, default=str).decode()
+    return json.dumps(data, ensure_ascii=False, indent=2, default=str)
+
+
+def _customer_all_json(customer) -> str:
+    """客户已加载列的 JSON 文本，缓存在实例上；字段变更、过期或刷新时由模型事件清除"""
+    cached = customer.__dict__.get('_all_json')
+    if cached is not None:
+        return cached
+    loaded = customer.__dict__
+    customer_data = {column.key: loaded[column.key] for column in customer.__table__.columns if column.key in loaded}
+
+    # 如果 custom_fields 是字符串，尝试解析为字典
+    if isinstance(customer_data.get('custom_fields'), str):
+        try:
+            customer_data['custom_fields'] = _parse_custom_fields(customer)
+        except ValueError:
+            pass # 保持原样，如果不是有效 JSON
+
+    customer._all_json = _dumps_indented(customer_data)
+    return customer._all_json
+
+
+def _resolve_customer_text_var(processor: "NodeProcessor", rest: str):
+    customer_obj = processor.context.db.get("customer", None)
+    if rest == "all":
+        if not customer_obj:
+            return "{}"
+        # 将整个客户对象（包括 custom_fields）转换为 JSON 字符串
+        return _customer_all_json(customer_obj)
+
+    if not customer_obj:
+        return None
+    # 特殊处理一些常见的字段映射：last_message 取触发消息内容
+    if rest == "last_message":
+        return processor.context.get("trigger_data", {}).get("message")
+    return getattr(customer_obj, rest, None)
+
+
+def _resolve_custom_object_text_var(processor: "NodeProcessor", rest: str):
+    match_field = _CUSTOM_OBJECT_FIELD_RE.match(rest)
+    if match_field:
+        entity_type_id = int(match_field.group(1))
+        record_id = int(match_field.group(2))
+        field_key = match_field.group(3)
+        record_obj = processor._get_custom_entity_record(entity_type_id, record_id)
+        if record_obj and record_obj.data and field_key in record_obj.data:
+            return _get_nested_value(record_obj.data, field_key)
+        return None
+
+    match_all = _CUSTOM_OBJECT_ALL_RE.match(rest)
+    if match_all:
+        entity_type_id = int(match_all.group(1))
+        # 从上下文中获取选中的记录ID，如果存在的话
+        selected_record_id = processor.context.get(f"selectedCustomEntityRecordId_{entity_type_id}")
+        if selected_record_id:
+            record_obj = processor._get_custom_entity_record(entity_type_id, selected_record_id)
+            if record_obj:
+                record_data = record_obj.data.copy() if record_obj.data else {}
+                return json.dumps(record_data, ensure_ascii=False, indent=2)
+        logger.debug("- Failed to resolve custom_object.all for entity type %s. Record not found or not selected.", entity_type_id)
+        return "{}"
+    return None
+
+
+def _resolve_ai_text_var(processor: "NodeProcessor", rest: str):
+    if not rest.startswith("reply."):
+        return None
+    return _get_nested_value(processor.context.ai.get("reply", {}), rest[len("reply."):])
+
+
+# 按变量路径首段分派，避免逐个 startswith 比较
+_TEXT_VAR_RESOLVERS = {
+    "trigger": _resolve_trigger_text_var,
+    "actor": _resolve_actor_text_var,
+    "db": _resolve_db_text_var,
+    "customer": _resolve_customer_text_var,
+    "custom_object": _resolve_custom_object_text_var,
+    "ai": _resolve_ai_text_var,
+}
+
+
 class SendWhatsAppMessageProcessor(NodeProcessor):
     """WhatsApp 消息发送节点"""
     
@@ -2903,167 +3215,57 @@ class SendWhatsAppMessageProcessor(NodeProcessor):
         """解析文本中的所有 {{variable_path}} 和 {variable_path} 变量"""
         if not isinstance(text, str): # Ensure text is a string
             return str(text)
-
-        def get_nested_value(data, path_parts):
-            current = data
-            for part in path_parts:
-                if isinstance(current, dict) and part in current:
-                    current = current[part]
-                elif isinstance(current, object) and hasattr(current, part):
-                    current = getattr(current, part)
-                else:
-                    return None
-            return current
+        if '{' not in text: # 纯文本无占位符，跳过正则替换
+            return text
 
         def replace_match(match):
             var_path = match.group(1).strip() # Extract path inside {{}} or {}
-            print(f"  🔍 Resolving variable path: {var_path}") # Debug print
-
-            # 尝试从各种上下文中解析变量
-            # 优先级：trigger_data, actor, db.customer, ai.reply, 通用变量, 其他节点输出
-
-            # 1. 优先尝试 'trigger' 相关变量
-            if var_path.startswith("trigger."):
-                trigger_data = self.context.get("trigger_data", {})
-                value = get_nested_value(trigger_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"    - Resolved from trigger: {var_path} -> {value}")
-                    return str(value)
-
-            # 2. 尝试 'actor' 相关变量
-            if var_path.startswith("actor."):
-                actor_data = self.context.get("actor", {})
-                value = get_nested_value(actor_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"    - Resolved from actor: {var_path} -> {value}")
-                    return str(value)
-
-            # 3. 尝试 'db.customer' 相关变量或 'customer.all'
-            if var_path.startswith("db.customer."):
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    value = get_nested_value(customer_obj, var_path.split('.')[2:])
-                    if value is not None:
-                        print(f"    - Resolved from db.customer: {var_path} -> {value}")
-                        return str(value)
-            elif var_path == "customer.all":
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    # 将整个客户对象（包括 custom_fields）转换为 JSON 字符串
-                    customer_data = customer_obj.__dict__.copy()
-                    customer_data.pop('_sa_instance_state', None)
-                    
-                    # 如果 custom_fields 是字符串，尝试解析为字典
-                    if isinstance(customer_data.get('custom_fields'), str):
-                        try:
-                            customer_data['custom_fields'] = json.loads(customer_data['custom_fields'])
-                        except json.JSONDecodeError:
-                            pass # 保持原样，如果不是有效 JSON
-
-                    return json.dumps(customer_data, ensure_ascii=False, indent=2)
-                return "{}"
-
-            # 4. 尝试 'custom_object' 相关变量
-            custom_object_match_field = re.match(r"custom_object\.(\d+)\.(\d+)\.([a-zA-Z0-9_.]+)", var_path)
-            custom_object_match_all = re.match(r"custom_object\.(\d+)\.all", var_path)
-
-            if custom_object_match_field:
-                entity_type_id = int(custom_object_match_field.group(1))
-                record_id = int(custom_object_match_field.group(2))
-                field_key = custom_object_match_field.group(3)
-                
-                record_obj = self.db.query(CustomEntityRecord).filter(
-                    CustomEntityRecord.entity_type_id == entity_type_id,
-                    CustomEntityRecord.id == record_id
-                ).first()
+            logger.debug("🔍 Resolving variable path: %s", var_path)
 
-                if record_obj and record_obj.data and field_key in record_obj.data:
-                    value = get_nested_value(record_obj.data, field_key.split('.'))
-                    if value is not None:
-                        print(f"    - Resolved from custom_object field: {var_path} -> {value}")
-                        return str(value)
-            elif custom_object_match_all:
-                entity_type_id = int(custom_object_match_all.group(1))
-                # 从上下文中获取选中的记录ID，如果存在的话
-                selected_record_id = self.context.get(f"selectedCustomEntityRecordId_{entity_type_id}")
-                
-                if selected_record_id:
-                    record_obj = self.db.query(CustomEntityRecord).filter(
-                        CustomEntityRecord.entity_type_id == entity_type_id,
-                        CustomEntityRecord.id == selected_record_id
-                    ).first()
-                    if record_obj:
-                        record_data = record_obj.data.copy() if record_obj.data else {}
-                        print(f"    - Resolved from custom_object all: {var_path} -> {record_data}")
-                        return json.dumps(record_data, ensure_ascii=False, indent=2)
-                print(f"    - Failed to resolve custom_object.all for entity type {entity_type_id}. Record not found or not selected.")
-                return "{}"
-
-            # 5. 尝试 'ai.reply' 相关变量
-            if var_path.startswith("ai.reply."):
-                ai_reply = self.context.ai.get("reply", {})
-                value = get_nested_value(ai_reply, var_path.split('.')[2:])
+            # 优先按首段分派：trigger, actor, db.customer, customer, custom_object, ai.reply
+            head, sep, rest = var_path.partition('.')
+            resolver = _TEXT_VAR_RESOLVERS.get(head) if sep else None
+            if resolver:
+                value = resolver(self, rest)
                 if value is not None:
-                    print(f"    - Resolved from ai.reply: {var_path} -> {value}")
+                    logger.debug("- Resolved from %s: %s -> %s", head, var_path, value)
                     return str(value)
 
-            # 6. 尝试 'customer' 相关变量（兼容格式）
-            if var_path.startswith("customer."):
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    field_name = var_path.replace("customer.", "")
-                    
-                    # 特殊处理一些常见的字段映射
-                    if field_name == "last_message":
-                        # 获取最后一条消息内容
-                        trigger_data = self.context.get("trigger_data", {})
-                        value = trigger_data.get("message")
-                        if value is not None:
-                            print(f"    - Resolved from customer.last_message (trigger): {var_path} -> {value}")
-                            return str(value)
-                        else:
-                            print(f"    - customer.last_message not found in trigger")
-                    elif hasattr(customer_obj, field_name):
-                        value = getattr(customer_obj, field_name)
-                        if value is not None:
-                            print(f"    - Resolved from customer: {var_path} -> {value}")
-                            return str(value)
-                    else:
-                        print(f"    - customer object has no field: {field_name}")
-                else:
-                    print(f"    - No customer object in context")
-
-            # 7. 尝试通用变量 (self.context.variables)
+            # 尝试通用变量 (self.context.variables)
             if var_path in self.context.variables:
                 value = self.context.variables[var_path]
-                print(f"    - Resolved from context.variables: {var_path} -> {value}")
+                logger.debug("- Resolved from context.variables: %s -> %s", var_path, value)
                 return str(value)
             
-            # 8. 尝试解析特定节点输出变量，例如 AI_NODE_ID.output.reply_text
-            parts = var_path.split('.')
+            # 尝试解析特定节点输出变量，例如 AI_NODE_ID.output.reply_text
+            parts = var_path.split('.', 2)
             if len(parts) >= 2:
                 node_id = parts[0]
                 output_key = parts[1]
                 # 检查是否是合法的节点输出路径，例如 AI_123.output
                 if output_key == "output" and node_id in self.context.variables:
                     node_output = self.context.variables[node_id]
-                    nested_path = parts[2:] # 进一步的嵌套路径，例如 reply_text
-                    value = get_nested_value(node_output, nested_path)
+                    # 进一步的嵌套路径，例如 reply_text
+                    value = _get_nested_value(node_output, parts[2]) if len(parts) > 2 else node_output
                     if value is not None:
-                        print(f"    - Resolved from node output: {var_path} -> {value}")
+                        logger.debug("- Resolved from node output: %s -> %s", var_path, value)
                         return str(value)
 
             # 如果所有尝试都失败，返回原始的变量占位符
-            print(f"    - Failed to resolve: {var_path}")
+            logger.debug("- Failed to resolve: %s", var_path)
             return match.group(0) # Return original {{variable}} or {variable} including braces
 
         # Handle both {{variable}} and {variable} patterns
         text = re.sub(r'''\{\{(.*?)\}\}''', replace_match, text)
-        text = re.sub(r'''\{([^{}]*)\}''', replace_match, text)
+        if '{' in text:
+            text = re.sub(r'''\{([^{}]*)\}''', replace_match, text)
         return text
 
 class TemplateProcessor(NodeProcessor):
     """模板消息节点 - 支持数据库变量查询"""
+
+    USES_DB = False
+    STATELESS = True
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """生成模板消息 - 支持多条消息和媒体"""
@@ -3437,7 +3639,7 @@ class SendTelegramMessageProcessor(NodeProcessor):
                     signed_url = await supabase_service.get_signed_url_for_file(relative_path)
                     if signed_url:
                         media_urls.append(signed_url)
-                        print(f"    📎 添加 Telegram 媒体文件: {media_file.filename}")
+                        logger.debug("📎 添加 Telegram 媒体文件: %s", media_file.filename)
             
             # 获取文件夹中的所有媒体文件
             if folder_names:
@@ -3453,7 +3655,7 @@ class SendTelegramMessageProcessor(NodeProcessor):
                         signed_url = await supabase_service.get_signed_url_for_file(relative_path)
                         if signed_url:
                             media_urls.append(signed_url)
-                            print(f"    📁 添加 Telegram 文件夹媒体: {folder_name}/{media_file.filename}")
+                            logger.debug("📁 添加 Telegram 文件夹媒体: %s/%s", folder_name, media_file.filename)
             
             return media_urls
             
@@ -3461,6 +3663,49 @@ class SendTelegramMessageProcessor(NodeProcessor):
             logger.error(f"Failed to get media URLs from identifiers for Telegram: {e}")
             return []
     
+    async def _send_media_concurrently(self, client: TelegramClient, entity: Any, media_urls: List[str], media_settings: Dict[str, Any]):
+        """
+        分开发送模式下并发上传媒体文件
+        
+        各媒体的上传互不依赖，用信号量限制并发数（media_settings.parallel_uploads，默认 4）。
+        如果配置了 delay_between_media，则保持逐个发送以保证间隔。
+        """
+        delay_between_media = media_settings.get("delay_between_media", False)
+        delay_seconds = media_settings.get("delay_seconds", 2)
+        parallel_uploads = 1 if delay_between_media else max(1, int(media_settings.get("parallel_uploads", 4)))
+        semaphore = asyncio.Semaphore(parallel_uploads)
+
+        async def send_one(i: int, media_url: str):
+            async with semaphore:
+                if delay_between_media and i > 0:
+                    logger.debug("⏱️ 延迟 %s 秒...", delay_seconds)
+                    await asyncio.sleep(delay_seconds)
+                logger.debug("🖼️ 发送媒体文件 %s/%s: %s", i+1, len(media_urls), media_url)
+                await client.send_message(entity=entity, message="", file=media_url)
+
+        await asyncio.gather(*(send_one(i, media_url) for i, media_url in enumerate(media_urls)))
+
+    async def _send_text_messages(self, client: TelegramClient, entity: Any, to: str, messages: List[str]):
+        """
+        流水线发送多条文本消息
+        
+        每条消息按会话节奏预约发送时间后即发出，不必等待上一条的网络往返；
+        任务按顺序创建并依次等待，预约时间单调递增，消息顺序保持不变。
+        """
+        async def send_one(i: int, message: str):
+            await _pace_telegram_send(to)
+            logger.debug("📝 发送文本消息 %s/%s: '%s'", i+1, len(messages), message)
+            await client.send_message(entity=entity, message=message)
+
+        tasks = [asyncio.create_task(send_one(i, message)) for i, message in enumerate(messages)]
+        try:
+            for task in tasks:
+                await task
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """发送 Telegram 消息"""
         node_data = node_config.get("data", {})
@@ -3471,38 +3716,38 @@ class SendTelegramMessageProcessor(NodeProcessor):
         bot_token = node_data.get("telegram_bot_token") # 从 node_data 获取 bot_token
         message_template = node_data.get("template") # 从 node_data 获取模板
         
-        print(f"📤 SendTelegram 節點開始執行:")
-        print(f"  初始配置 - send_mode: '{send_mode}', number_source: '{number_source}', message_template: '{message_template}'")
+        logger.debug("📤 SendTelegram 節點開始執行:")
+        logger.debug("初始配置 - send_mode: '%s', number_source: '%s', message_template: '%s'", send_mode, number_source, message_template)
         
         # 确定接收方 (to)
         if send_mode == "smart_reply":
             # 智能回复：使用触发器的 chat_id
             trigger_data = self.context.get("trigger_data", {})
             to = trigger_data.get("chat_id", "")
-            print(f"  智能回复 - 使用触发器 Chat ID: {to}")
+            logger.debug("智能回复 - 使用触发器 Chat ID: %s", to)
         elif send_mode == "force_telegram":
             # 强制发送到 Telegram
             if number_source == "custom_number":
                 to = node_data.get("telegram_chat_id", "")
-                print(f"  强制 Telegram - 自定义 Chat ID: {to}")
+                logger.debug("强制 Telegram - 自定义 Chat ID: %s", to)
             else:  # trigger_number
                 trigger_data = self.context.get("trigger_data", {})
                 to = trigger_data.get("chat_id", "")
-                print(f"  强制 Telegram - 触发器 Chat ID: {to}")
+                logger.debug("强制 Telegram - 触发器 Chat ID: %s", to)
         elif send_mode == "telegram_chat_id":
             # 兼容旧的配置方式
             to = node_data.get("telegram_chat_id", "")
-            print(f"  兼容模式 - 使用指定 Chat ID: {to}")
+            logger.debug("兼容模式 - 使用指定 Chat ID: %s", to)
         elif send_mode == "trigger_number":
             # 兼容旧的配置方式
             trigger_data = self.context.get("trigger_data", {})
             to = trigger_data.get("chat_id", trigger_data.get("phone", "")) # 优先使用 chat_id，其次 phone
-            print(f"  兼容模式 - 使用触发器 Chat ID/Phone: {to}")
+            logger.debug("兼容模式 - 使用触发器 Chat ID/Phone: %s", to)
         else:
             # 如果 send_mode 未知或为空，默认为智能回复
             trigger_data = self.context.get("trigger_data", {})
             to = trigger_data.get("chat_id", trigger_data.get("phone", ""))
-            print(f"  未知模式，默认使用触发器 (Chat ID/Phone): {to}")
+            logger.debug("未知模式，默认使用触发器 (Chat ID/Phone): %s", to)
 
         # 解析消息内容 - 支持多条消息
         messages_to_send = []
@@ -3511,13 +3756,13 @@ class SendTelegramMessageProcessor(NodeProcessor):
         if message_template:
             resolved_message = self._resolve_variable_from_context(message_template)
             messages_to_send.append(resolved_message)
-            print(f"  ✅ 使用节点模板消息: '{resolved_message}'")
+            logger.debug("✅ 使用节点模板消息: '%s'", resolved_message)
         
         # 如果节点模板为空，尝试从上下文中获取消息内容（模板处理器或其他处理器的输出）
         if not messages_to_send:
             # 调试：打印完整的上下文信息
-            print(f"  🔍 调试上下文信息:")
-            print(f"    - 完整上下文键: {list(self.context.variables.keys())}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔍 调试上下文信息: 完整上下文键 %s", list(self.context.variables.keys()))
             
             # 1. 优先从模板处理器输出获取多条消息 (message_templates)
             template_messages = self.context.variables.get("message_templates", [])
@@ -3525,51 +3770,51 @@ class SendTelegramMessageProcessor(NodeProcessor):
                 for msg_obj in template_messages:
                     if isinstance(msg_obj, dict) and msg_obj.get("content"):
                         messages_to_send.append(msg_obj["content"])
-                print(f"  ✅ 使用模板处理器多条消息输出: {len(messages_to_send)} 条消息")
+                logger.debug("✅ 使用模板处理器多条消息输出: %s 条消息", len(messages_to_send))
             
             # 2. 如果没有多条消息，尝试单条消息 (message_content)
             if not messages_to_send:
                 template_message = self.context.variables.get("message_content")
                 if template_message:
                     messages_to_send.append(template_message)
-                    print(f"  ✅ 使用模板处理器单条消息输出: '{template_message}'")
+                    logger.debug("✅ 使用模板处理器单条消息输出: '%s'", template_message)
             
             # 3. 如果没有模板输出，尝试从 AI 回复中获取
             if not messages_to_send:
                 ai_data = self.context.variables.get("ai")
-                print(f"    - ai 对象: {ai_data}")
-                print(f"    - ai 对象类型: {type(ai_data)}")
+                logger.debug("- ai 对象: %s", ai_data)
+                logger.debug("- ai 对象类型: %s", type(ai_data))
                 
                 if ai_data and isinstance(ai_data, dict):
                     reply_obj = ai_data.get("reply")
-                    print(f"    - ai.reply 对象: {reply_obj}")
-                    print(f"    - ai.reply 类型: {type(reply_obj)}")
+                    logger.debug("- ai.reply 对象: %s", reply_obj)
+                    logger.debug("- ai.reply 类型: %s", type(reply_obj))
                     
                     if reply_obj and isinstance(reply_obj, dict):
                         ai_message = reply_obj.get("reply_text")
                         if ai_message:
                             messages_to_send.append(ai_message)
-                            print(f"  ✅ 使用 AI 回复: '{ai_message}'")
+                            logger.debug("✅ 使用 AI 回复: '%s'", ai_message)
                 
                 # 备用方法：尝试直接从 context.ai 获取（如果 variables 复制失败）
                 if not messages_to_send and hasattr(self.context, 'ai'):
                     reply_obj = self.context.ai.get("reply", {})
-                    print(f"    - 备用：从 context.ai.reply 获取: {reply_obj}")
+                    logger.debug("- 备用：从 context.ai.reply 获取: %s", reply_obj)
                     if reply_obj and isinstance(reply_obj, dict):
                         ai_message = reply_obj.get("reply_text")
                         if ai_message:
                             messages_to_send.append(ai_message)
-                            print(f"  ✅ 备用方式使用 AI 回复: '{ai_message}'")
+                            logger.debug("✅ 备用方式使用 AI 回复: '%s'", ai_message)
             
             # 4. 最终fallback，使用默认消息
             if not messages_to_send:
                 default_message = self.context.get("chat.last_message", "Hi! We received your message.")
                 messages_to_send.append(default_message)
-                print(f"  ⚠️ 使用默认消息 (无其他消息源): '{default_message}'")
+                logger.debug("⚠️ 使用默认消息 (无其他消息源): '%s'", default_message)
 
-        print(f"  最终接收方 (to): '{to}'")
-        print(f"  最终消息数量: {len(messages_to_send)} 条")
-        print(f"  最终消息内容: {messages_to_send}")
+        logger.debug("最终接收方 (to): '%s'", to)
+        logger.debug("最终消息数量: %s 条", len(messages_to_send))
+        logger.debug("最终消息内容: %s", messages_to_send)
 
         if not to:
             raise ValueError("Recipient (chat_id) for Telegram message is empty.")
@@ -3595,7 +3840,7 @@ class SendTelegramMessageProcessor(NodeProcessor):
             template_media_uuids = [media.get("uuid") for media in template_media_list if media.get("uuid")]
             media_uuids.extend(template_media_uuids)
             media_settings.update(template_media_settings)
-            print(f"  📋 从模板处理器获取媒体 - 数量: {len(template_media_uuids)}")
+            logger.debug("📋 从模板处理器获取媒体 - 数量: %s", len(template_media_uuids))
         
         # 从 AI 回复中获取媒体文件和媒体设置
         ai_data = self.context.variables.get("ai")
@@ -3612,16 +3857,16 @@ class SendTelegramMessageProcessor(NodeProcessor):
                 media_settings.update(ai_media_settings)
                 
                 if ai_media_uuids or ai_folder_names:
-                    print(f"  🤖 从 AI 回复获取媒体 - UUIDs: {len(ai_media_uuids)}, 文件夹: {len(ai_folder_names)}")
+                    logger.debug("🤖 从 AI 回复获取媒体 - UUIDs: %s, 文件夹: %s", len(ai_media_uuids), len(ai_folder_names))
         
         media_urls = []
         if media_uuids or folder_names:
-            print(f"  📎 总媒体配置 - UUIDs: {len(media_uuids)}, 文件夹: {len(folder_names)}")
+            logger.debug("📎 总媒体配置 - UUIDs: %s, 文件夹: %s", len(media_uuids), len(folder_names))
             media_urls = await self._get_media_urls_from_identifiers(media_uuids, folder_names, user_id)
-            print(f"  📎 获取到 {len(media_urls)} 个媒体文件")
+            logger.debug("📎 获取到 %s 个媒体文件", len(media_urls))
 
-        print(f"  媒体文件数量: {len(media_urls)}")
-        print(f"  媒体设置: {media_settings}")
+        logger.debug("媒体文件数量: %s", len(media_urls))
+        logger.debug("媒体设置: %s", media_settings)
 
         if not messages_to_send and not media_urls:
             raise ValueError("Message content and media files for Telegram message are both empty.")
@@ -3636,7 +3881,7 @@ class SendTelegramMessageProcessor(NodeProcessor):
         # 检查是否提供了 bot_token
         if bot_token:
             # 如果提供了 bot_token，使用 Bot 模式发送
-            print(f"  使用 Telegram Bot 发送消息到 {to}")
+            logger.debug("使用 Telegram Bot 发送消息到 %s", to)
             try:
                 async with TelegramClient(StringSession(), api_id, api_hash) as bot_client:
                     # Bot 客户端也需要 connect
@@ -3648,11 +3893,11 @@ class SendTelegramMessageProcessor(NodeProcessor):
                         # 尝试将 chat_id 转换为整数
                         chat_id_int = int(to)
                         entity = chat_id_int  # 直接使用整数 chat_id
-                        print(f"  Bot 模式使用整数 chat_id: {entity}")
+                        logger.debug("Bot 模式使用整数 chat_id: %s", entity)
                     except ValueError:
                         # 如果不是数字，尝试作为用户名或实体获取
                         entity = await bot_client.get_entity(to)
-                        print(f"  Bot 模式通过 get_entity 获取实体: {entity}")
+                        logger.debug("Bot 模式通过 get_entity 获取实体: %s", entity)
                     
                     # 发送消息和媒体文件
                     if media_urls:
@@ -3665,270 +3910,191 @@ class SendTelegramMessageProcessor(NodeProcessor):
                         # 检查媒体发送模式
                         media_send_mode = media_settings.get("media_send_mode", "together_with_caption")
                         
-                        print(f"  📋 Telegram Bot 媒体发送配置:")
-                        print(f"    - 发送模式: {media_send_mode}")
-                        print(f"    - 分开发送: {send_separately}")
-                        print(f"    - 附带说明: {send_with_caption}")
-                        print(f"    - 延迟发送: {delay_between_media} ({delay_seconds}秒)")
+                        logger.debug("📋 Telegram Bot 媒体发送配置:")
+                        logger.debug("- 发送模式: %s", media_send_mode)
+                        logger.debug("- 分开发送: %s", send_separately)
+                        logger.debug("- 附带说明: %s", send_with_caption)
+                        logger.debug("- 延迟发送: %s (%s秒)", delay_between_media, delay_seconds)
                         
                         if media_send_mode == "separately" or send_separately:
                             # 分开发送：先发送媒体，再发送文本
-                            print(f"  🖼️ Telegram Bot 分开发送模式：先发送所有媒体文件")
+                            logger.debug("🖼️ Telegram Bot 分开发送模式：先发送所有媒体文件")
                             
-                            # 先发送每个媒体文件
-                            for i, media_url in enumerate(media_urls):
-                                if delay_between_media and i > 0:
-                                    print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
-                                    await asyncio.sleep(delay_seconds)
-                                
-                                print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
-                                await bot_client.send_message(entity=entity, message="", file=media_url)
+                            # 先并发发送所有媒体文件
+                            await self._send_media_concurrently(bot_client, entity, media_urls, media_settings)
                             
                             # 所有媒体发送完成后，再发送文本消息
                             if messages_to_send:
-                                print(f"  📝 媒体发送完成，现在发送 {len(messages_to_send)} 条文本消息")
-                                for i, message in enumerate(messages_to_send):
-                                    if i > 0:
-                                        await asyncio.sleep(1)  # 消息间延迟1秒
-                                    print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                    await bot_client.send_message(entity=entity, message=message)
+                                logger.debug("📝 媒体发送完成，现在发送 %s 条文本消息", len(messages_to_send))
+                                await self._send_text_messages(bot_client, entity, to, messages_to_send)
                                 
                         elif media_send_mode == "together_with_caption":
                             # 一起发送模式：媒体附带文本说明
                             if len(media_urls) == 1 and messages_to_send and send_with_caption:
                                 # 单个媒体文件，带第一条文本
                                 first_message = messages_to_send[0]
-                                print(f"  📤 发送带文本的单个媒体文件: '{first_message}'")
+                                logger.debug("📤 发送带文本的单个媒体文件: '%s'", first_message)
+                                await _pace_telegram_send(to)
                                 await bot_client.send_message(entity=entity, message=first_message, file=media_urls[0])
                                 
                                 # 发送剩余的文本消息
-                                for i, message in enumerate(messages_to_send[1:], 1):
-                                    await asyncio.sleep(1)  # 消息间延迟1秒
-                                    print(f"  📝 发送剩余文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                    await bot_client.send_message(entity=entity, message=message)
+                                await self._send_text_messages(bot_client, entity, to, messages_to_send[1:])
                             else:
                                 # 多个媒体文件：第一个带文本，其余单独发送
                                 for i, media_url in enumerate(media_urls):
                                     if delay_between_media and i > 0:
-                                        print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
+                                        logger.debug("⏱️ 延迟 %s 秒...", delay_seconds)
                                         await asyncio.sleep(delay_seconds)
                                     
                                     if i == 0 and messages_to_send and send_with_caption:
                                         # 第一个媒体文件带第一条文本
                                         first_message = messages_to_send[0]
-                                        print(f"  🖼️📝 发送带文本的媒体文件 {i+1}/{len(media_urls)}: '{first_message}'")
+                                        logger.debug("🖼️📝 发送带文本的媒体文件 %s/%s: '%s'", i+1, len(media_urls), first_message)
+                                        await _pace_telegram_send(to)
                                         await bot_client.send_message(entity=entity, message=first_message, file=media_url)
                                     else:
                                         # 其余媒体文件单独发送
-                                        print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
+                                        logger.debug("🖼️ 发送媒体文件 %s/%s: %s", i+1, len(media_urls), media_url)
                                         await bot_client.send_message(entity=entity, message="", file=media_url)
                                 
                                 # 发送剩余的文本消息（如果有多条消息）
                                 if len(messages_to_send) > 1:
-                                    print(f"  📝 发送剩余的 {len(messages_to_send)-1} 条文本消息")
-                                    for i, message in enumerate(messages_to_send[1:], 1):
-                                        await asyncio.sleep(1)  # 消息间延迟1秒
-                                        print(f"  📝 发送剩余文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                        await bot_client.send_message(entity=entity, message=message)
+                                    logger.debug("📝 发送剩余的 %s 条文本消息", len(messages_to_send)-1)
+                                    await self._send_text_messages(bot_client, entity, to, messages_to_send[1:])
                         else:  # media_only 或其他模式
                             # 只发送媒体文件
-                            print(f"  🖼️ 只发送媒体文件模式")
+                            logger.debug("🖼️ 只发送媒体文件模式")
                             for i, media_url in enumerate(media_urls):
                                 if delay_between_media and i > 0:
-                                    print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
+                                    logger.debug("⏱️ 延迟 %s 秒...", delay_seconds)
                                     await asyncio.sleep(delay_seconds)
                                 
-                                print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
+                                logger.debug("🖼️ 发送媒体文件 %s/%s: %s", i+1, len(media_urls), media_url)
                                 await bot_client.send_message(entity=entity, message="", file=media_url)
                             
                             # 如果是 media_only 模式但仍有文本，单独发送文本
                             if messages_to_send and media_send_mode != "media_only":
-                                print(f"  📝 发送 {len(messages_to_send)} 条文本消息")
-                                for i, message in enumerate(messages_to_send):
-                                    if i > 0:
-                                        await asyncio.sleep(1)  # 消息间延迟1秒
-                                    print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                    await bot_client.send_message(entity=entity, message=message)
+                                logger.debug("📝 发送 %s 条文本消息", len(messages_to_send))
+                                await self._send_text_messages(bot_client, entity, to, messages_to_send)
                     else:
                         # 只发送文本消息
-                        print(f"  📝 只发送 {len(messages_to_send)} 条文本消息")
-                        for i, message in enumerate(messages_to_send):
-                            if i > 0:
-                                await asyncio.sleep(1)  # 消息间延迟1秒
-                            print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                            await bot_client.send_message(entity=entity, message=message)
+                        logger.debug("📝 只发送 %s 条文本消息", len(messages_to_send))
+                        await self._send_text_messages(bot_client, entity, to, messages_to_send)
                     
-                    print(f"✅ Telegram Bot 消息发送成功到 {to}")
+                    logger.debug("✅ Telegram Bot 消息发送成功到 %s", to)
             except Exception as e:
                 logger.error(f"❌ Telegram Bot 消息发送失败到 {to}: {e}")
                 raise
         else:
             # 否则，使用用户会话模式发送
-            # 获取用户的 string_session 或 session_file_b64
-            string_sess = settings_service.get_setting_for_user('telegram_string_session', user_id)
-            session_file_b64 = settings_service.get_setting_for_user('telegram_session_file', user_id)
-
-            session_param: Any = None
-            temp_session_file_path: Optional[str] = None
-
-            if string_sess:
-                session_param = StringSession(string_sess)
-                print(f"  使用 StringSession 发送消息...")
-            elif session_file_b64:
-                try:
-                    # 更健壮的 base64 解码
-                    cleaned_session_file = session_file_b64.strip().replace(' ', '')
-                    padding_needed = -len(cleaned_session_file) % 4
-                    if padding_needed != 0: # 仅在需要时添加填充
-                        cleaned_session_file += '=' * padding_needed
-
-                    data = base64.b64decode(cleaned_session_file, validate=True)
-                    temp_session_file = tempfile.NamedTemporaryFile(delete=False, suffix=".session")
-                    temp_session_file.write(data)
-                    temp_session_file.close()
-                    temp_session_file_path = temp_session_file.name
-                    session_param = temp_session_file_path
-                    print(f"  使用临时 session 文件 '{temp_session_file_path}' 发送消息...")
-                except Exception as e:
-                    logger.error(f"❌ 解码或写入临时会话文件失败: {e}")
-                    # 如果会话文件损坏，清除它
-                    settings_service.delete_setting_for_user('telegram_session_file', user_id)
-                    raise HTTPException(status_code=500, detail="Invalid Telegram session file, please re-login.")
-
-            if not session_param:
-                raise HTTPException(status_code=400, detail="Telegram session not found. Please log in to Telegram.")
-
-            client: Optional[TelegramClient] = None
             try:
-                client = TelegramClient(session_param, api_id, api_hash)
-                await _ensure_client_connect(client)
-                
-                # 获取目标实体 - 处理 chat_id 转换
-                try:
-                    # 尝试将 chat_id 转换为整数
-                    chat_id_int = int(to)
-                    entity = chat_id_int  # 直接使用整数 chat_id
-                    print(f"  使用整数 chat_id: {entity}")
-                except ValueError:
-                    # 如果不是数字，尝试作为用户名或实体获取
-                    entity = await client.get_entity(to)
-                    print(f"  通过 get_entity 获取实体: {entity}")
-
-                # 发送消息和媒体文件
-                if media_urls:
-                    # 获取媒体发送配置
-                    send_separately = media_settings.get("send_media_separately", False)
-                    send_with_caption = media_settings.get("send_with_caption", True)
-                    delay_between_media = media_settings.get("delay_between_media", False)
-                    delay_seconds = media_settings.get("delay_seconds", 2)
+                # 复用该用户的长连接客户端；会话未变时不重新读取会话、不重新建立连接
+                fingerprint = _telegram_session_fingerprint(self.db, user_id)
+                async with _user_telegram_client(
+                    user_id,
+                    fingerprint,
+                    lambda: self._build_user_session(settings_service, user_id),
+                    api_id,
+                    api_hash,
+                ) as client:
+                    # 获取目标实体 - 处理 chat_id 转换
+                    try:
+                        # 尝试将 chat_id 转换为整数
+                        chat_id_int = int(to)
+                        entity = chat_id_int  # 直接使用整数 chat_id
+                        logger.debug("使用整数 chat_id: %s", entity)
+                    except ValueError:
+                        # 如果不是数字，尝试作为用户名或实体获取
+                        entity = await client.get_entity(to)
+                        logger.debug("通过 get_entity 获取实体: %s", entity)
+
+                    # 发送消息和媒体文件
+                    if media_urls:
+                        # 获取媒体发送配置
+                        send_separately = media_settings.get("send_media_separately", False)
+                        send_with_caption = media_settings.get("send_with_caption", True)
+                        delay_between_media = media_settings.get("delay_between_media", False)
+                        delay_seconds = media_settings.get("delay_seconds", 2)
                     
-                    # 检查媒体发送模式
-                    media_send_mode = media_settings.get("media_send_mode", "together_with_caption")
+                        # 检查媒体发送模式
+                        media_send_mode = media_settings.get("media_send_mode", "together_with_caption")
                     
-                    print(f"  📋 Telegram 用户会话媒体发送配置:")
-                    print(f"    - 发送模式: {media_send_mode}")
-                    print(f"    - 分开发送: {send_separately}")
-                    print(f"    - 附带说明: {send_with_caption}")
-                    print(f"    - 延迟发送: {delay_between_media} ({delay_seconds}秒)")
+                        logger.debug("📋 Telegram 用户会话媒体发送配置:")
+                        logger.debug("- 发送模式: %s", media_send_mode)
+                        logger.debug("- 分开发送: %s", send_separately)
+                        logger.debug("- 附带说明: %s", send_with_caption)
+                        logger.debug("- 延迟发送: %s (%s秒)", delay_between_media, delay_seconds)
                     
-                    if media_send_mode == "separately" or send_separately:
-                        # 分开发送：先发送媒体，再发送文本
-                        print(f"  🖼️ Telegram 用户会话分开发送模式：先发送所有媒体文件")
+                        if media_send_mode == "separately" or send_separately:
+                            # 分开发送：先发送媒体，再发送文本
+                            logger.debug("🖼️ Telegram 用户会话分开发送模式：先发送所有媒体文件")
                         
-                        # 先发送每个媒体文件
-                        for i, media_url in enumerate(media_urls):
-                            if delay_between_media and i > 0:
-                                print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
-                                await asyncio.sleep(delay_seconds)
-                            
-                            print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
-                            await client.send_message(entity=entity, message="", file=media_url)
+                            # 先并发发送所有媒体文件
+                            await self._send_media_concurrently(client, entity, media_urls, media_settings)
                         
-                        # 所有媒体发送完成后，再发送文本消息
-                        if messages_to_send:
-                            print(f"  📝 媒体发送完成，现在发送 {len(messages_to_send)} 条文本消息")
-                            for i, message in enumerate(messages_to_send):
-                                if i > 0:
-                                    await asyncio.sleep(1)  # 消息间延迟1秒
-                                print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                await client.send_message(entity=entity, message=message)
+                            # 所有媒体发送完成后，再发送文本消息
+                            if messages_to_send:
+                                logger.debug("📝 媒体发送完成，现在发送 %s 条文本消息", len(messages_to_send))
+                                await self._send_text_messages(client, entity, to, messages_to_send)
                             
-                    elif media_send_mode == "together_with_caption":
-                        # 一起发送模式：媒体附带文本说明
-                        if len(media_urls) == 1 and messages_to_send and send_with_caption:
-                            # 单个媒体文件，带第一条文本
-                            first_message = messages_to_send[0]
-                            print(f"  📤 发送带文本的单个媒体文件: '{first_message}'")
-                            await client.send_message(entity=entity, message=first_message, file=media_urls[0])
+                        elif media_send_mode == "together_with_caption":
+                            # 一起发送模式：媒体附带文本说明
+                            if len(media_urls) == 1 and messages_to_send and send_with_caption:
+                                # 单个媒体文件，带第一条文本
+                                first_message = messages_to_send[0]
+                                logger.debug("📤 发送带文本的单个媒体文件: '%s'", first_message)
+                                await _pace_telegram_send(to)
+                                await client.send_message(entity=entity, message=first_message, file=media_urls[0])
                             
-                            # 发送剩余的文本消息
-                            for i, message in enumerate(messages_to_send[1:], 1):
-                                await asyncio.sleep(1)  # 消息间延迟1秒
-                                print(f"  📝 发送剩余文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                await client.send_message(entity=entity, message=message)
-                        else:
-                            # 多个媒体文件：第一个带文本，其余单独发送
-                            for i, media_url in enumerate(media_urls):
-                                if delay_between_media and i > 0:
-                                    print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
-                                    await asyncio.sleep(delay_seconds)
+                                # 发送剩余的文本消息
+                                await self._send_text_messages(client, entity, to, messages_to_send[1:])
+                            else:
+                                # 多个媒体文件：第一个带文本，其余单独发送
+                                for i, media_url in enumerate(media_urls):
+                                    if delay_between_media and i > 0:
+                                        logger.debug("⏱️ 延迟 %s 秒...", delay_seconds)
+                                        await asyncio.sleep(delay_seconds)
                                 
-                                if i == 0 and messages_to_send and send_with_caption:
-                                    # 第一个媒体文件带第一条文本
-                                    first_message = messages_to_send[0]
-                                    print(f"  🖼️📝 发送带文本的媒体文件 {i+1}/{len(media_urls)}: '{first_message}'")
-                                    await client.send_message(entity=entity, message=first_message, file=media_url)
-                                else:
-                                    # 其余媒体文件单独发送
-                                    print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
-                                    await client.send_message(entity=entity, message="", file=media_url)
+                                    if i == 0 and messages_to_send and send_with_caption:
+                                        # 第一个媒体文件带第一条文本
+                                        first_message = messages_to_send[0]
+                                        logger.debug("🖼️📝 发送带文本的媒体文件 %s/%s: '%s'", i+1, len(media_urls), first_message)
+                                        await _pace_telegram_send(to)
+                                        await client.send_message(entity=entity, message=first_message, file=media_url)
+                                    else:
+                                        # 其余媒体文件单独发送
+                                        logger.debug("🖼️ 发送媒体文件 %s/%s: %s", i+1, len(media_urls), media_url)
+                                        await client.send_message(entity=entity, message="", file=media_url)
                             
-                            # 发送剩余的文本消息（如果有多条消息）
-                            if len(messages_to_send) > 1:
-                                print(f"  📝 发送剩余的 {len(messages_to_send)-1} 条文本消息")
-                                for i, message in enumerate(messages_to_send[1:], 1):
-                                    await asyncio.sleep(1)  # 消息间延迟1秒
-                                    print(f"  📝 发送剩余文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                    await client.send_message(entity=entity, message=message)
+                                # 发送剩余的文本消息（如果有多条消息）
+                                if len(messages_to_send) > 1:
+                                    logger.debug("📝 发送剩余的 %s 条文本消息", len(messages_to_send)-1)
+                                    await self._send_text_messages(client, entity, to, messages_to_send[1:])
                                     
-                    else:  # media_only 或其他模式
-                        # 只发送媒体文件
-                        print(f"  🖼️ 只发送媒体文件模式")
-                        for i, media_url in enumerate(media_urls):
-                            if delay_between_media and i > 0:
-                                print(f"  ⏱️ 延迟 {delay_seconds} 秒...")
-                                await asyncio.sleep(delay_seconds)
+                        else:  # media_only 或其他模式
+                            # 只发送媒体文件
+                            logger.debug("🖼️ 只发送媒体文件模式")
+                            for i, media_url in enumerate(media_urls):
+                                if delay_between_media and i > 0:
+                                    logger.debug("⏱️ 延迟 %s 秒...", delay_seconds)
+                                    await asyncio.sleep(delay_seconds)
                             
-                            print(f"  🖼️ 发送媒体文件 {i+1}/{len(media_urls)}: {media_url}")
-                            await client.send_message(entity=entity, message="", file=media_url)
+                                logger.debug("🖼️ 发送媒体文件 %s/%s: %s", i+1, len(media_urls), media_url)
+                                await client.send_message(entity=entity, message="", file=media_url)
                         
-                        # 如果是 media_only 模式但仍有文本，单独发送文本
-                        if messages_to_send and media_send_mode != "media_only":
-                            print(f"  📝 发送 {len(messages_to_send)} 条文本消息")
-                            for i, message in enumerate(messages_to_send):
-                                if i > 0:
-                                    await asyncio.sleep(1)  # 消息间延迟1秒
-                                print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                                await client.send_message(entity=entity, message=message)
-                else:
-                    # 只发送文本消息
-                    print(f"  📝 只发送 {len(messages_to_send)} 条文本消息")
-                    for i, message in enumerate(messages_to_send):
-                        if i > 0:
-                            await asyncio.sleep(1)  # 消息间延迟1秒
-                        print(f"  📝 发送文本消息 {i+1}/{len(messages_to_send)}: '{message}'")
-                        await client.send_message(entity=entity, message=message)
+                            # 如果是 media_only 模式但仍有文本，单独发送文本
+                            if messages_to_send and media_send_mode != "media_only":
+                                logger.debug("📝 发送 %s 条文本消息", len(messages_to_send))
+                                await self._send_text_messages(client, entity, to, messages_to_send)
+                    else:
+                        # 只发送文本消息
+                        logger.debug("📝 只发送 %s 条文本消息", len(messages_to_send))
+                        await self._send_text_messages(client, entity, to, messages_to_send)
                 
-                print(f"✅ Telegram 用户会话消息发送成功到 {to}")
+                    logger.debug("✅ Telegram 用户会话消息发送成功到 %s", to)
             except Exception as e:
                 logger.error(f"❌ Telegram 用户会话消息发送失败到 {to}: {e}", exc_info=True)
                 raise
-            finally:
-                if client and client.is_connected():
-                    await client.disconnect()
-                if temp_session_file_path and os.path.exists(temp_session_file_path):
-                    os.remove(temp_session_file_path)
-                    print(f"  清理临时会话文件: {temp_session_file_path}")
 
         return {
             "status": "success",
@@ -3938,159 +4104,127 @@ class SendTelegramMessageProcessor(NodeProcessor):
             "message_count": len(messages_to_send)
         }
 
+    def _build_user_session(self, settings_service, user_id: int) -> Any:
+        """读取用户的 Telegram 会话，返回 StringSession 或 session 文件的二进制内容"""
+        # 获取用户的 string_session 或 session_file_b64
+        string_sess = settings_service.get_setting_for_user('telegram_string_session', user_id)
+        session_file_b64 = settings_service.get_setting_for_user('telegram_session_file', user_id)
+
+        session_param: Any = None
+
+        if string_sess:
+            session_param = StringSession(string_sess)
+            logger.debug("使用 StringSession 发送消息...")
+        elif session_file_b64:
+            try:
+                # 更健壮的 base64 解码
+                cleaned_session_file = session_file_b64.strip().replace(' ', '')
+                padding_needed = -len(cleaned_session_file) % 4
+                if padding_needed != 0: # 仅在需要时添加填充
+                    cleaned_session_file += '=' * padding_needed
+
+                # 返回解码后的内容，由调用方在线程池中写入临时 session 文件
+                session_param = base64.b64decode(cleaned_session_file, validate=True)
+                logger.debug("使用 session 文件 (%s 字节) 发送消息...", len(session_param))
+            except Exception as e:
+                logger.error(f"❌ 解码或写入临时会话文件失败: {e}")
+                # 如果会话文件损坏，清除它
+                settings_service.delete_setting_for_user('telegram_session_file', user_id)
+                raise HTTPException(status_code=500, detail="Invalid Telegram session file, please re-login.")
+
+        if not session_param:
+            raise HTTPException(status_code=400, detail="Telegram session not found. Please log in to Telegram.")
+
+        return session_param
+
     def _resolve_variable_from_context(self, text: str) -> str:
         """解析文本中的所有 {{variable_path}} 和 {variable_path} 变量"""
         if not isinstance(text, str): # Ensure text is a string
             return str(text)
-
-        def get_nested_value(data, path_parts):
-            current = data
-            for part in path_parts:
-                if isinstance(current, dict) and part in current:
-                    current = current[part]
-                elif isinstance(current, object) and hasattr(current, part):
-                    current = getattr(current, part)
-                else:
-                    return None
-            return current
+        if '{' not in text: # 纯文本无占位符，跳过正则替换
+            return text
 
         def replace_match(match):
             var_path = match.group(1).strip() # Extract path inside {{}} or {}
-            print(f"  🔍 Resolving variable path: {var_path}") # Debug print
+            logger.debug("🔍 Resolving variable path: %s", var_path)
 
-            # 尝试从各种上下文中解析变量
-            # 优先级：trigger_data, actor, db.customer, ai.reply, 通用变量, 其他节点输出
-
-            # 1. 优先尝试 'trigger' 相关变量
-            if var_path.startswith("trigger."):
-                trigger_data = self.context.get("trigger_data", {})
-                value = get_nested_value(trigger_data, var_path.split('.')[1:])
+            # 优先按首段分派：trigger, actor, db.customer, customer, custom_object, ai.reply
+            head, sep, rest = var_path.partition('.')
+            resolver = _TEXT_VAR_RESOLVERS.get(head) if sep else None
+            if resolver:
+                value = resolver(self, rest)
                 if value is not None:
-                    print(f"    - Resolved from trigger: {var_path} -> {value}")
-                    return str(value)
-                else:
-                    print(f"       ❌ trigger 中未找到: {var_path}")
-            
-            # 2. 尝试 'actor' 相关变量
-            if var_path.startswith("actor."):
-                actor_data = self.context.get("actor", {})
-                value = get_nested_value(actor_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"    - Resolved from actor: {var_path} -> {value}")
-                    return str(value)
-
-            # 3. 尝试 'db.customer' 相关变量或 'customer.all'
-            if var_path.startswith("db.customer."):
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    value = get_nested_value(customer_obj, var_path.split('.')[2:])
-                    if value is not None:
-                        print(f"    - Resolved from db.customer: {var_path} -> {value}")
-                        return str(value)
-            elif var_path == "customer.all":
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    # 将整个客户对象（包括 custom_fields）转换为 JSON 字符串
-                    customer_data = customer_obj.__dict__.copy()
-                    customer_data.pop('_sa_instance_state', None)
-                    
-                    # 如果 custom_fields 是字符串，尝试解析为字典
-                    if isinstance(customer_data.get('custom_fields'), str):
-                        try:
-                            customer_data['custom_fields'] = json.loads(customer_data['custom_fields'])
-                        except json.JSONDecodeError:
-                            pass # 保持原样，如果不是有效 JSON
-
-                    return json.dumps(customer_data, ensure_ascii=False, indent=2)
-                return "{}"
-
-            # 4. 尝试 'custom_object' 相关变量
-            custom_object_match_field = re.match(r"custom_object\.(\d+)\.(\d+)\.([a-zA-Z0-9_.]+)", var_path)
-            custom_object_match_all = re.match(r"custom_object\.(\d+)\.all", var_path)
-
-            if custom_object_match_field:
-                entity_type_id = int(custom_object_match_field.group(1))
-                record_id = int(custom_object_match_field.group(2))
-                field_key = custom_object_match_field.group(3)
-                
-                record_obj = self.db.query(CustomEntityRecord).filter(
-                    CustomEntityRecord.entity_type_id == entity_type_id,
-                    CustomEntityRecord.id == record_id
-                ).first()
-
-                if record_obj and record_obj.data and field_key in record_obj.data:
-                    value = get_nested_value(record_obj.data, field_key.split('.'))
-                    if value is not None:
-                        print(f"    - Resolved from custom_object field: {var_path} -> {value}")
-                        return str(value)
-            elif custom_object_match_all:
-                entity_type_id = int(custom_object_match_all.group(1))
-                # 从上下文中获取选中的记录ID，如果存在的话
-                selected_record_id = self.context.get(f"selectedCustomEntityRecordId_{entity_type_id}")
-                
-                if selected_record_id:
-                    record_obj = self.db.query(CustomEntityRecord).filter(
-                        CustomEntityRecord.entity_type_id == entity_type_id,
-                        CustomEntityRecord.id == selected_record_id
-                    ).first()
-                    if record_obj:
-                        record_data = record_obj.data.copy() if record_obj.data else {}
-                        print(f"    - Resolved from custom_object all: {var_path} -> {record_data}")
-                        return json.dumps(record_data, ensure_ascii=False, indent=2)
-                print(f"    - Failed to resolve custom_object.all for entity type {entity_type_id}. Record not found or not selected.")
-                return "{}"
-
-            # 5. 尝试 'ai.reply' 相关变量
-            if var_path.startswith("ai.reply."):
-                ai_reply = self.context.ai.get("reply", {})
-                value = get_nested_value(ai_reply, var_path.split('.')[2:])
-                if value is not None:
-                    print(f"    - Resolved from ai.reply: {var_path} -> {value}")
+                    logger.debug("- Resolved from %s: %s -> %s", head, var_path, value)
                     return str(value)
 
-            # 6. 尝试 'customer' 相关变量（兼容格式）
-            if var_path.startswith("customer."):
-                customer_obj = self.context.db.get("customer", None)
-                if customer_obj:
-                    field_name = var_path.replace("customer.", "")
-                    
-                    # 特殊处理一些常见的字段映射
-                    if field_name == "last_message":
-                        # 获取最后一条消息内容
-                        trigger_data = self.context.get("trigger_data", {})
-                        value = trigger_data.get("message")
-                        if value is not None:
-                            print(f"    - Resolved from customer.last_message (trigger): {var_path} -> {value}")
-                            return str(value)
-                        else:
-                            print(f"    - customer.last_message not found in trigger")
-                    elif hasattr(customer_obj, field_name):
-                        value = getattr(customer_obj, field_name)
-                        if value is not None:
-                            print(f"    - Resolved from customer: {var_path} -> {value}")
-                            return str(value)
-                    else:
-                        print(f"    - customer object has no field: {field_name}")
-                else:
-                    print(f"    - No customer object in context")
-
-            # 7. 尝试通用变量 (self.context.variables)
+            # 尝试通用变量 (self.context.variables)
             if var_path in self.context.variables:
                 value = self.context.variables[var_path]
-                print(f"    - Resolved from context.variables: {var_path} -> {value}")
+                logger.debug("- Resolved from context.variables: %s -> %s", var_path, value)
                 return str(value)
             
             # 如果所有尝试都失败，返回原始的变量占位符
-            print(f"    - Failed to resolve: {var_path}")
+            logger.debug("- Failed to resolve: %s", var_path)
             return match.group(0) # Return original {{variable}} or {variable} including braces
 
         # Handle both {{variable}} and {variable} patterns
         text = re.sub(r'''\{\{(.*?)\}\}''', replace_match, text)
-        text = re.sub(r'''\{([^{}]*)\}''', replace_match, text)
+        if '{' in text:
+            text = re.sub(r'''\{([^{}]*)\}''', replace_match, text)
         return text
 
+@lru_cache(maxsize=128)
+def _build_keyword_automaton(keywords: tuple):
+    """为一组（已小写的）屏蔽词构建 Aho-Corasick 自动机，按词表缓存"""
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+def _contains_blocked_keyword(text_lower: str, keywords: tuple) -> bool:
+    """检查文本中是否包含任一屏蔽词；未安装 pyahocorasick 时退回逐词扫描"""
+    if ahocorasick is None or "" in keywords:
+        return any(keyword in text_lower for keyword in keywords)
+    for _ in _build_keyword_automaton(keywords).iter(text_lower):
+        return True
+    return False
+
+@lru_cache(maxsize=128)
+def _build_url_whitelist(entries: tuple):
+    """将白名单拆分为域名集合（按主机名哈希匹配）和含路径/端口的条目（按子串匹配）"""
+    hosts = set()
+    patterns = []
+    for entry in entries:
+        entry = str(entry).strip().lower()
+        if entry and '/' not in entry and ':' not in entry:
+            hosts.add(entry)
+        else:
+            patterns.append(entry)
+    return frozenset(hosts), tuple(patterns)
+
+def _is_url_allowed(url: str, hosts: frozenset, patterns: tuple) -> bool:
+    """主机名或其任一上级域名在白名单中即放行"""
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        host = ''
+    while host:
+        if host in hosts:
+            return True
+        host = host.partition('.')[2]
+    if patterns:
+        url_lower = url.lower()
+        return any(pattern in url_lower for pattern in patterns)
+    return False
+
+_GUARDRAIL_URL_RE = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
 class GuardrailValidatorProcessor(NodeProcessor):
     """合规检查节点"""
+
+    USES_DB = False
+    STATELESS = True
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """执行合规检查"""
@@ -4102,17 +4236,17 @@ class GuardrailValidatorProcessor(NodeProcessor):
         ai_reply = self.context.get("ai.reply", {})
         reply_text = ai_reply.get("reply_text", "")
         
-        # 关键词检查
-        for keyword in blocked_keywords:
-            if keyword.lower() in reply_text.lower():
+        # 关键词检查（回复文本只转换一次小写）
+        if blocked_keywords:
+            keywords = tuple(keyword.lower() for keyword in blocked_keywords)
+            if _contains_blocked_keyword(reply_text.lower(), keywords):
                 return {"pass_or_fail_branch": "fail"}
         
-        # URL 检查（如果有的话）
-        import re
-        urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', reply_text)
-        if urls and url_whitelist:
-            for url in urls:
-                if not any(allowed in url for allowed in url_whitelist):
+        # URL 检查（仅在配置了白名单时扫描）
+        if url_whitelist:
+            hosts, patterns = _build_url_whitelist(tuple(url_whitelist))
+            for url in _GUARDRAIL_URL_RE.findall(reply_text):
+                if not _is_url_allowed(url, hosts, patterns):
                     return {"pass_or_fail_branch": "fail"}
         
         return {"pass_or_fail_branch": "pass"}
@@ -4136,59 +4270,269 @@ def _get_var_value_from_context(context: WorkflowContext, var_path: str):
         return None
 
 
+def _compile_jsonlogic_operand(arg):
+    """将 JSONLogic 操作数编译为取值函数：{"var": key} 取上下文变量，其余视为字面量"""
+    if isinstance(arg, dict) and 'var' in arg:
+        return _compile_jl_var(arg['var'])
+    return lambda ctx: arg
+
+
+def _compile_jl_eq(args):
+    a, b = args
+    get_a, get_b = _compile_jsonlogic_operand(a), _compile_jsonlogic_operand(b)
+    return lambda ctx: get_a(ctx) == get_b(ctx)
+
+
+def _compile_jl_ne(args):
+    a, b = args
+    get_a, get_b = _compile_jsonlogic_operand(a), _compile_jsonlogic_operand(b)
+    return lambda ctx: get_a(ctx) != get_b(ctx)
+
+
+def _compile_jl_and(args):
+    parts = tuple(compile_jsonlogic(e) for e in args)
+
+    def evaluate(ctx):
+        for part in parts:
+            if not part(ctx):
+                return False
+        return True
+    return evaluate
+
+
+def _compile_jl_or(args):
+    parts = tuple(compile_jsonlogic(e) for e in args)
+
+    def evaluate(ctx):
+        for part in parts:
+            if part(ctx):
+                return True
+        return False
+    return evaluate
+
+
+def _compile_jl_var(args):
+    key = sys.intern(args) if isinstance(args, str) else args
+    return lambda ctx: ctx.get(key)
+
+
+# 按表达式唯一的操作符键分派，一次字典查找代替逐个 `in` 判断
+_JL_COMPILERS = {
+    '==': _compile_jl_eq,
+    '!=': _compile_jl_ne,
+    'and': _compile_jl_and,
+    'or': _compile_jl_or,
+    'var': _compile_jl_var,
+}
+
+
+def compile_jsonlogic(expression) -> Callable[[dict], Any]:
+    """将 JSONLogic 表达式（最小子集）编译为闭包，求值时不再遍历表达式字典"""
+    if not isinstance(expression, dict):
+        result = bool(expression)
+        return lambda ctx: result
+    op = next(iter(expression), None)
+    compiler = _JL_COMPILERS.get(op)
+    if compiler is None:
+        return lambda ctx: False
+    return compiler(expression[op])
+
+
+@lru_cache(maxsize=256)
+def _compile_jsonlogic_source(source: str) -> Callable[[dict], Any]:
+    """按 JSON 文本缓存编译结果，同一节点的表达式只编译一次"""
+    return compile_jsonlogic(json.loads(source))
+
+
+# 按节点 ID 缓存 (原始表达式, 编译结果)；表达式与上次相同（==）时直接复用，无需重新序列化
+_JSONLOGIC_NODE_CACHE: Dict[Any, tuple] = {}
+
+
+def _get_compiled_jsonlogic(node_id, expr_raw) -> Callable[[dict], Any]:
+    """获取节点 JSONLogic 表达式的编译结果"""
+    cached = _JSONLOGIC_NODE_CACHE.get(node_id) if node_id is not None else None
+    if cached is not None and cached[0] == expr_raw:
+        return cached[1]
+    if isinstance(expr_raw, str):
+        compiled = _compile_jsonlogic_source(expr_raw)
+    else:
+        compiled = _compile_jsonlogic_source(json.dumps(expr_raw or {}, sort_keys=True))
+    if node_id is not None:
+        _JSONLOGIC_NODE_CACHE[node_id] = (expr_raw, compiled)
+    return compiled
+
+
 def evaluate_jsonlogic(expression: dict, context_vars: dict) -> bool:
     # minimal jsonlogic subset
-    if not isinstance(expression, dict):
-        return bool(expression)
-    if '==' in expression:
-        a, b = expression['==']
-        if isinstance(a, dict) and 'var' in a:
-            a = context_vars.get(a['var'])
-        if isinstance(b, dict) and 'var' in b:
-            b = context_vars.get(b['var'])
-        return a == b
-    if '!=' in expression:
-        a, b = expression['!=']
-        if isinstance(a, dict) and 'var' in a:
-            a = context_vars.get(a['var'])
-        if isinstance(b, dict) and 'var' in b:
-            b = context_vars.get(b['var'])
-        return a != b
-    if 'and' in expression:
-        return all(evaluate_jsonlogic(e, context_vars) for e in expression['and'])
-    if 'or' in expression:
-        return any(evaluate_jsonlogic(e, context_vars) for e in expression['or'])
-    if 'var' in expression:
-        return context_vars.get(expression['var'])
-    return False
+    return compile_jsonlogic(expression)(context_vars)
+
+
+def _compile_date_diff(value, from_now: bool) -> Callable[[Any], bool]:
+    """编译 days_ago / days_from_now 比较"""
+    try:
+        target_days = int(value or 0)
+    except (ValueError, TypeError):
+        return lambda actual_value: False
+
+    def check(actual_value) -> bool:
+        if not actual_value:
+            return False
+        try:
+            if isinstance(actual_value, str):
+                actual_date = datetime.fromisoformat(actual_value.replace('Z', '+00:00'))
+            else:
+                actual_date = actual_value
+            delta = actual_date - datetime.utcnow() if from_now else datetime.utcnow() - actual_date
+            return delta.days == target_days
+        except:
+            return False
+    return check
+
+
+def compile_condition(operator: str, value) -> Callable[[Any], bool]:
+    """将可视化条件的操作符和比较值编译为只接收字段实际值的闭包"""
+    if operator == '==':
+        expected = str(value)
+        return lambda actual_value: str(actual_value) == expected
+    if operator == '!=':
+        expected = str(value)
+        return lambda actual_value: str(actual_value) != expected
+    if operator in ('>', '>=', '<', '<='):
+        threshold = float(value or 0)
+        if operator == '>':
+            return lambda actual_value: float(actual_value or 0) > threshold
+        if operator == '>=':
+            return lambda actual_value: float(actual_value or 0) >= threshold
+        if operator == '<':
+            return lambda actual_value: float(actual_value or 0) < threshold
+        return lambda actual_value: float(actual_value or 0) <= threshold
+    if operator == 'contains':
+        needle = str(value).lower()
+        return lambda actual_value: needle in str(actual_value or '').lower()
+    if operator == 'starts_with':
+        prefix = str(value).lower()
+        return lambda actual_value: str(actual_value or '').lower().startswith(prefix)
+    if operator == 'ends_with':
+        suffix = str(value).lower()
+        return lambda actual_value: str(actual_value or '').lower().endswith(suffix)
+    if operator == 'is_empty':
+        return lambda actual_value: not actual_value or str(actual_value).strip() == ''
+    if operator == 'is_not_empty':
+        return lambda actual_value: actual_value and str(actual_value).strip() != ''
+    if operator == 'between':
+        if ',' in str(value):
+            min_val, max_val = str(value).split(',', 1)
+            low, high = float(min_val.strip() or 0), float(max_val.strip() or 0)
+            return lambda actual_value: low <= float(actual_value or 0) <= high
+        return lambda actual_value: False
+    if operator == 'days_ago':
+        return _compile_date_diff(value, from_now=False)
+    if operator == 'days_from_now':
+        return _compile_date_diff(value, from_now=True)
+    return lambda actual_value: False
+
+
+_compile_condition_cached = lru_cache(maxsize=1024)(compile_condition)
+
+
+# JSONLogic 条件中可通过 db.customer.* 引用的客户字段
+_CONDITION_CUSTOMER_ATTRS = frozenset([
+    'id', 'name', 'phone', 'email', 'status', 'stage_id', 'budget_min', 'budget_max', 'preferred_location',
+    'move_in_date', 'unread_count', 'updated_at', 'last_timestamp', 'last_follow_up_time',
+])
+
+
+class _LazyConditionVars(Mapping):
+    """JSONLogic 求值用的上下文变量视图，按键前缀按需取值并缓存"""
+
+    def __init__(self, trigger: Dict[str, Any], customer, ai_ctx: Dict[str, Any]):
+        self._trigger = trigger
+        self._customer = customer
+        self._ai = ai_ctx
+        self._cache: Dict[str, Any] = {}
+
+    def _lookup(self, key):
+        if not isinstance(key, str):
+            raise KeyError(key)
+        head, _, rest = key.partition('.')
+        if head == 'trigger' and rest in self._trigger:
+            return self._trigger[rest]
+        if head == 'ai' and rest in self._ai:
+            return self._ai[rest]
+        if self._customer is not None:
+            if head == 'db' and rest.startswith('customer.') and rest[9:] in _CONDITION_CUSTOMER_ATTRS:
+                return _customer_field(self._customer, rest[9:])
+            if head == 'custom_fields':
+                custom_fields = _parse_custom_fields(self._customer)
+                if rest in custom_fields:
+                    return custom_fields[rest]
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except (KeyError, TypeError):
+            pass
+        value = self._lookup(key)
+        self._cache[key] = value
+        return value
+
+    def _keys(self):
+        keys = [f'trigger.{k}' for k in self._trigger]
+        if self._customer is not None:
+            keys.extend(f'db.customer.{attr}' for attr in _CONDITION_CUSTOMER_ATTRS)
+            keys.extend(f'custom_fields.{k}' for k in _parse_custom_fields(self._customer))
+        keys.extend(f'ai.{k}' for k in self._ai)
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
 
 
 class ConditionProcessor(NodeProcessor):
     """Condition 节点，支持可视化条件构建器或 JSONLogic"""
+
+    USES_DB = False
+    STATELESS = True
     
-    def _get_field_value(self, field_path: str, customer=None):
-        """获取字段值，支持 db.customer.* 和 custom_fields.*"""
-        if field_path.startswith('db.customer.'):
-            field_name = field_path.replace('db.customer.', '')
-            if customer:
-                if field_name == 'custom_fields':
-                    return customer.custom_fields or {}
-                else:
-                    return getattr(customer, field_name, None)
-        elif field_path.startswith('custom_fields.'):
-            field_key = field_path.replace('custom_fields.', '')
-            if customer and customer.custom_fields:
-                custom_fields = customer.custom_fields if isinstance(customer.custom_fields, dict) else json.loads(customer.custom_fields or '{}')
-                return custom_fields.get(field_key)
-        elif field_path.startswith('trigger.'):
-            field_name = field_path.replace('trigger.', '')
-            trigger = self.context.get('trigger_data', {})
-            return trigger.get(field_name)
-        elif field_path.startswith('ai.'):
-            field_name = field_path.replace('ai.', '')
-            ai_ctx = self.context.get('ai', {}) or {}
-            return ai_ctx.get(field_name)
+    def _db_field_value(self, rest: str, customer=None):
+        if not rest.startswith('customer.') or not customer:
+            return None
+        field_name = rest[9:]
+        if field_name == 'custom_fields':
+            return _customer_field(customer, 'custom_fields') or {}
+        return _customer_field(customer, field_name)
+
+    def _custom_field_value(self, rest: str, customer=None):
+        if customer:
+            return _parse_custom_fields(customer).get(rest)
         return None
+
+    def _trigger_field_value(self, rest: str, customer=None):
+        return self.context.get('trigger_data', {}).get(rest)
+
+    def _ai_field_value(self, rest: str, customer=None):
+        ai_ctx = self.context.get('ai', {}) or {}
+        return ai_ctx.get(rest)
+
+    # 按字段路径首段分派
+    _FIELD_GETTERS = {
+        'db': _db_field_value,
+        'custom_fields': _custom_field_value,
+        'trigger': _trigger_field_value,
+        'ai': _ai_field_value,
+    }
+
+    def _get_field_value(self, field_path: str, customer=None):
+        """获取字段值，支持 db.customer.*、custom_fields.*、trigger.* 和 ai.*"""
+        head, sep, rest = field_path.partition('.')
+        getter = self._FIELD_GETTERS.get(head) if sep else None
+        if not getter:
+            return None
+        return getter(self, rest, customer)
     
     def _evaluate_condition(self, condition: Dict[str, Any], customer=None) -> bool:
         """评估单个条件"""
@@ -4202,63 +4546,12 @@ class ConditionProcessor(NodeProcessor):
         actual_value = self._get_field_value(field, customer)
         
         try:
-            # 处理不同的操作符
-            if operator == '==':
-                return str(actual_value) == str(value)
-            elif operator == '!=':
-                return str(actual_value) != str(value)
-            elif operator == '>':
-                return float(actual_value or 0) > float(value or 0)
-            elif operator == '>=':
-                return float(actual_value or 0) >= float(value or 0)
-            elif operator == '<':
-                return float(actual_value or 0) < float(value or 0)
-            elif operator == '<=':
-                return float(actual_value or 0) <= float(value or 0)
-            elif operator == 'contains':
-                return str(value).lower() in str(actual_value or '').lower()
-            elif operator == 'starts_with':
-                return str(actual_value or '').lower().startswith(str(value).lower())
-            elif operator == 'ends_with':
-                return str(actual_value or '').lower().endswith(str(value).lower())
-            elif operator == 'is_empty':
-                return not actual_value or str(actual_value).strip() == ''
-            elif operator == 'is_not_empty':
-                return actual_value and str(actual_value).strip() != ''
-            elif operator == 'between':
-                if ',' in str(value):
-                    min_val, max_val = str(value).split(',', 1)
-                    actual_num = float(actual_value or 0)
-                    return float(min_val.strip() or 0) <= actual_num <= float(max_val.strip() or 0)
-                return False
-            elif operator == 'days_ago':
-                if actual_value:
-                    from datetime import datetime, timedelta
-                    try:
-                        if isinstance(actual_value, str):
-                            actual_date = datetime.fromisoformat(actual_value.replace('Z', '+00:00'))
-                        else:
-                            actual_date = actual_value
-                        days_diff = (datetime.utcnow() - actual_date).days
-                        return days_diff == int(value or 0)
-                    except:
-                        return False
-                return False
-            elif operator == 'days_from_now':
-                if actual_value:
-                    from datetime import datetime, timedelta
-                    try:
-                        if isinstance(actual_value, str):
-                            actual_date = datetime.fromisoformat(actual_value.replace('Z', '+00:00'))
-                        else:
-                            actual_date = actual_value
-                        days_diff = (actual_date - datetime.utcnow()).days
-                        return days_diff == int(value or 0)
-                    except:
-                        return False
-                return False
-            else:
-                return False
+            # 条件结构在各次执行间不变，按 (operator, value) 缓存编译后的比较函数
+            try:
+                check = _compile_condition_cached(operator, value)
+            except TypeError:  # value 不可哈希（如列表）时不缓存
+                check = compile_condition(operator, value)
+            return check(actual_value)
         except (ValueError, TypeError) as e:
             logger.warning(f"Condition evaluation error for {field} {operator} {value}: {e}")
             return False
@@ -4279,32 +4572,16 @@ class ConditionProcessor(NodeProcessor):
             if mode == 'jsonlogic':
                 # JSONLogic 模式 - 保持原有逻辑
                 expr_raw = node_data.get('jsonlogic') or node_data.get('json_logic')
-                if isinstance(expr_raw, str):
-                    expr = json.loads(expr_raw)
-                else:
-                    expr = expr_raw or {}
-                
-                # 构建上下文变量
-                ctx_vars = {}
-                trigger = self.context.get('trigger_data', {})
-                for k, v in trigger.items():
-                    ctx_vars[f'trigger.{k}'] = v
-                
-                if customer:
-                    for attr in ['id', 'name', 'phone', 'email', 'status', 'stage_id', 'budget_min', 'budget_max', 'preferred_location', 'move_in_date', 'unread_count', 'updated_at', 'last_timestamp', 'last_follow_up_time']:
-                        ctx_vars[f'db.customer.{attr}'] = getattr(customer, attr, None)
-                    
-                    # 添加 custom_fields 支持
-                    if customer.custom_fields:
-                        custom_fields = customer.custom_fields if isinstance(customer.custom_fields, dict) else json.loads(customer.custom_fields or '{}')
-                        for key, value in custom_fields.items():
-                            ctx_vars[f'custom_fields.{key}'] = value
+                compiled_expr = _get_compiled_jsonlogic(node_config.get('id'), expr_raw)
                 
-                ai_ctx = self.context.get('ai', {}) or {}
-                for k, v in ai_ctx.items():
-                    ctx_vars[f'ai.{k}'] = v
+                # 上下文变量按需解析，只计算表达式实际引用的字段
+                ctx_vars = _LazyConditionVars(
+                    self.context.get('trigger_data', {}),
+                    customer,
+                    self.context.get('ai', {}) or {},
+                )
                 
-                result = evaluate_jsonlogic(expr, ctx_vars)
+                result = compiled_expr(ctx_vars)
             else:
                 # 可视化条件构建器模式
                 conditions = node_data.get('conditions', [])
@@ -4340,8 +4617,21 @@ class ConditionProcessor(NodeProcessor):
 class SendMessageProcessor(NodeProcessor):
     """通用消息发送节点 - 根据触发渠道自动选择发送方式"""
     
+    # 渠道 -> 实际发送处理器
+    _CHANNEL_PROCESSORS = {
+        "telegram": SendTelegramMessageProcessor,
+        "whatsapp": SendWhatsAppMessageProcessor,
+    }
+    # 发送模式 -> 固定渠道（None 表示使用触发渠道）；未列出的旧配置走兼容模式
+    _SEND_MODE_CHANNELS = {
+        "smart_reply": None,
+        "force_whatsapp": "whatsapp",
+        "force_telegram": "telegram",
+    }
+    
     def __init__(self, db: Session, context: WorkflowContext):
         super().__init__(db, context)
+        self._channel_processors: Dict[str, NodeProcessor] = {}
     
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
         """根据触发渠道自动选择发送方式"""
@@ -4357,84 +4647,304 @@ class SendMessageProcessor(NodeProcessor):
         
         logger.info(f"📤 通用发送节点 - 发送模式: {send_mode}, 触发渠道: {trigger_channel}, 指定渠道: {specified_channel}")
         
-        # 根据发送模式确定最终渠道
-        if send_mode == "smart_reply":
-            # 智能回复：使用触发渠道
-            channel = trigger_channel
-            logger.info(f"  智能回复模式 - 使用触发渠道: {channel}")
-        elif send_mode == "force_whatsapp":
-            # 强制发送到 WhatsApp
-            channel = "whatsapp"
-            logger.info(f"  强制 WhatsApp 模式")
-        elif send_mode == "force_telegram":
-            # 强制发送到 Telegram
-            channel = "telegram"
-            logger.info(f"  强制 Telegram 模式")
+        # 根据发送模式确定最终渠道：智能回复使用触发渠道，force_* 使用固定渠道，
+        # 兼容旧的配置方式时优先使用节点配置中指定的渠道，否则使用触发渠道
+        if send_mode in self._SEND_MODE_CHANNELS:
+            channel = self._SEND_MODE_CHANNELS[send_mode] or trigger_channel
         else:
-            # 兼容旧的配置方式：优先使用节点配置中指定的渠道，否则使用触发渠道
-            channel = specified_channel if specified_channel else trigger_channel
-            logger.info(f"  兼容模式 - 最终渠道: {channel}")
+            channel = specified_channel or trigger_channel
+        logger.info(f"  最终渠道: {channel}")
         
-        # 根据渠道选择对应的处理器
-        if channel == "telegram":
-            processor = SendTelegramMessageProcessor(self.db, self.context)
-            # 确保 Telegram 节点配置正确
-            if not node_data.get("send_mode") or send_mode == "smart_reply":
-                node_data["send_mode"] = "smart_reply"  # 使用智能回复模式
-        elif channel == "whatsapp":
-            processor = SendWhatsAppMessageProcessor(self.db, self.context)
-            # 确保 WhatsApp 节点配置正确
-            if not node_data.get("send_mode") or send_mode == "smart_reply":
-                node_data["send_mode"] = "smart_reply"  # 使用智能回复模式
-        else:
-            raise ValueError(f"Unsupported channel: {channel}")
+        # 根据渠道选择对应的处理器（同一节点实例内复用）
+        processor = self._channel_processors.get(channel)
+        if processor is None:
+            processor_cls = self._CHANNEL_PROCESSORS.get(channel)
+            if processor_cls is None:
+                raise ValueError(f"Unsupported channel: {channel}")
+            processor = self._channel_processors[channel] = processor_cls(self.db, self.context)
+        
+        # 确保目标节点配置正确：未指定或智能回复时使用智能回复模式
+        if not node_data.get("send_mode") or send_mode == "smart_reply":
+            node_data["send_mode"] = "smart_reply"
         
         # 执行对应的处理器
         return await processor.execute(node_config)
 
+# CustomAPI 节点共用的 HTTP 客户端，复用连接池，避免每次请求重新建立 TCP/TLS 连接
+_HTTPX_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_httpx_client() -> httpx.AsyncClient:
+    """获取（按需创建）共享的 httpx.AsyncClient，超时由每次请求单独传入"""
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is None or _HTTPX_CLIENT.is_closed:
+        _HTTPX_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(30.0),
+        )
+    return _HTTPX_CLIENT
+
+async def close_httpx_client():
+    """关闭共享的 HTTP 客户端（应用关闭时调用）"""
+    global _HTTPX_CLIENT
+    if _HTTPX_CLIENT is not None:
+        await _HTTPX_CLIENT.aclose()
+        _HTTPX_CLIENT = None
+
+# 响应无法解析为 JSON 时，输出中保留的原始文本最大长度
+_API_RAW_TEXT_LIMIT = 4096
+
+
+def _parse_api_response(response: httpx.Response) -> Any:
+    """
+    解析 API 响应体：直接从原始字节解析 JSON，不再额外解码整段文本
+    
+    Content-Type 不是 JSON 且响应体看起来也不像 JSON 时跳过解析；
+    解析失败时只保留有限长度的原始文本。
+    """
+    content = response.content
+    content_type = response.headers.get("content-type", "")
+    if "json" in content_type or content[:64].lstrip()[:1] in (b"{", b"["):
+        try:
+            response_json = orjson.loads(content) if orjson is not None else json.loads(content)
+            logger.debug("响应 JSON: %s", response_json)
+            return response_json
+        except ValueError as e:
+            logger.debug("❌ 解析响应 JSON 失败: %s", e)
+    else:
+        logger.debug("⏭️ 响应 Content-Type 为 %s，跳过 JSON 解析", content_type)
+
+    raw_text = content[:_API_RAW_TEXT_LIMIT].decode(response.encoding or "utf-8", errors="replace")
+    if len(content) > _API_RAW_TEXT_LIMIT:
+        raw_text += "...(truncated)"
+    logger.debug("原始响应文本: %s", raw_text)
+    return {"error": "Failed to parse JSON", "raw_text": raw_text}
+
+_EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+
+def _transform_last_4_digits(value: str) -> str:
+    # 提取最后4位数字
+    digits = ''.join(filter(str.isdigit, value))
+    return digits[-4:] if len(digits) >= 4 else digits
+
+
+def _transform_first_word(value: str) -> str:
+    # 提取第一个单词
+    words = value.split()
+    return words[0] if words else value
+
+
+def _transform_extract_email(value: str) -> str:
+    # 提取邮箱地址
+    match = _EMAIL_RE.search(value)
+    return match.group(0) if match else value
+
+
+def _transform_extract_phone(value: str) -> str:
+    # 提取电话号码（数字）
+    digits = ''.join(filter(str.isdigit, value))
+    return digits if digits else value
+
+
+# 智能变量转换器名称 -> 转换函数
+_SMART_VAR_TRANSFORMERS: Dict[str, Callable[[str], str]] = {
+    "Last 4 Digits": _transform_last_4_digits,
+    "First Word": _transform_first_word,
+    "Uppercase": str.upper,
+    "Lowercase": str.lower,
+    "Capitalize": str.capitalize,
+    "Extract Email": _transform_extract_email,
+    "Extract Phone": _transform_extract_phone,
+}
+
+
+class _SmartVarPlan:
+    """CustomAPI 节点智能变量的预处理结果：有数据源的变量列表"""
+
+    def __init__(self, smart_variables: Dict[str, Any]):
+        # (变量名, 数据源模板, 转换器名或 None)
+        self.entries = []
+        for var_name, var_config in (smart_variables or {}).items():
+            source = var_config.get("source", "")
+            if not source:
+                logger.debug("跳过变量 %s: 无数据源", var_name)
+                continue
+            transformer = var_config.get("transformer", "None")
+            self.entries.append((var_name, source, transformer if transformer and transformer != "None" else None))
+
+
+# 节点 ID -> (smart_variables 配置, 预处理结果)；配置变化（!=）时重建
+_SMART_VAR_PLAN_CACHE: Dict[Any, tuple] = {}
+
+
+def _get_smart_var_plan(node_id, smart_variables: Dict[str, Any]) -> _SmartVarPlan:
+    """获取节点的智能变量预处理结果"""
+    cached = _SMART_VAR_PLAN_CACHE.get(node_id) if node_id is not None else None
+    if cached is not None and cached[0] == smart_variables:
+        return cached[1]
+    plan = _SmartVarPlan(smart_variables)
+    if node_id is not None:
+        _SMART_VAR_PLAN_CACHE[node_id] = (smart_variables, plan)
+    return plan
+
+
+class _JsonBodyPlan:
+    """CustomAPI 节点 JSON body 模板的预处理结果：按 {{variable}} 占位符拆分后的片段"""
+
+    def __init__(self, template: str):
+        # split 的结果中字面量与变量路径交替出现：[literal, var, literal, ..., literal]
+        pieces = _JSON_BODY_VAR_RE.split(template)
+        self.literals = tuple(pieces[0::2])
+        self.var_paths = tuple(pieces[1::2])
+
+    def render(self, resolve_var: Callable[[str], str]) -> str:
+        """依次解析各变量并与字面量拼接；无变量时直接返回模板"""
+        if not self.var_paths:
+            return self.literals[0]
+        parts = [self.literals[0]]
+        for var_path, literal in zip(self.var_paths, self.literals[1:]):
+            parts.append(resolve_var(var_path))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+class _JsonObjectBodyPlan:
+    """对象形式（dict/list）的 JSON body 模板：只对含占位符的字符串值做替换"""
+
+    def __init__(self, template: Any):
+        self._build = self._compile(template)
+
+    @classmethod
+    def _compile(cls, value: Any) -> Callable[[Callable[[str], str]], Any]:
+        if isinstance(value, dict):
+            items = [(key, cls._compile(item)) for key, item in value.items()]
+            return lambda resolve_var: {key: build(resolve_var) for key, build in items}
+        if isinstance(value, list):
+            builds = [cls._compile(item) for item in value]
+            return lambda resolve_var: [build(resolve_var) for build in builds]
+        if isinstance(value, str) and '{{' in value:
+            return _JsonBodyPlan(value).render
+        return lambda resolve_var: value
+
+    def build(self, resolve_var: Callable[[str], str]) -> Any:
+        """依次解析各变量，返回新的 body 对象"""
+        return self._build(resolve_var)
+
+
+# 节点 ID -> (body 模板, 预处理结果)；模板变化时重建
+_JSON_BODY_PLAN_CACHE: Dict[Any, tuple] = {}
+
+
+def _get_json_body_plan(node_id, template: Any) -> Union[_JsonBodyPlan, _JsonObjectBodyPlan]:
+    """获取节点 JSON body 模板的预处理结果；body 可以是 JSON 字符串或对象"""
+    cached = _JSON_BODY_PLAN_CACHE.get(node_id) if node_id is not None else None
+    if cached is not None and cached[0] == template:
+        return cached[1]
+    plan = _JsonObjectBodyPlan(template) if isinstance(template, (dict, list)) else _JsonBodyPlan(template)
+    if node_id is not None:
+        _JSON_BODY_PLAN_CACHE[node_id] = (template, plan)
+    return plan
+
+
+# CustomAPI 节点支持的 HTTP 方法，以及需要携带 JSON body 的方法
+_SUPPORTED_HTTP_METHODS = frozenset({'GET', 'POST', 'PUT', 'PATCH', 'DELETE'})
+_METHOD_NEEDS_BODY = frozenset({'POST', 'PUT', 'PATCH'})
+
+# CustomAPI 节点 URL / Header / Body 中的 {{variable}} 占位符
+_TEMPLATE_VAR_RE = re.compile(r'\{\{\s*([^}]+?)\s*\}\}')  # 两侧空白由正则吸收，无需再 strip
+
+
+# 以下解析函数供 CustomAPI 节点的 {{variable}} 替换使用，参数 rest 为去掉首段后的路径；
+# 返回 None 表示未解析，保留原始占位符
+
+def _resolve_api_db_var(processor: NodeProcessor, rest: str):
+    if not rest.startswith("customer."):
+        return processor.context.get(f"db.{rest}")
+    customer = processor.context.db.get("customer")
+    if not customer:
+        return None
+    field_name = rest[9:]
+    snapshot = _customer_snapshot(customer)
+    if field_name in snapshot:
+        value = snapshot[field_name]
+    elif hasattr(customer, field_name):
+        value = getattr(customer, field_name)
+    else:
+        return None
+    return value if value is not None else ""  # 字段存在但为空时替换为空字符串
+
+
+def _resolve_api_custom_field_var(processor: NodeProcessor, rest: str):
+    customer = processor.context.db.get("customer")
+    if not customer:
+        return None
+    return _parse_custom_fields(customer).get(rest)
+
+
+def _resolve_api_ai_var(processor: NodeProcessor, rest: str):
+    return _get_nested_value(processor.context.ai, rest)
+
+
+def _resolve_api_response_var(processor: NodeProcessor, rest: str):
+    return _get_nested_value(processor.context.get("api.response", {}), rest)
+
+
+def _resolve_api_customer_var(processor: NodeProcessor, rest: str):
+    # 兼容旧格式 customer.*：last_message 取触发消息，其余读取客户字段
+    if rest == "last_message":
+        return processor.context.get("trigger_data", {}).get("message")
+    customer = processor.context.db.get("customer")
+    if not customer:
+        return None
+    return _customer_field(customer, rest)
+
+
+_CUSTOM_API_VAR_RESOLVERS = {
+    "trigger": _resolve_trigger_text_var,
+    "db": _resolve_api_db_var,
+    "custom_fields": _resolve_api_custom_field_var,
+    "ai": _resolve_api_ai_var,
+    "api": _resolve_api_response_var,
+    "customer": _resolve_api_customer_var,
+}
+
+
 class CustomAPIProcessor(NodeProcessor):
     """自定义 API 调用节点"""
+
+    USES_DB = False
+    STATELESS = True
     
     def _apply_transformer(self, value: str, transformer: str) -> str:
         """应用智能变量转换器"""
         if not value or not transformer or transformer == "None":
             return value
         
+        transform = _SMART_VAR_TRANSFORMERS.get(transformer)
+        if transform is None:
+            # 未知转换器，返回原值
+            logger.warning(f"Unknown transformer: {transformer}")
+            return value
         try:
-            if transformer == "Last 4 Digits":
-                # 提取最后4位数字
-                digits = ''.join(filter(str.isdigit, str(value)))
-                return digits[-4:] if len(digits) >= 4 else digits
-            elif transformer == "First Word":
-                # 提取第一个单词
-                words = str(value).split()
-                return words[0] if words else value
-            elif transformer == "Uppercase":
-                return str(value).upper()
-            elif transformer == "Lowercase":
-                return str(value).lower()
-            elif transformer == "Capitalize":
-                return str(value).capitalize()
-            elif transformer == "Extract Email":
-                # 提取邮箱地址
-                import re
-                email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-                match = re.search(email_pattern, str(value))
-                return match.group(0) if match else value
-            elif transformer == "Extract Phone":
-                # 提取电话号码（数字）
-                digits = ''.join(filter(str.isdigit, str(value)))
-                return digits if digits else value
-            else:
-                # 未知转换器，返回原值
-                logger.warning(f"Unknown transformer: {transformer}")
-                return value
+            return transform(value)
         except Exception as e:
             logger.error(f"智能变量转换器失败 ({transformer}): {e}")
             return value
 
+    def _resolve_json_body_var(self, var_path: str) -> str:
+        """解析 JSON body 中的单个变量（与 URL、请求头共用 _CUSTOM_API_VAR_RESOLVERS），未解析时返回空字符串"""
+        head, sep, rest = var_path.partition('.')
+        resolver = _CUSTOM_API_VAR_RESOLVERS.get(head) if sep else None
+        value = resolver(self, rest) if resolver is not None else self.context.get(var_path)
+        if value is None:
+            logger.debug("⚠️ JSON Body 变量未解析，使用空字符串: %s", var_path)
+            return ""
+        logger.debug("✅ JSON Body 变量解析: %s -> %s", var_path, value)
+        # 变量可能与其他文本拼接在同一个 JSON 字符串中，返回字符串内容而不做 JSON 编码
+        return value if type(value) is str else str(value)
+
     async def execute(self, node_config: Dict[str, Any]) -> Dict[str, Any]:
-        print(f"\n🔧 CustomAPI 节点开始执行...")
+        logger.debug("🔧 CustomAPI 节点开始执行...")
         
         user_id = self.context.get("trigger_data", {}).get("user_id")
         if not user_id:
@@ -4450,115 +4960,116 @@ class CustomAPIProcessor(NodeProcessor):
         retry_count = node_data.get("retry_count", 0)
         response_mapping = node_data.get("response_mapping", {})
 
-        print(f"  📋 节点配置:")
-        print(f"    - Method: {method}")
-        print(f"    - URL Template: {url_template}")
-        print(f"    - Headers Template: {headers_template}")
-        print(f"    - Body Template: {body_template}")
-        print(f"    - Auth Config: {auth_config}")
-        print(f"    - Timeout: {timeout}s")
-        print(f"    - Retry Count: {retry_count}")
-        print(f"    - Response Mapping: {response_mapping}")
+        logger.debug("📋 节点配置:")
+        logger.debug("- Method: %s", method)
+        logger.debug("- URL Template: %s", url_template)
+        logger.debug("- Headers Template: %s", headers_template)
+        logger.debug("- Body Template: %s", body_template)
+        logger.debug("- Auth Config: %s", auth_config)
+        logger.debug("- Timeout: %ss", timeout)
+        logger.debug("- Retry Count: %s", retry_count)
+        logger.debug("- Response Mapping: %s", response_mapping)
 
         if not url_template:
             raise ValueError("API URL is required for CustomAPI node.")
 
-        print(f"\n  🔍 开始变量替换...")
-        print(f"    当前上下文变量: {list(self.context.variables.keys())}")
-        
-        # 打印触发数据和客户信息用于调试
-        trigger_data = self.context.get("trigger_data", {})
-        customer = self.context.db.get("customer")
-        ai_data = self.context.get("ai", {})
-        
-        print(f"    触发数据: {trigger_data}")
-        if customer:
-            print(f"    客户信息: ID={customer.id}, Name={customer.name}, Phone={customer.phone}")
-            if hasattr(customer, 'custom_fields') and customer.custom_fields:
-                print(f"    客户自定义字段: {customer.custom_fields}")
-        if ai_data:
-            print(f"    AI 数据: {ai_data}")
+        logger.debug("🔍 开始变量替换...")
+        if logger.isEnabledFor(logging.DEBUG):
+            # 打印触发数据和客户信息用于调试
+            logger.debug("当前上下文变量: %s", list(self.context.variables.keys()))
+            trigger_data = self.context.get("trigger_data", {})
+            customer = self.context.db.get("customer")
+            ai_data = self.context.get("ai", {})
+            
+            logger.debug("触发数据: %s", trigger_data)
+            if customer:
+                logger.debug("客户信息: ID=%s, Name=%s, Phone=%s", customer.id, customer.name, customer.phone)
+                if hasattr(customer, 'custom_fields') and customer.custom_fields:
+                    logger.debug("客户自定义字段: %s", customer.custom_fields)
+            if ai_data:
+                logger.debug("AI 数据: %s", ai_data)
 
         # 1. 变量替换
-        print(f"\n  🔄 URL 变量替换:")
-        print(f"    原始 URL: {url_template}")
+        logger.debug("🔄 URL 变量替换:")
+        logger.debug("原始 URL: %s", url_template)
         url = self._resolve_text_variables(url_template) if url_template else None
-        print(f"    替换后 URL: {url}")
+        logger.debug("替换后 URL: %s", url)
         
-        print(f"\n  🔄 Headers 变量替换:")
+        logger.debug("🔄 Headers 变量替换:")
         headers = {}
         for k, v in headers_template.items():
-            print(f"    原始 Header {k}: {v}")
+            logger.debug("原始 Header %s: %s", k, v)
             resolved_value = self._resolve_text_variables(v)
             headers[k] = resolved_value
-            print(f"    替换后 Header {k}: {resolved_value}")
+            logger.debug("替换后 Header %s: %s", k, resolved_value)
         
         # 处理智能变量
-        print(f"\n  🧠 处理智能变量:")
+        logger.debug("🧠 处理智能变量:")
         smart_variables = node_data.get("smart_variables", {})
+        smart_var_plan = _get_smart_var_plan(node_config.get("id"), smart_variables)
         processed_smart_vars = {}
         
         if smart_variables:
-            print(f"    找到 {len(smart_variables)} 个智能变量")
-            for var_name, var_config in smart_variables.items():
-                source = var_config.get("source", "")
-                transformer = var_config.get("transformer", "None")
+            logger.debug("找到 %s 个智能变量", len(smart_variables))
+            for var_name, source, transformer in smart_var_plan.entries:
+                logger.debug("处理变量: %s, 数据源: %s, 转换器: %s", var_name, source, transformer)
                 
-                if source:
-                    print(f"    处理变量: {var_name}")
-                    print(f"      数据源: {source}")
-                    print(f"      转换器: {transformer}")
-                    
-                    # 解析数据源
-                    resolved_value = self._resolve_text_variables(source)
-                    print(f"      解析后值: {resolved_value}")
-                    
-                    # 应用转换器
-                    if transformer and transformer != "None" and resolved_value:
-                        transformed_value = self._apply_transformer(str(resolved_value), transformer)
-                        print(f"      转换后值: {transformed_value}")
-                        processed_smart_vars[var_name] = transformed_value
-                    else:
-                        processed_smart_vars[var_name] = resolved_value
+                # 解析数据源
+                resolved_value = self._resolve_text_variables(source)
+                
+                # 应用转换器
+                if transformer and resolved_value:
+                    transformed_value = self._apply_transformer(str(resolved_value), transformer)
+                    logger.debug("解析后值: %s, 转换后值: %s", resolved_value, transformed_value)
+                    processed_smart_vars[var_name] = transformed_value
                 else:
-                    print(f"    跳过变量 {var_name}: 无数据源")
+                    logger.debug("解析后值: %s", resolved_value)
+                    processed_smart_vars[var_name] = resolved_value
             
-            print(f"    处理完成的智能变量: {processed_smart_vars}")
+            logger.debug("处理完成的智能变量: %s", processed_smart_vars)
         else:
-            print(f"    无智能变量配置")
+            logger.debug("无智能变量配置")
         
-        print(f"\n  🔄 Body 变量替换:")
+        logger.debug("🔄 Body 变量替换:")
         body = None
         if body_template:
-            print(f"    原始 Body: {body_template}")
-            # 先替换智能变量，再替换其他变量
-            body_with_smart_vars = body_template
-            for var_name, var_value in processed_smart_vars.items():
-                placeholder = f"{{{{{var_name}}}}}"
-                if placeholder in body_with_smart_vars:
-                    print(f"      替换智能变量: {placeholder} -> {var_value}")
-                    body_with_smart_vars = body_with_smart_vars.replace(placeholder, str(var_value))
-            
-            print(f"    智能变量替换后: {body_with_smart_vars}")
-            body = self._resolve_json_body_from_context(body_with_smart_vars)
-            print(f"    最终 Body: {body}")
+            logger.debug("原始 Body: %s", body_template)
+            # 模板按节点预先拆分为字面量与占位符，每次只需解析变量并拼接：
+            # 智能变量占位符取其处理结果，其余变量从上下文解析
+            body_plan = _get_json_body_plan(node_config.get("id"), body_template)
+            smart_values = {var_name: str(var_value) for var_name, var_value in processed_smart_vars.items()}
+
+            def resolve_body_var(var_path):
+                if var_path in smart_values:
+                    logger.debug("替换智能变量: %s -> %s", var_path, smart_values[var_path])
+                    return smart_values[var_path]
+                return self._resolve_json_body_var(var_path)
+
+            if isinstance(body_plan, _JsonObjectBodyPlan):
+                # 对象形式的 body 直接逐值替换，无需先拼成字符串再解析
+                body = body_plan.build(resolve_body_var)
+            else:
+                body_string = body_plan.render(resolve_body_var)
+                logger.debug("变量替换后: %s", body_string)
+                body = self._parse_json_body(body_string)
+            logger.debug("最终 Body: %s", body)
         else:
-            print(f"    无 Body 模板")
+            logger.debug("无 Body 模板")
 
         # 2. 认证处理
-        print(f"\n  🔐 认证处理:")
+        logger.debug("🔐 认证处理:")
         auth_header = None
         if auth_config.get("type") == "bearer":
             token = auth_config.get("token")
             if token:
                 auth_header = {"Authorization": f"Bearer {token}"}
-                print(f"    Bearer 认证: {token[:10]}..." if len(token) > 10 else f"    Bearer 认证: {token}")
+                logger.debug("Bearer 认证: %s...", token[:10])
         elif auth_config.get("type") == "api_key":
             api_key = auth_config.get("api_key")
             header_name = auth_config.get("api_key_header", "X-API-Key")
             if api_key and header_name:
                 auth_header = {header_name: api_key}
-                print(f"    API Key 认证: {header_name} = {api_key[:10]}..." if len(api_key) > 10 else f"    API Key 认证: {header_name} = {api_key}")
+                logger.debug("API Key 认证: %s = %s...", header_name, api_key[:10])
         elif auth_config.get("type") == "basic":
             username = auth_config.get("username")
             password = auth_config.get("password")
@@ -4566,238 +5077,343 @@ class CustomAPIProcessor(NodeProcessor):
                 credentials = f"{username}:{password}".encode("ascii")
                 encoded_credentials = base64.b64encode(credentials).decode("ascii")
                 auth_header = {"Authorization": f"Basic {encoded_credentials}"}
-                print(f"    Basic 认证: {username}:{'*' * len(password)}")
+                logger.debug("Basic 认证: %s:%s", username, '*' * len(password))
         else:
-            print(f"    无认证配置")
+            logger.debug("无认证配置")
 
         if auth_header:
             headers.update(auth_header)
-            print(f"    认证头已添加到请求头中")
+            logger.debug("认证头已添加到请求头中")
         
-        print(f"\n  📤 最终请求参数:")
-        print(f"    Method: {method}")
-        print(f"    URL: {url}")
-        print(f"    Headers: {headers}")
-        print(f"    Body: {body}")
+        logger.debug("📤 最终请求参数:")
+        logger.debug("Method: %s", method)
+        logger.debug("URL: %s", url)
+        logger.debug("Headers: %s", headers)
+        logger.debug("Body: %s", body)
 
         # 3. 发送HTTP请求与重试
+        if method not in _SUPPORTED_HTTP_METHODS:
+            raise ValueError(f"Unsupported HTTP method: {method}")
+        request_kwargs = {"headers": headers, "timeout": timeout}
+        if method in _METHOD_NEEDS_BODY:
+            request_kwargs["json"] = body
+
         async def make_request():
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                if method == "GET":
-                    response = await client.get(url, headers=headers)
-                elif method == "POST":
-                    response = await client.post(url, headers=headers, json=body)
-                elif method == "PUT":
-                    response = await client.put(url, headers=headers, json=body)
-                elif method == "DELETE":
-                    response = await client.delete(url, headers=headers)
-                else:
-                    raise ValueError(f"Unsupported HTTP method: {method}")
-                response.raise_for_status() # Raises HTTPStatusError for bad responses (4xx, 5xx)
-                return response
+            response = await get_httpx_client().request(method, url, **request_kwargs)
+            response.raise_for_status() # Raises HTTPStatusError for bad responses (4xx, 5xx)
+            return response
 
-        print(f"\n  🚀 开始发送 HTTP 请求...")
+        logger.debug("🚀 开始发送 HTTP 请求...")
+        self._release_db_connection()
         response = None
         last_exception = None
         for attempt in range(retry_count + 1):
             try:
-                print(f"    尝试 {attempt + 1}/{retry_count + 1}")
+                logger.debug("尝试 %s/%s", attempt + 1, retry_count + 1)
                 response = await make_request()
-                print(f"    ✅ 请求成功! 状态码: {response.status_code}")
-                print(f"    响应头: {dict(response.headers)}")
+                logger.debug("✅ 请求成功! 状态码: %s", response.status_code)
+                logger.debug("响应头: %s", response.headers)
                 break
             except httpx.HTTPStatusError as e:
-                print(f"    ❌ HTTP 状态错误: {e.response.status_code}")
-                print(f"    错误响应: {e.response.text}")
+                logger.debug("❌ HTTP 状态错误: %s", e.response.status_code)
+                logger.debug("错误响应: %s", e.response.text)
                 logger.warning(f"API request failed with status {e.response.status_code}: {e.response.text}. Attempt {attempt + 1}/{retry_count + 1}")
                 last_exception = e
             except httpx.RequestError as e:
-                print(f"    ❌ 请求错误: {e}")
+                logger.debug("❌ 请求错误: %s", e)
                 logger.warning(f"API request error: {e}. Attempt {attempt + 1}/{retry_count + 1}")
                 last_exception = e
             except Exception as e:
-                print(f"    ❌ 未知错误: {e}")
+                logger.debug("❌ 未知错误: %s", e)
                 logger.warning(f"Unexpected API error: {e}. Attempt {attempt + 1}/{retry_count + 1}")
                 last_exception = e
             
             if attempt < retry_count:
                 wait_time = 2 ** attempt
-                print(f"    ⏱️ 等待 {wait_time} 秒后重试...")
+                logger.debug("⏱️ 等待 %s 秒后重试...", wait_time)
                 await asyncio.sleep(wait_time) # Exponential backoff
             else:
-                print(f"    🚫 所有重试失败，抛出异常")
+                logger.debug("🚫 所有重试失败，抛出异常")
                 raise last_exception # Re-raise if all retries fail
 
         if not response:
             raise ValueError("API request failed after all retries.")
 
         # 4. 响应处理
-        print(f"\n  📥 处理 API 响应...")
-        try:
-            response_json = response.json()
-            print(f"    响应 JSON: {response_json}")
-        except Exception as e:
-            print(f"    ❌ 解析响应 JSON 失败: {e}")
-            print(f"    原始响应文本: {response.text}")
-            response_json = {"error": "Failed to parse JSON", "raw_text": response.text}
-        
-        output_data = {"status_code": response.status_code, "headers": dict(response.headers)}
+        logger.debug("📥 处理 API 响应...")
+        response_json = _parse_api_response(response)
+        
+        # 默认保留全部响应头（模板可能引用任意 api.response.headers.*）；
+        # 节点配置 response_headers 列表时只保留其中的响应头，减少复制和序列化
+        header_names = node_data.get("response_headers")
+        if header_names:
+            response_headers = {name: response.headers[name] for name in header_names if name in response.headers}
+        else:
+            response_headers = dict(response.headers)
+        output_data = {
+            "status_code": response.status_code,
+            "headers": response_headers,
+        }
 
         if response_mapping.get("data_field"):
             data_field_path = response_mapping["data_field"].split('.')
-            print(f"    🎯 提取数据字段: {response_mapping['data_field']} -> {data_field_path}")
+            logger.debug("🎯 提取数据字段: %s -> %s", response_mapping['data_field'], data_field_path)
             current_data = response_json
             try:
                 for field in data_field_path:
-                    print(f"      访问字段: {field}")
+                    logger.debug("访问字段: %s", field)
                     current_data = current_data[field]
-                    print(f"      当前数据: {current_data}")
+                    logger.debug("当前数据: %s", current_data)
                 output_data["data"] = current_data
-                print(f"    ✅ 成功提取数据字段: {current_data}")
+                logger.debug("✅ 成功提取数据字段: %s", current_data)
             except (KeyError, TypeError) as e:
-                print(f"    ❌ 提取数据字段失败: {e}")
+                logger.debug("❌ 提取数据字段失败: %s", e)
                 logger.warning(f"Could not extract data_field '{response_mapping.get('data_field')}' from API response: {e}")
                 output_data["data"] = response_json # Fallback to full response
-                print(f"    🔄 回退到完整响应")
+                logger.debug("🔄 回退到完整响应")
         else:
             output_data["data"] = response_json
-            print(f"    📋 使用完整响应作为数据")
+            logger.debug("📋 使用完整响应作为数据")
 
-        print(f"\n  💾 保存到上下文...")
-        print(f"    输出数据: {output_data}")
+        logger.debug("💾 保存到上下文...")
+        logger.debug("输出数据: %s", output_data)
         
         # 保存到上下文，以便后续节点使用
         self.context.set("api.response", output_data)
-        print(f"    ✅ 已保存到 context['api.response']")
+        logger.debug("✅ 已保存到 context['api.response']")
 
-        print(f"\n  🎉 CustomAPI 节点执行完成!")
+        logger.debug("🎉 CustomAPI 节点执行完成!")
         return output_data
 
     def _resolve_text_variables(self, text: str) -> str:
         """解析文本中的所有 {{variable_path}} 变量"""
         if not isinstance(text, str):
             return str(text)
-
-        def get_nested_value(data, path_parts):
-            current = data
-            for part in path_parts:
-                if isinstance(current, dict) and part in current:
-                    current = current[part]
-                elif isinstance(current, object) and hasattr(current, part):
-                    current = getattr(current, part)
-                else:
-                    return None
-            return current
+        if '{{' not in text: # 无模板标记，跳过正则替换
+            return text
 
         def replace_match(match):
-            var_path = match.group(1).strip()
-            print(f"      🔍 解析变量: {var_path}")
-            
-            # 尝试从各种上下文中解析变量
-            # 1. 优先尝试 'trigger' 相关变量
-            if var_path.startswith("trigger."):
-                trigger_data = self.context.get("trigger_data", {})
-                value = get_nested_value(trigger_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"        ✅ 从 trigger 解析: {var_path} -> {value}")
-                    return str(value)
-                else:
-                    print(f"        ❌ trigger 中未找到: {var_path}")
-            
-            # 2. 尝试 'db.customer' 相关变量
-            elif var_path.startswith("db.customer."):
-                customer = self.context.db.get("customer")
-                if customer:
-                    field_name = var_path.replace("db.customer.", "")
-                    if hasattr(customer, field_name):
-                        value = getattr(customer, field_name)
-                        print(f"        ✅ 从 db.customer 解析: {var_path} -> {value}")
-                        return str(value) if value is not None else ""
-                    else:
-                        print(f"        ❌ customer 对象没有字段: {field_name}")
-                else:
-                    print(f"        ❌ 上下文中没有 customer 对象")
-            
-            # 3. 尝试 'custom_fields' 相关变量
-            elif var_path.startswith("custom_fields."):
-                customer = self.context.db.get("customer")
-                if customer and hasattr(customer, 'custom_fields'):
-                    field_name = var_path.replace("custom_fields.", "")
-                    custom_fields = customer.custom_fields or {}
-                    value = custom_fields.get(field_name)
-                    if value is not None:
-                        print(f"        ✅ 从 custom_fields 解析: {var_path} -> {value}")
-                        return str(value)
-                    else:
-                        print(f"        ❌ custom_fields 中未找到: {field_name}")
-                else:
-                    print(f"        ❌ customer 对象没有 custom_fields")
-            
-            # 4. 尝试从 AI 输出中解析
-            elif var_path.startswith("ai."):
-                ai_data = self.context.ai
-                value = get_nested_value(ai_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"        ✅ 从 ai 解析: {var_path} -> {value}")
-                    return str(value)
-                else:
-                    print(f"        ❌ ai 中未找到: {var_path}")
-            
-            # 5. 尝试从 API 响应中解析
-            elif var_path.startswith("api."):
-                api_data = self.context.get("api.response", {})
-                value = get_nested_value(api_data, var_path.split('.')[1:])
-                if value is not None:
-                    print(f"        ✅ 从 api.response 解析: {var_path} -> {value}")
-                    return str(value)
-                else:
-                    print(f"        ❌ api.response 中未找到: {var_path}")
+            var_path = match.group(1)
+            logger.debug("🔍 解析变量: %s", var_path)
             
-            # 6. 直接从上下文变量中查找
+            # 按首段分派到对应的数据源；无匹配的首段直接从上下文变量中查找
+            head, sep, rest = var_path.partition('.')
+            resolver = _CUSTOM_API_VAR_RESOLVERS.get(head) if sep else None
+            if resolver is not None:
+                value = resolver(self, rest)
             else:
                 value = self.context.get(var_path)
-                if value is not None:
-                    print(f"        ✅ 从 context 解析: {var_path} -> {value}")
-                    return str(value)
-                else:
-                    print(f"        ❌ context 中未找到: {var_path}")
+            if value is not None:
+                logger.debug("✅ 解析成功: %s -> %s", var_path, value)
+                return str(value)
             
             # 如果找不到变量，返回原始文本
-            print(f"        ⚠️ 变量未解析，保持原样: {var_path}")
+            logger.debug("⚠️ 变量未解析，保持原样: %s", var_path)
             return f"{{{{{var_path}}}}}"
 
         # 使用正则表达式替换所有 {{variable}} 格式的变量
-        import re
-        result = re.sub(r'\{\{([^}]+)\}\}', replace_match, text)
-        return result
+        return _TEMPLATE_VAR_RE.sub(replace_match, text)
+
+
+class _WorkflowGraph:
+    """由 workflow.edges 预处理得到的图结构"""
+
+    def __init__(self, edges: List[Any]):
+        self.edges = edges
+        self.edge_map: Dict[str, List[str]] = {}
+        self.incoming_count: Dict[str, int] = {}
+        self.start_nodes: Dict[str, Optional[str]] = {}  # 触发类别 -> 起始节点
+        self.pending_by_start: Dict[str, Dict[str, int]] = {}  # 起始节点 -> 可达节点的入边数
+        # 每个节点的 outgoing edge 对象（保留 sourceHandle 等元信息，用于分支路由）
+        self.outgoing_by_source: Dict[str, List[Dict[str, Any]]] = {}
+        # 统一处理两种 edges 格式（dict 列表或数组对）
+        for edge in edges:
+            if isinstance(edge, dict):
+                source = edge.get('source')
+                target = edge.get('target')
+                self.outgoing_by_source.setdefault(source, []).append(edge)
+            else:
+                # 旧格式: [source, target, ...]
+                if len(edge) < 2:
+                    continue
+                source, target = edge[0], edge[1]
+                # 确保兼容旧格式并获取 sourceHandle
+                self.outgoing_by_source.setdefault(source, []).append(
+                    {'source': source, 'target': target, 'sourceHandle': edge[2] if len(edge) > 2 else None}
+                )
+
+            if source is None or target is None:
+                continue
+
+            self.edge_map.setdefault(source, []).append(target)
+            self.incoming_count[target] = self.incoming_count.get(target, 0) + 1
+            self.incoming_count.setdefault(source, self.incoming_count.get(source, 0))
+
+    def start_node_for(self, trigger_type: str, nodes: List[Dict[str, Any]]) -> Optional[str]:
+        """根据触发类型选择起始节点（结果按触发类别缓存）"""
+        # 根据触发类型选择对应的 Trigger 节点
+        trigger_node_type = 'DbTrigger' if trigger_type in ("db_change", "db_scheduled") else 'MessageTrigger'
+        if trigger_node_type in self.start_nodes:
+            return self.start_nodes[trigger_node_type]
+
+        start_node_id = None
+        for n in nodes:
+            if n.get('type') == trigger_node_type:
+                start_node_id = n.get('id')
+                logger.debug("🎯 %s 触发，选择该节点作为起点: %s", trigger_node_type, start_node_id)
+                break
+
+        # 如果没有找到对应的 Trigger 节点，则选入度为 0 的节点
+        if not start_node_id:
+            for n in nodes:
+                nid = n["id"]
+                if self.incoming_count.get(nid, 0) == 0:
+                    start_node_id = nid
+                    logger.debug("🎯 未找到特定 Trigger 节点，选择入度为 0 的节点: %s", start_node_id)
+                    break
+
+        # 最后回退到第一个 edge 的 source（兼容）
+        if not start_node_id:
+            first_edge = self.edges[0]
+            if isinstance(first_edge, dict):
+                start_node_id = first_edge.get('source')
+            else:
+                start_node_id = first_edge[0] if len(first_edge) > 0 else None
+
+        self.start_nodes[trigger_node_type] = start_node_id
+        return start_node_id
+
+    def pending_counts(self, start_node_id: str) -> Dict[str, int]:
+        """从起始节点可达的各节点，来自可达节点的入边数（按起始节点缓存）"""
+        counts = self.pending_by_start.get(start_node_id)
+        if counts is None:
+            reachable = set()
+            stack = [start_node_id]
+            while stack:
+                node_id = stack.pop()
+                if node_id not in reachable:
+                    reachable.add(node_id)
+                    stack.extend(self.edge_map.get(node_id, []))
+            counts = dict.fromkeys(reachable, 0)
+            for source in reachable:
+                for target in self.edge_map.get(source, []):
+                    counts[target] += 1
+            self.pending_by_start[start_node_id] = counts
+        return counts
+
+
+class _DependencyScheduler:
+    """
+    一次工作流执行中的节点调度状态
+    
+    节点的每条入边在前驱结束时确定为存活（前驱选中了它）或死边（前驱未选中，或前驱本身不会执行）。
+    全部入边确定、且至少一条存活时节点进入下一波；全部为死边时节点不执行，并把死边继续向下传播。
+    因此汇合节点会等待所有仍可能执行的分支，并且只执行一次。
+    """
+
+    def __init__(self, graph: _WorkflowGraph, start_node_id: str):
+        self.graph = graph
+        self.remaining = dict(graph.pending_counts(start_node_id))
+        self.live: Dict[str, None] = {}  # 已有存活入边的节点（保持到达顺序）
+        self.finished = set()  # 已执行或确定不会执行的节点
+        self.ready = [start_node_id]
+
+    def next_wave(self, nodes_dict: Dict[str, Any]) -> List[str]:
+        """取出下一批可以执行的节点；没有时返回空列表"""
+        wave = []
+        while not wave:
+            if not self.ready:
+                self.ready = self._blocked_nodes()
+                if not self.ready:
+                    break
+            ready, self.ready = self.ready, []
+            for node_id in dict.fromkeys(ready):
+                if node_id in self.finished:
+                    continue
+                if node_id in nodes_dict:
+                    self.finished.add(node_id)
+                    wave.append(node_id)
+                else:
+                    # edges 指向不存在的节点：视为不执行，其出边均为死边
+                    self.complete(node_id, ())
+        return wave
+
+    def complete(self, node_id: str, selected: List[str]):
+        """节点结束：selected 中的后继为存活边，其余出边为死边"""
+        self.finished.add(node_id)
+        stack = [(node_id, set(selected))]
+        while stack:
+            source, selected_targets = stack.pop()
+            for target in self.graph.edge_map.get(source, []):
+                if target in self.finished:
+                    continue
+                if target in selected_targets:
+                    self.live[target] = None
+                self.remaining[target] = self.remaining.get(target, 1) - 1
+                if self.remaining[target] > 0:
+                    continue
+                if target in self.live:
+                    self.ready.append(target)
+                else:
+                    self.finished.add(target)
+                    stack.append((target, ()))
+
+    def _blocked_nodes(self) -> List[str]:
+        # 图中有环时，环上的节点互相等待入边；已有存活入边的节点直接放行，每个节点仍只执行一次
+        blocked = [node_id for node_id in self.live if node_id not in self.finished]
+        if blocked:
+            logger.warning("⚠️ 工作流存在环，以下节点未等待全部前驱即执行: %s", blocked)
+        return blocked
+
+
+# 工作流 ID -> (updated_at, 图结构)；工作流被编辑后 updated_at 变化，缓存随之失效
+_GRAPH_CACHE: Dict[int, tuple] = {}
+
+
+def _get_workflow_graph(workflow: Workflow) -> _WorkflowGraph:
+    """获取工作流的图结构，未缓存或工作流已更新时重建"""
+    version = getattr(workflow, 'updated_at', None)
+    cached = _GRAPH_CACHE.get(workflow.id)
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1]
+    graph = _WorkflowGraph(workflow.edges)
+    _GRAPH_CACHE[workflow.id] = (version, graph)
+    return graph
+
+
+# 单个节点扇出时同时执行的分支数上限
+_MAX_PARALLEL_BRANCHES = 8
 
 
 class WorkflowEngine:
     """工作流引擎"""
     
+    # 节点类型 -> 处理器类；SendMessage 节点的渠道由 SendMessageProcessor 自行分派
+    PROCESSORS = {
+        "MessageTrigger": MessageTriggerProcessor,
+        "DbTrigger": DbTriggerProcessor,  # 新增：数据库触发器处理器
+        "StatusTrigger": DbTriggerProcessor,  # 向后兼容：旧的StatusTrigger使用DbTrigger处理器
+        "AI": AIProcessor,
+        "Condition": ConditionProcessor,
+        "UpdateDB": UpdateDBProcessor,
+        "Delay": DelayProcessor,
+        "SendWhatsAppMessage": SendWhatsAppMessageProcessor,
+        "SendTelegramMessage": SendTelegramMessageProcessor, # 添加 Telegram 消息发送处理器
+        "SendMessage": SendMessageProcessor,  # 添加通用消息发送处理器
+        "Template": TemplateProcessor,
+        "GuardrailValidator": GuardrailValidatorProcessor,
+        "CustomAPI": CustomAPIProcessor # 新增：自定义API处理器
+    }
+    
     def __init__(self, db: Session):
         self.db = db
-        self.processors = {
-            "MessageTrigger": MessageTriggerProcessor,
-            "DbTrigger": DbTriggerProcessor,  # 新增：数据库触发器处理器
-            "StatusTrigger": DbTriggerProcessor,  # 向后兼容：旧的StatusTrigger使用DbTrigger处理器
-            "AI": AIProcessor,
-            "Condition": ConditionProcessor,
-            "UpdateDB": UpdateDBProcessor,
-            "Delay": DelayProcessor,
-            "SendWhatsAppMessage": SendWhatsAppMessageProcessor,
-            "SendTelegramMessage": SendTelegramMessageProcessor, # 添加 Telegram 消息发送处理器
-            "SendMessage": SendMessageProcessor,  # 添加通用消息发送处理器
-            "Template": TemplateProcessor,
-            "GuardrailValidator": GuardrailValidatorProcessor,
-            "CustomAPI": CustomAPIProcessor # 新增：自定义API处理器
-        }
+        self.processors = self.PROCESSORS
     
     @retry_on_failure(max_retries=3, delay=1.0)
     async def execute_workflow(self, workflow_id: int, trigger_data: Dict[str, Any]) -> WorkflowExecution:
         """执行工作流"""
         execution_start_time = datetime.utcnow()
-        logger.info(f"🔄 工作流執行開始 - ID: {workflow_id}, 觸發資料: {trigger_data}")
+        logger.info("🔄 工作流執行開始 - ID: %s, 觸發資料: %s", workflow_id, trigger_data)
         
         # 获取工作流定义（使用优化的查询）
         try:
@@ -4807,13 +5423,13 @@ class WorkflowEngine:
             ).first()
             
             if not workflow:
-                logger.error(f"工作流 {workflow_id} 未找到或未啟用")
+                logger.error("工作流 %s 未找到或未啟用", workflow_id)
                 raise ValueError(f"Workflow {workflow_id} not found or not active")
             
-            logger.info(f"✅ 工作流找到: {workflow.name} (節點數: {len(workflow.nodes)}, 邊數: {len(workflow.edges)})")
+            logger.info("✅ 工作流找到: %s (節點數: %s, 邊數: %s)", workflow.name, len(workflow.nodes), len(workflow.edges))
             
         except SQLAlchemyError as e:
-            logger.error(f"数据库查询工作流失败: {e}")
+            logger.error("数据库查询工作流失败: %s", e)
             raise e
         
         # 创建执行记录（使用安全的数据库操作）
@@ -4831,19 +5447,17 @@ class WorkflowEngine:
                 self.db.add(execution)
                 self.db.flush()  # 获取 ID 但不提交
                 execution_id = execution.id
-                
-            # 刷新执行记录
-            execution = self.db.query(WorkflowExecution).filter(WorkflowExecution.id == execution_id).first()
+            # 提交后直接沿用会话中的 execution 实例，不再按 ID 重新查询
             
         except Exception as e:
-            logger.error(f"创建工作流执行记录失败: {e}")
+            logger.error("创建工作流执行记录失败: %s", e)
             raise e
         
         # 创建执行上下文
         context = WorkflowContext()
         context.set("trigger_data", trigger_data)
         context.set("workflow_id", workflow_id)
-        context.set("execution_id", execution.id)
+        context.set("execution_id", execution_id)
         
         try:
             # 按照 edges 定义的顺序执行节点
@@ -4854,151 +5468,24 @@ class WorkflowEngine:
             if not edges:
                 raise ValueError("Workflow has no edges defined")
             
-            # 处理 edges 列表，构建 edge_map 并选择合适的起始节点
-            edge_map = {}
-            incoming_count = {}
-            # 统一处理两种 edges 格式（dict 列表或数组对）
-            for edge in edges:
-                if isinstance(edge, dict):
-                    source = edge.get('source')
-                    target = edge.get('target')
+            # 图结构（edge_map / 入度 / 起始节点）按工作流版本缓存，只在工作流被编辑后重建
+            graph = _get_workflow_graph(workflow)
+            start_node_id = graph.start_node_for(trigger_data.get("trigger_type", "message"), workflow.nodes)
+
+            # 按依赖分波执行：节点的所有存活前驱都结束后才执行，条件节点未选中的分支不会阻塞汇合节点；
+            # 同一波的节点相互独立，并发执行
+            scheduler = _DependencyScheduler(graph, start_node_id)
+            wave = scheduler.next_wave(nodes_dict) if start_node_id else []
+            while wave:
+                if len(wave) == 1:
+                    await self._execute_node(execution, nodes_dict[wave[0]], context)
                 else:
-                    # 旧格式: [source, target, ...]
-                    if len(edge) < 2:
-                        continue
-                    source, target = edge[0], edge[1]
-
-                if source is None or target is None:
-                    continue
-
-                edge_map.setdefault(source, []).append(target)
-                incoming_count[target] = incoming_count.get(target, 0) + 1
-                incoming_count.setdefault(source, incoming_count.get(source, 0))
-
-            # 🔧 根据触发类型选择合适的起始节点
-            start_node_id = None
-            trigger_type = trigger_data.get("trigger_type", "message")
-            
-            # 根据触发类型选择对应的 Trigger 节点
-            if trigger_type in ("db_change", "db_scheduled"):
-                # DB Trigger：寻找 DbTrigger 节点
-                for n in workflow.nodes:
-                    if n.get('type') == 'DbTrigger':
-                        start_node_id = n.get('id')
-                        print(f"  🎯 DB Trigger 触发，选择 DbTrigger 节点作为起点: {start_node_id}")
-                        break
-            else:
-                # Message Trigger：寻找 MessageTrigger 节点
-                for n in workflow.nodes:
-                    if n.get('type') == 'MessageTrigger':
-                        start_node_id = n.get('id')
-                        print(f"  🎯 Message Trigger 触发，选择 MessageTrigger 节点作为起点: {start_node_id}")
-                        break
-
-            # 如果没有找到对应的 Trigger 节点，则选入度为 0 的节点
-            if not start_node_id:
-                for nid in nodes_dict.keys():
-                    if incoming_count.get(nid, 0) == 0:
-                        start_node_id = nid
-                        print(f"  🎯 未找到特定 Trigger 节点，选择入度为 0 的节点: {start_node_id}")
-                        break
-
-            # 最后回退到第一个 edge 的 source（兼容）
-            if not start_node_id:
-                first_edge = edges[0]
-                if isinstance(first_edge, dict):
-                    start_node_id = first_edge.get('source')
-                else:
-                    start_node_id = first_edge[0] if len(first_edge) > 0 else None
-
-            current_node_id = start_node_id
-            
-            # 执行节点序列
-            while current_node_id:
-                if current_node_id not in nodes_dict:
-                    break
-                
-                node = nodes_dict[current_node_id]
-                await self._execute_node(execution, node, context)
-                
-                # 根据节点类型和结果决定下一个节点
-                next_nodes = edge_map.get(current_node_id, [])
-                
-                # Debug: 打印边连接信息
-                print(f"  🔍 节点 {current_node_id} 的下一个节点: {next_nodes}")
-                print(f"  🔍 完整边映射: {edge_map}")
-                
-                if not next_nodes:
-                    print(f"  ⚠️ 节点 {current_node_id} 没有下一个节点，工作流结束")
-                    break
+                    logger.debug("🔀 并行执行节点: %s", wave)
+                    await self._execute_parallel_nodes(execution, wave, nodes_dict, context)
                 
-                # 支持基于 Condition 的 true/false 分支路由：
-                # - 如果当前节点有显式分支化的 outgoing edges（edge id 包含 true/false 或 edge dict 有 sourceHandle），
-                #   则只在能找到与当前分支匹配的 edge 时继续执行对应目标；否则停止执行（不回退到第一个 target）。
-                # - 如果没有任何分支化的 outgoing edges，则保留兼容行为，取第一个 target。
-                branch_key = f'__branch__{current_node_id}'
-                branch_val = context.get(branch_key)
-
-                # 查找该节点的所有 outgoing edge 对象（使用原始 edges 列表以获取元信息）
-                outgoing_edges = []
-                if edges and isinstance(edges, list):
-                    for e in edges:
-                        try:
-                            if isinstance(e, dict):
-                                if e.get('source') == current_node_id:
-                                    outgoing_edges.append(e)
-                            else:
-                                # 兼容旧格式数组 [source, target]
-                                if len(e) >= 2 and e[0] == current_node_id:
-                                    outgoing_edges.append({'source': e[0], 'target': e[1], 'sourceHandle': e[2] if len(e) > 2 else None}) # 确保兼容旧格式并获取 sourceHandle
-                        except Exception:
-                            continue
-
-                # 判断是否存在真正的分支化 edge（通过 sourceHandle 为 true/false 标识）
-                has_conditional_branch_edges = any(
-                    isinstance(e, dict) and e.get('sourceHandle') in ['true', 'false']
-                    for e in outgoing_edges
-                )
-
-                selected_next_nodes = []
-                if has_conditional_branch_edges:
-                    # 仅在 branch_val 可用时尝试匹配条件分支
-                    if branch_val is not None:
-                        for e in outgoing_edges:
-                            try:
-                                # match by explicit sourceHandle for true/false branches
-                                if isinstance(e, dict) and e.get('sourceHandle') in ['true', 'false']:
-                                    if str(e.get('sourceHandle')).lower() == str(branch_val).lower():
-                                        selected_next_nodes.append(e.get('target'))
-                            except Exception:
-                                continue
-                    
-                    # 如果存在条件分支边但未找到匹配，则停止执行（不回退）
-                    if not selected_next_nodes:
-                        print(f"  ⚠️ 条件分支节点 {current_node_id} 没有找到匹配的分支 '{branch_val}'，工作流结束")
-                        current_node_id = None
-                    else:
-                        # 如果有多个匹配的分支，需要并行执行
-                        if len(selected_next_nodes) > 1:
-                            print(f"  🔀 节点 {current_node_id} 有多个分支需要并行执行: {selected_next_nodes}")
-                            # 并行执行所有匹配的分支节点
-                            for next_node_id in selected_next_nodes[1:]:  # 从第二个开始并行执行
-                                if next_node_id in nodes_dict:
-                                    print(f"  🚀 并行执行分支节点: {next_node_id}")
-                                    await self._execute_node(execution, nodes_dict[next_node_id], context)
-                        # 继续执行第一个分支
-                        current_node_id = selected_next_nodes[0]
-                else:
-                    # 非条件分支：检查是否有多个并行的输出节点
-                    if len(next_nodes) > 1:
-                        print(f"  🔀 节点 {current_node_id} 有多个并行输出: {next_nodes}")
-                        # 并行执行除第一个外的所有节点
-                        for next_node_id in next_nodes[1:]:
-                            if next_node_id in nodes_dict:
-                                print(f"  🚀 并行执行节点: {next_node_id}")
-                                await self._execute_node(execution, nodes_dict[next_node_id], context)
-                    # 继续执行第一个节点
-                    current_node_id = next_nodes[0] if next_nodes else None
+                for node_id in wave:
+                    scheduler.complete(node_id, self._select_next_nodes(node_id, graph, context))
+                wave = scheduler.next_wave(nodes_dict)
             
             # 标记执行完成
             execution_end_time = datetime.utcnow()
@@ -5034,13 +5521,13 @@ class WorkflowEngine:
                                 executed_at=execution_end_time
                             )
                             self.db.add(db_trigger_exec)
-                            print(f"  📝 记录 DbTrigger 执行: workflow_id={workflow_id}, customer_id={customer_id}")
+                            logger.debug("📝 记录 DbTrigger 执行: workflow_id=%s, customer_id=%s", workflow_id, customer_id)
                     
-                logger.info(f"✅ 工作流執行完成 - ID: {workflow_id}, 耗時: {execution_duration:.2f}秒")
+                logger.info("✅ 工作流執行完成 - ID: %s, 耗時: %.2f秒", workflow_id, execution_duration)
                 return execution
                 
             except Exception as db_error:
-                logger.error(f"更新工作流完成状态失败: {db_error}")
+                logger.error("更新工作流完成状态失败: %s", db_error)
                 # 即使数据库更新失败，工作流实际上已经成功执行
                 return execution
             
@@ -5051,7 +5538,7 @@ class WorkflowEngine:
             error_details = {
                 "error": str(e),
                 "type": type(e).__name__,
-                "traceback": traceback.format_exc()
+                "traceback": _format_traceback(e)
             }
             
             try:
@@ -5067,77 +5554,149 @@ class WorkflowEngine:
                         execution.execution_data = {"error_details": error_details}
                         
             except Exception as db_error:
-                logger.error(f"更新工作流失败状态时出错: {db_error}")
+                logger.error("更新工作流失败状态时出错: %s", db_error)
             
-            logger.error(f"❌ 工作流執行失敗 - ID: {workflow_id}, 耗時: {execution_duration:.2f}秒, 錯誤: {str(e)}")
-            logger.debug(f"工作流执行失败详细信息: {error_details}")
+            logger.error("❌ 工作流執行失敗 - ID: %s, 耗時: %.2f秒, 錯誤: %s", workflow_id, execution_duration, e)
+            logger.debug("工作流执行失败详细信息: %s", error_details)
             raise e
+        finally:
+            context.processors.clear()
     
+    def _select_next_nodes(self, current_node_id: str, graph: "_WorkflowGraph", context: WorkflowContext) -> List[str]:
+        """根据节点类型和结果决定下一批节点"""
+        next_nodes = graph.edge_map.get(current_node_id, [])
+        
+        # Debug: 打印边连接信息
+        logger.debug("🔍 节点 %s 的下一个节点: %s", current_node_id, next_nodes)
+        
+        if not next_nodes:
+            logger.debug("⚠️ 节点 %s 没有下一个节点，分支结束", current_node_id)
+            return []
+        
+        # 支持基于 Condition 的 true/false 分支路由：
+        # - 如果当前节点有显式分支化的 outgoing edges（edge dict 有 sourceHandle），
+        #   则只沿与当前分支匹配的 edge 继续执行；找不到匹配时该分支结束（不回退到其他 target）。
+        # - 如果没有任何分支化的 outgoing edges，则所有 target 都作为下一批节点。
+        branch_val = context.get(f'__branch__{current_node_id}')
+
+        # 该节点的所有 outgoing edge 对象（构建图结构时已按 source 分组）
+        outgoing_edges = graph.outgoing_by_source.get(current_node_id, [])
+
+        # 判断是否存在真正的分支化 edge（通过 sourceHandle 为 true/false 标识）
+        has_conditional_branch_edges = any(
+            isinstance(e, dict) and e.get('sourceHandle') in ['true', 'false']
+            for e in outgoing_edges
+        )
+        if not has_conditional_branch_edges:
+            return next_nodes
+
+        selected_next_nodes = []
+        # 仅在 branch_val 可用时尝试匹配条件分支
+        if branch_val is not None:
+            for e in outgoing_edges:
+                # match by explicit sourceHandle for true/false branches
+                if isinstance(e, dict) and e.get('sourceHandle') in ['true', 'false']:
+                    if str(e.get('sourceHandle')).lower() == str(branch_val).lower():
+                        selected_next_nodes.append(e.get('target'))
+        
+        if not selected_next_nodes:
+            logger.debug("⚠️ 条件分支节点 %s 没有找到匹配的分支 '%s'，分支结束", current_node_id, branch_val)
+        return selected_next_nodes
+
+    async def _execute_parallel_nodes(self, execution: WorkflowExecution, node_ids: List[str], nodes_dict: Dict[str, Any], context: WorkflowContext):
+        """
+        并发执行多个相互独立的分支节点
+        
+        - 每个分支使用上下文副本，全部完成后按节点顺序合并回 context，分支之间不会互相覆盖变量；
+        - 各分支共享同一个同步 Session：读写数据库的节点（USES_DB）持有 db_lock 逐个执行，
+          其余节点（如 CustomAPI、Condition）并发执行，只在写步骤记录时短暂获取该锁，
+          因此一个分支的提交或回滚不会带上另一个分支未完成的写入；
+        - 某个分支失败时，等其余分支全部结束后再抛出第一个异常。
+        """
+        semaphore = asyncio.Semaphore(_MAX_PARALLEL_BRANCHES)
+        db_lock = asyncio.Lock()
+        base = context.fork()
+        branches = [(node_id, context.fork()) for node_id in node_ids if node_id in nodes_dict]
+
+        async def run(node_id: str, branch_context: WorkflowContext):
+            async with semaphore:
+                logger.debug("🚀 并行执行节点: %s", node_id)
+                node = nodes_dict[node_id]
+                processor_class = self.processors.get(node["type"])
+                if processor_class is None or processor_class.USES_DB:
+                    async with db_lock:
+                        await self._execute_node(execution, node, branch_context)
+                else:
+                    await self._execute_node(execution, node, branch_context, db_lock=db_lock)
+
+        # 等所有分支结束后再抛出失败：否则失败路径会在兄弟分支仍持有 db_lock 写入时提交或回滚共享会话
+        results = await asyncio.gather(
+            *(run(node_id, branch_context) for node_id, branch_context in branches),
+            return_exceptions=True,
+        )
+        errors = []
+        for (node_id, branch_context), result in zip(branches, results):
+            if isinstance(result, BaseException):
+                logger.error("❌ 并行分支节点 %s 执行失败: %s", node_id, result)
+                errors.append(result)
+            else:
+                context.merge_fork(branch_context, base)
+        if errors:
+            raise errors[0]
+
     @retry_on_failure(max_retries=2, delay=0.5)
-    async def _execute_node(self, execution: WorkflowExecution, node: Dict[str, Any], context: WorkflowContext):
-        """执行单个节点"""
+    async def _execute_node(self, execution: WorkflowExecution, node: Dict[str, Any], context: WorkflowContext, db_lock: Optional[asyncio.Lock] = None):
+        """执行单个节点；db_lock 仅在并行分支中传入，用于与其他分支串行化会话的提交"""
         node_id = node["id"]
         node_type = node["type"]
         
-        logger.info(f"📦 執行節點 - ID: {node_id}, 類型: {node_type}")
-        logger.debug(f"節點配置: {node}")
+        logger.info("📦 執行節點 - ID: %s, 類型: %s", node_id, node_type)
+        logger.debug("節點配置: %s", node)
+        
+        # 步骤执行记录先在内存中构建，节点结束时连同结果一次写入（一次提交代替插入、回查、更新三次往返）；
+        # 执行 ID 取自上下文，避免访问提交后已过期的 execution 触发重新加载
+        start_time = datetime.utcnow()  # 同时作为步骤的 started_at 与耗时计算起点
+        step = WorkflowStepExecution(
+            execution_id=context.get("execution_id") or execution.id,
+            node_id=node_id,
+            node_type=node_type,
+            status="running",
+            input_data=node,
+            started_at=start_time
+        )
         
-        # 创建步骤执行记录（使用安全的数据库操作）
-        step = None
         try:
-            async with safe_db_operation(self.db, "create_step_execution"):
-                step = WorkflowStepExecution(
-                    execution_id=execution.id,
-                    node_id=node_id,
-                    node_type=node_type,
-                    status="running",
-                    input_data=node,
-                    started_at=datetime.utcnow()
-                )
-                self.db.add(step)
-                self.db.flush()  # 获取 ID 但不提交
-                step_id = step.id
-                
-            # 刷新步骤记录
-            step = self.db.query(WorkflowStepExecution).filter(WorkflowStepExecution.id == step_id).first()
-            
-        except Exception as e:
-            logger.error(f"创建节点执行记录失败: {e}")
-            raise e
-        
-        try:
-            start_time = datetime.utcnow()
-            
             # 获取处理器类
             processor_class = self.processors.get(node_type)
             if not processor_class:
-                # 根据 channel 动态选择处理器
-                if node_type == "SendMessage" and node.get("data", {}).get("channel") == "telegram":
-                    processor_class = SendTelegramMessageProcessor
-                elif node_type == "SendMessage" and node.get("data", {}).get("channel") == "whatsapp":
-                    processor_class = SendWhatsAppMessageProcessor
-                else:
-                    print(f"    ❌ 不支援的節點類型: {node_type}")
-                    raise ValueError(f"Unsupported node type: {node_type}")
+                logger.error("❌ 不支援的節點類型: %s", node_type)
+                raise ValueError(f"Unsupported node type: {node_type}")
             
-            print(f"    🚀 創建處理器: {processor_class.__name__}")
+            logger.debug("🚀 創建處理器: %s", processor_class.__name__)
             
-            # 创建处理器并执行
-            processor = processor_class(self.db, context)
-            print(f"    ⏳ 開始執行節點...")
+            # 获取（按需创建）处理器并执行：无状态处理器缓存在上下文上，随本次执行结束释放
+            if processor_class.STATELESS:
+                processor = context.processors.get(processor_class)
+                if processor is None:
+                    processor = context.processors[processor_class] = processor_class(self.db, context)
+            else:
+                processor = processor_class(self.db, context)
+            processor.db_lock = db_lock
+            logger.debug("⏳ 開始執行節點...")
             output_data = await processor.execute(node)
             # print(f"    ✅ 節點執行完成，輸出: {output_data}")
             
             # 更新上下文
             context.update_from_dict(output_data)
-            print(f"    📝 上下文已更新")
+            logger.debug("📝 上下文已更新")
             
             # 记录执行结果
             end_time = datetime.utcnow()
             duration_ms = int((end_time - start_time).total_seconds() * 1000)
             
             try:
-                async with safe_db_operation(self.db, "complete_step_execution"):
+                async with (db_lock or nullcontext()), safe_db_operation(self.db, "complete_step_execution"):
+                    self.db.add(step)
                     step.status = "completed"
                     step.output_data = serialize_for_json(output_data)  # 使用序列化函数
                     step.completed_at = end_time
@@ -5148,10 +5707,10 @@ class WorkflowEngine:
                     if context.get(branch_key):
                         step.branch_taken = context.get(branch_key)
                         
-                logger.info(f"✅ 節點執行完成 - ID: {node_id}, 耗時: {duration_ms}ms")
+                logger.info("✅ 節點執行完成 - ID: %s, 耗時: %sms", node_id, duration_ms)
                 
             except Exception as db_error:
-                logger.error(f"更新节点完成状态失败: {db_error}")
+                logger.error("更新节点完成状态失败: %s", db_error)
                 # 继续执行，不因为数据库更新失败而中断工作流
             
         except Exception as e:
@@ -5161,12 +5720,13 @@ class WorkflowEngine:
             error_details = {
                 "error": str(e),
                 "type": type(e).__name__,
-                "traceback": traceback.format_exc(),
+                "traceback": _format_traceback(e),
                 "node_config": node
             }
             
             try:
-                async with safe_db_operation(self.db, "fail_step_execution"):
+                async with (db_lock or nullcontext()), safe_db_operation(self.db, "fail_step_execution"):
+                    self.db.add(step)
                     step.status = "failed"
                     step.error_message = str(e)
                     step.completed_at = end_time
@@ -5175,25 +5735,8 @@ class WorkflowEngine:
                     step.output_data = serialize_for_json({"error_details": error_details})
                     
             except Exception as db_error:
-                logger.error(f"更新节点失败状态时出错: {db_error}")
+                logger.error("更新节点失败状态时出错: %s", db_error)
             
-            logger.error(f"❌ 節點執行失敗 - ID: {node_id}, 類型: {node_type}, 耗時: {duration_ms}ms, 錯誤: {str(e)}")
-            logger.debug(f"节点执行失败详细信息: {error_details}")
+            logger.error("❌ 節點執行失敗 - ID: %s, 類型: %s, 耗時: %sms, 錯誤: %s", node_id, node_type, duration_ms, e)
+            logger.debug("节点执行失败详细信息: %s", error_details)
             raise e
-
-    def _resolve_variable_from_context(self, variable_path: str, default: Any = None) -> Any:
-        # 支持: trigger.X, db.customer.field, ai.field
-        try:
-            if variable_path.startswith('trigger.'):
-                return self.context.get('trigger_data', {}).get(variable_path.split('.', 1)[1])
-            if variable_path.startswith('db.customer.'):
-                customer = self.context.db.get('customer')
-                if customer:
-                    return getattr(customer, variable_path.split('.', 2)[2], None)
-                return None
-            if variable_path.startswith('ai.'):
-                return self.context.get('ai', {}).get(variable_path.split('.', 1)[1])
-            # fallback to variables
-            return self.context.get(variable_path)
-        except Exception:
-            return default
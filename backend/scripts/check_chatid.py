@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import json
+from sqlalchemy import String, cast, or_
 from app.db.database import SessionLocal
 from app.db.models import Customer
 
@@ -8,19 +9,21 @@ def main(chat_id: str):
     db = SessionLocal()
     try:
         found = False
-        for c in db.query(Customer).all():
-            try:
-                cf = c.custom_fields or {}
-            except Exception:
-                cf = {}
-            if str(cf.get('telegram_chat_id')) == str(chat_id) or str(getattr(c, 'telegram_chat_id', '')) == str(chat_id):
-                print(json.dumps({
-                    'id': c.id,
-                    'name': c.name,
-                    'phone': c.phone,
-                    'custom_fields': cf
-                }, ensure_ascii=False))
-                found = True
+        # 在数据库中按列或 custom_fields 中的 telegram_chat_id 过滤，不再把整张客户表拉到本地逐行比较。
+        # JSON 值转为文本后数字为 123、字符串为 "123"（PostgreSQL 与 SQLite 一致），两种形式都匹配
+        chat_id = str(chat_id)
+        customers = db.query(Customer).filter(or_(
+            Customer.telegram_chat_id == chat_id,
+            cast(Customer.custom_fields['telegram_chat_id'], String).in_((chat_id, json.dumps(chat_id))),
+        ))
+        for c in customers:
+            print(json.dumps({
+                'id': c.id,
+                'name': c.name,
+                'phone': c.phone,
+                'custom_fields': c.custom_fields or {}
+            }, ensure_ascii=False))
+            found = True
         if not found:
             print('NOT_FOUND')
     finally:
@@ -3,10 +3,13 @@ import sys
 import requests
 import json
 
+# 复用连接（keep-alive），被其他脚本导入多次调用 main 时不必每次重新握手 TLS
+_session = requests.Session()
+
 def main(token: str):
     url = f"https://api.telegram.org/bot{token}/getUpdates"
     try:
-        r = requests.get(url, timeout=15)
+        r = _session.get(url, timeout=15)
         r.raise_for_status()
         data = r.json()
     except Exception as e:
@@ -1,10 +1,14 @@
 import asyncio
 import base64
+import binascii
 import os
 from app.db.database import SessionLocal
 from app.services.settings import SettingsService
 from telethon import TelegramClient
 
+# 每次解码的 base64 字符数，需为 4 的倍数以保证分块边界对齐
+_B64_CHUNK = 64 * 1024
+
 
 def main(user_id: int = 1):
     db = SessionLocal()
@@ -26,10 +30,18 @@ def main(user_id: int = 1):
 
     path = f'/tmp/tg_{user_id}.session'
     try:
-        data = base64.b64decode(sess_b64)
+        # 分块解码直接写入文件，避免同时持有 base64 字符串和完整解码结果；
+        # 严格校验字符，数据损坏时立即失败，而不是等 Telethon 连接后才报错
         with open(path, 'wb') as fh:
-            fh.write(data)
+            for i in range(0, len(sess_b64), _B64_CHUNK):
+                fh.write(base64.b64decode(sess_b64[i:i + _B64_CHUNK], validate=True))
+        del sess_b64
         print('Wrote session file to', path)
+    except (binascii.Error, ValueError) as e:
+        print('Invalid base64 session in DB:', e)
+        if os.path.exists(path):
+            os.remove(path)
+        return
     except Exception as e:
         print('Failed to write session file:', e)
         return
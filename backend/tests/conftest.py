@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 测试直接导入 app 包；Settings 的必填项给占位值，测试不会连接这些服务
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "test")
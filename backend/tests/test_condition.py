@@ -0,0 +1,171 @@
+"""Condition 节点：编译后的条件与原逐次解释求值的结果一致"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+engine = pytest.importorskip("app.services.workflow_engine")
+from app.db.models import Customer
+
+
+def reference_evaluate(operator, value, actual_value):
+    """编译前 ConditionProcessor._evaluate_condition 的比较逻辑"""
+    try:
+        if operator == '==':
+            return str(actual_value) == str(value)
+        elif operator == '!=':
+            return str(actual_value) != str(value)
+        elif operator == '>':
+            return float(actual_value or 0) > float(value or 0)
+        elif operator == '>=':
+            return float(actual_value or 0) >= float(value or 0)
+        elif operator == '<':
+            return float(actual_value or 0) < float(value or 0)
+        elif operator == '<=':
+            return float(actual_value or 0) <= float(value or 0)
+        elif operator == 'contains':
+            return str(value).lower() in str(actual_value or '').lower()
+        elif operator == 'starts_with':
+            return str(actual_value or '').lower().startswith(str(value).lower())
+        elif operator == 'ends_with':
+            return str(actual_value or '').lower().endswith(str(value).lower())
+        elif operator == 'is_empty':
+            return not actual_value or str(actual_value).strip() == ''
+        elif operator == 'is_not_empty':
+            return actual_value and str(actual_value).strip() != ''
+        elif operator == 'between':
+            if ',' in str(value):
+                min_val, max_val = str(value).split(',', 1)
+                actual_num = float(actual_value or 0)
+                return float(min_val.strip() or 0) <= actual_num <= float(max_val.strip() or 0)
+            return False
+        elif operator in ('days_ago', 'days_from_now'):
+            if actual_value:
+                try:
+                    if isinstance(actual_value, str):
+                        actual_date = datetime.fromisoformat(actual_value.replace('Z', '+00:00'))
+                    else:
+                        actual_date = actual_value
+                    if operator == 'days_ago':
+                        days_diff = (datetime.utcnow() - actual_date).days
+                    else:
+                        days_diff = (actual_date - datetime.utcnow()).days
+                    return days_diff == int(value or 0)
+                except:
+                    return False
+            return False
+        else:
+            return False
+    except (ValueError, TypeError):
+        return False
+
+
+def reference_jsonlogic(expression, context_vars):
+    """编译前 evaluate_jsonlogic 的实现"""
+    if not isinstance(expression, dict):
+        return bool(expression)
+    if '==' in expression or '!=' in expression:
+        op = '==' if '==' in expression else '!='
+        a, b = expression[op]
+        if isinstance(a, dict) and 'var' in a:
+            a = context_vars.get(a['var'])
+        if isinstance(b, dict) and 'var' in b:
+            b = context_vars.get(b['var'])
+        return a == b if op == '==' else a != b
+    if 'and' in expression:
+        return all(reference_jsonlogic(e, context_vars) for e in expression['and'])
+    if 'or' in expression:
+        return any(reference_jsonlogic(e, context_vars) for e in expression['or'])
+    if 'var' in expression:
+        return context_vars.get(expression['var'])
+    return False
+
+
+# 相对当前时间的日期留出半天余量，避免跨越整天边界
+_THREE_DAYS_AGO = (datetime.utcnow() - timedelta(days=3, hours=12)).isoformat()
+_TWO_DAYS_LATER = (datetime.utcnow() + timedelta(days=2, hours=12)).isoformat()
+
+OPERATOR_CASES = [
+    ('==', 'abc', 'abc'), ('==', 5, '5'), ('==', '', None), ('!=', 'abc', 'abd'), ('!=', 1, 1),
+    ('>', '10', 11), ('>', '10', '9.5'), ('>', '', None), ('>', 'x', 3), ('>', '3', 'x'),
+    ('>=', 10, 10), ('<', '2.5', 2), ('<=', None, 0), ('<=', '1', 'abc'),
+    ('contains', 'Hello', 'say hello world'), ('contains', 'x', None), ('starts_with', 'AB', 'abc'),
+    ('starts_with', 'b', 'abc'), ('ends_with', 'BC', 'abc'), ('ends_with', '', None),
+    ('is_empty', '', '   '), ('is_empty', '', 0), ('is_empty', '', 'x'),
+    ('is_not_empty', '', 'x'), ('is_not_empty', '', ''), ('is_not_empty', '', None),
+    ('between', '1,10', 5), ('between', '1, 10', '11'), ('between', ',10', None), ('between', '1', 5),
+    ('between', '1,abc', 5), ('between', '1,10', 'abc'),
+    ('days_ago', '3', _THREE_DAYS_AGO), ('days_ago', '2', _THREE_DAYS_AGO), ('days_ago', 'x', _THREE_DAYS_AGO),
+    ('days_ago', '3', None), ('days_ago', '3', 'not a date'),
+    ('days_from_now', 2, _TWO_DAYS_LATER), ('days_from_now', 5, _TWO_DAYS_LATER),
+    ('unknown', 'a', 'a'), ('==', ['a'], "['a']"),
+]
+
+
+def make_processor(trigger_data=None, ai=None):
+    context = engine.WorkflowContext()
+    context.set('trigger_data', trigger_data or {})
+    context.set('ai', ai or {})
+    return engine.ConditionProcessor(None, context)
+
+
+@pytest.mark.parametrize("operator,value,actual", OPERATOR_CASES)
+def test_visual_condition_matches_reference(operator, value, actual):
+    processor = make_processor({'field': actual})
+    condition = {'field': 'trigger.field', 'operator': operator, 'value': value}
+    assert bool(processor._evaluate_condition(condition)) == bool(reference_evaluate(operator, value, actual))
+    # 第二次求值命中编译缓存，结果不变
+    assert bool(processor._evaluate_condition(condition)) == bool(reference_evaluate(operator, value, actual))
+
+
+JSONLOGIC_CASES = [
+    {'==': [{'var': 'trigger.message'}, 'hi']},
+    {'!=': [{'var': 'db.customer.status'}, 'new']},
+    {'==': [{'var': 'custom_fields.plan'}, 'gold']},
+    {'and': [{'var': 'ai.is_lead'}, {'==': [{'var': 'db.customer.name'}, 'Alice']}]},
+    {'or': [{'==': [{'var': 'trigger.missing'}, None]}, False]},
+    {'==': [{'var': 'db.customer.photo_url'}, None]},
+    {'var': 'ai.score'},
+    {'unknown': []},
+    True,
+    0,
+]
+
+
+@pytest.mark.parametrize("expression", JSONLOGIC_CASES)
+def test_jsonlogic_matches_reference(expression):
+    trigger = {'message': 'hi', 'chat_id': 42}
+    ai_ctx = {'is_lead': True, 'score': 0}
+    customer = Customer(name='Alice', status='new', custom_fields={'plan': 'gold'})
+
+    eager_vars = {f'trigger.{k}': v for k, v in trigger.items()}
+    for attr in engine._CONDITION_CUSTOMER_ATTRS:
+        eager_vars[f'db.customer.{attr}'] = getattr(customer, attr, None)
+    eager_vars['custom_fields.plan'] = 'gold'
+    eager_vars.update({f'ai.{k}': v for k, v in ai_ctx.items()})
+
+    lazy_vars = engine._LazyConditionVars(trigger, customer, ai_ctx)
+    expected = reference_jsonlogic(expression, eager_vars)
+    assert engine.compile_jsonlogic(expression)(lazy_vars) == expected
+    assert engine.evaluate_jsonlogic(expression, eager_vars) == expected
+
+
+def test_condition_node_branch_matches_reference():
+    processor = make_processor({'budget': '1500', 'message': 'Need a ROOM'})
+    node = {
+        'id': 'c1',
+        'data': {
+            'mode': 'visual',
+            'logicOperator': 'AND',
+            'conditions': [
+                {'field': 'trigger.budget', 'operator': 'between', 'value': '1000,2000'},
+                {'field': 'trigger.message', 'operator': 'contains', 'value': 'room'},
+            ],
+        },
+    }
+    assert asyncio.run(processor.execute(node)) == {'__branch__c1': 'true'}
+    node['data']['logicOperator'] = 'OR'
+    node['data']['conditions'][0]['value'] = '1,2'
+    node['data']['conditions'][1]['value'] = 'house'
+    assert asyncio.run(processor.execute(node)) == {'__branch__c1': 'false'}
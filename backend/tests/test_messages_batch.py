@@ -0,0 +1,101 @@
+"""批量入站消息：单条失败不影响其他消息，工作流在响应之后执行"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("fastapi")
+messages = pytest.importorskip("app.routers.messages")
+from fastapi import BackgroundTasks, HTTPException
+
+
+def test_batch_reports_per_item_results(monkeypatch):
+    stored = []
+
+    async def fake_store(item, db, run_workflows=True):
+        assert run_workflows is False
+        if not item.get("user_id"):
+            raise HTTPException(status_code=400, detail="Missing user_id")
+        stored.append(item["content"])
+        trigger_data = {"user_id": item["user_id"], "chat_id": item["chat_id"], "message": item["content"]}
+        return SimpleNamespace(id=f"m{len(stored)}"), ([7], trigger_data)
+
+    monkeypatch.setattr(messages, "_store_inbound_message", fake_store)
+    background_tasks = BackgroundTasks()
+    batch = [
+        {"user_id": 1, "chat_id": 10, "content": "first"},
+        {"chat_id": 11, "content": "no user"},
+        {"user_id": 1, "chat_id": 10, "content": "second"},
+    ]
+
+    response = asyncio.run(messages.receive_message_batch({"batch": batch}, background_tasks, db=None))
+
+    assert response == {"results": [
+        {"status": "ok", "message_id": "m1"},
+        {"status": "error", "status_code": 400, "detail": "Missing user_id"},
+        {"status": "ok", "message_id": "m2"},
+    ]}
+    assert stored == ["first", "second"]
+    # 只有保存成功的消息进入后台工作流任务
+    assert len(background_tasks.tasks) == 1
+    deferred = background_tasks.tasks[0].args[0]
+    assert [trigger_data["message"] for _, trigger_data in deferred] == ["first", "second"]
+
+
+def test_deferred_workflows_keep_conversation_order(monkeypatch):
+    executed = []
+
+    class FakeEngine:
+        def __init__(self, db):
+            pass
+
+        async def execute_workflow(self, workflow_id, trigger_data):
+            await asyncio.sleep(0)
+            if trigger_data["message"] == "boom":
+                raise RuntimeError("workflow failed")
+            executed.append((trigger_data["chat_id"], trigger_data["message"]))
+
+    closed = []
+    monkeypatch.setattr("app.services.workflow_engine.WorkflowEngine", FakeEngine)
+    monkeypatch.setattr(messages, "SessionLocal", lambda: SimpleNamespace(close=lambda: closed.append(True)))
+
+    deferred = [
+        ([1], {"user_id": 1, "chat_id": 10, "message": "a1"}),
+        ([1], {"user_id": 1, "chat_id": 20, "message": "boom"}),
+        ([1], {"user_id": 1, "chat_id": 10, "message": "a2"}),
+        ([1], {"user_id": 1, "chat_id": 20, "message": "b2"}),
+    ]
+    asyncio.run(messages._run_deferred_workflows(deferred))
+
+    assert [m for chat, m in executed if chat == 10] == ["a1", "a2"]
+    # 同一会话中前一条工作流失败不影响后续消息
+    assert [m for chat, m in executed if chat == 20] == ["b2"]
+    assert len(closed) == 2
+
+
+def test_consecutive_batches_of_same_conversation_run_in_order(monkeypatch):
+    events = []
+
+    class FakeEngine:
+        def __init__(self, db):
+            pass
+
+        async def execute_workflow(self, workflow_id, trigger_data):
+            events.append(("start", trigger_data["message"]))
+            # 第一批的工作流较慢，第二批若不等待会先开始执行
+            await asyncio.sleep(0.05 if trigger_data["message"] == "first" else 0)
+            events.append(("end", trigger_data["message"]))
+
+    monkeypatch.setattr("app.services.workflow_engine.WorkflowEngine", FakeEngine)
+    monkeypatch.setattr(messages, "SessionLocal", lambda: SimpleNamespace(close=lambda: None))
+
+    async def run_two_batches():
+        first = [([1], {"user_id": 1, "chat_id": 10, "message": "first"})]
+        second = [([1], {"user_id": 1, "chat_id": 10, "message": "second"})]
+        await asyncio.gather(messages._run_deferred_workflows(first), messages._run_deferred_workflows(second))
+
+    asyncio.run(run_two_batches())
+
+    assert events == [("start", "first"), ("end", "first"), ("start", "second"), ("end", "second")]
+    assert messages._conversation_locks == {}
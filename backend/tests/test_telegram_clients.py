@@ -0,0 +1,95 @@
+"""工作流发送 Telegram 消息时复用的用户客户端缓存"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+engine = pytest.importorskip("app.services.workflow_engine")
+
+
+class FakeClient:
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self.connected = False
+        self.disconnects = 0
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+        self.disconnects += 1
+
+
+@pytest.fixture(autouse=True)
+def fake_telegram(monkeypatch):
+    monkeypatch.setattr(engine, "TelegramClient", FakeClient)
+    monkeypatch.setattr(engine, "_telegram_clients", {})
+    monkeypatch.setattr(engine, "_telegram_client_locks", {})
+
+
+def use_client(fingerprint, session="s"):
+    return engine._user_telegram_client(1, fingerprint, lambda: session, 0, "")
+
+
+def test_client_is_reused_until_session_changes():
+    async def scenario():
+        async with use_client("a") as first:
+            pass
+        async with use_client("a") as again:
+            pass
+        async with use_client("b", session="relogin") as rebuilt:
+            pass
+        return first, again, rebuilt
+
+    first, again, rebuilt = asyncio.run(scenario())
+    assert first is again
+    assert rebuilt is not first and rebuilt.session == "relogin"
+    assert first.disconnects == 1 and rebuilt.connected
+
+
+def test_send_errors_keep_client_for_other_sends():
+    async def scenario():
+        with pytest.raises(ValueError):
+            async with use_client("a") as first:
+                raise ValueError("invalid entity")
+        async with use_client("a") as again:
+            pass
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    assert first is again and first.connected
+
+
+def test_connection_error_disconnects_after_concurrent_sends_finish():
+    async def scenario():
+        other_send_started = asyncio.Event()
+        release_other_send = asyncio.Event()
+
+        async def other_send():
+            async with use_client("a") as client:
+                other_send_started.set()
+                await release_other_send.wait()
+                assert client.connected
+            return client
+
+        task = asyncio.ensure_future(other_send())
+        await other_send_started.wait()
+        with pytest.raises(ConnectionError):
+            async with use_client("a"):
+                raise ConnectionError("connection lost")
+        shared = engine._telegram_clients.get(1)
+        release_other_send.set()
+        client = await task
+        async with use_client("a") as fresh:
+            pass
+        return shared, client, fresh
+
+    shared, client, fresh = asyncio.run(scenario())
+    # 失效的客户端立即移出缓存，但直到另一个发送结束才断开
+    assert shared is None
+    assert client.disconnects == 1
+    assert fresh is not client
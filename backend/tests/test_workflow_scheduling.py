@@ -0,0 +1,91 @@
+"""工作流节点调度：汇合节点只执行一次，未选中的分支不执行"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+engine = pytest.importorskip("app.services.workflow_engine")
+
+
+def run_schedule(edges, start, branches=None):
+    """按调度器给出的波次模拟执行，返回每一波的节点；branches 为条件节点 -> 'true'/'false'"""
+    graph = engine._WorkflowGraph(edges)
+    nodes = {node_id: {'id': node_id} for edge in edges for node_id in (edge['source'], edge['target'])}
+    context = engine.WorkflowContext()
+    for node_id, branch in (branches or {}).items():
+        context.set(f'__branch__{node_id}', branch)
+    workflow_engine = engine.WorkflowEngine(None)
+
+    scheduler = engine._DependencyScheduler(graph, start)
+    waves = []
+    wave = scheduler.next_wave(nodes)
+    while wave:
+        waves.append(wave)
+        for node_id in wave:
+            scheduler.complete(node_id, workflow_engine._select_next_nodes(node_id, graph, context))
+        wave = scheduler.next_wave(nodes)
+    return waves
+
+
+def edge(source, target, handle=None):
+    return {'source': source, 'target': target, 'sourceHandle': handle}
+
+
+def test_diamond_join_runs_once_after_both_branches():
+    edges = [edge('t', 'a'), edge('t', 'b'), edge('a', 'j'), edge('b', 'j'), edge('j', 'end')]
+    assert run_schedule(edges, 't') == [['t'], ['a', 'b'], ['j'], ['end']]
+
+
+def test_join_waits_for_longer_branch():
+    edges = [edge('t', 'a'), edge('t', 'b1'), edge('b1', 'b2'), edge('a', 'j'), edge('b2', 'j')]
+    waves = run_schedule(edges, 't')
+    assert waves == [['t'], ['a', 'b1'], ['b2'], ['j']]
+
+
+def test_false_branch_skips_true_side_and_still_reaches_join():
+    edges = [
+        edge('t', 'c'),
+        edge('c', 'yes', 'true'), edge('c', 'no', 'false'),
+        edge('yes', 'yes2'), edge('yes2', 'j'), edge('no', 'j'),
+    ]
+    waves = run_schedule(edges, 't', {'c': 'false'})
+    assert waves == [['t'], ['c'], ['no'], ['j']]
+
+
+def test_unmatched_branch_ends_workflow():
+    edges = [edge('t', 'c'), edge('c', 'yes', 'true'), edge('yes', 'end')]
+    assert run_schedule(edges, 't', {'c': 'false'}) == [['t'], ['c']]
+
+
+def test_cycle_runs_each_node_once():
+    edges = [edge('t', 'a'), edge('a', 'b'), edge('b', 'a')]
+    assert run_schedule(edges, 't') == [['t'], ['a'], ['b']]
+
+
+def test_parallel_failure_waits_for_sibling_branches():
+    finished = []
+
+    class SlowNode:
+        USES_DB = True
+
+    class FailingNode:
+        USES_DB = False
+
+    async def fake_execute_node(execution, node, context, db_lock=None):
+        if node['type'] == 'Fail':
+            raise RuntimeError('branch failed')
+        await asyncio.sleep(0.05)
+        context.set(node['id'], 'done')
+        finished.append(node['id'])
+
+    workflow_engine = engine.WorkflowEngine(None)
+    workflow_engine.processors = {'Slow': SlowNode, 'Fail': FailingNode}
+    workflow_engine._execute_node = fake_execute_node
+    nodes = {'slow': {'id': 'slow', 'type': 'Slow'}, 'fail': {'id': 'fail', 'type': 'Fail'}}
+    context = engine.WorkflowContext()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(workflow_engine._execute_parallel_nodes(None, ['slow', 'fail'], nodes, context))
+    # 失败在兄弟分支结束后才抛出，成功分支的结果已合并回上下文
+    assert finished == ['slow']
+    assert context.get('slow') == 'done'
@@ -33,7 +33,12 @@ workflow = {
                 "headers": {
                     "Content-Type": "application/json"
                 },
-                "body": '{"customer_name": "{{var_name}}", "phone_last_4": "{{var_phone}}", "raw_phone": "{{trigger.phone}}", "raw_name": "{{trigger.name}}"}',
+                "body": {
+                    "customer_name": "{{var_name}}",
+                    "phone_last_4": "{{var_phone}}",
+                    "raw_phone": "{{trigger.phone}}",
+                    "raw_name": "{{trigger.name}}"
+                },
                 "smart_variables": {
                     "var_name": {
                         "display_name": "客户姓名（首字）",
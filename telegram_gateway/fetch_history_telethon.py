@@ -9,6 +9,7 @@ Requires: API_ID, API_HASH and a valid session (first-run of gateway.py created
 """
 
 import os
+import sys
 import argparse
 import asyncio
 from telethon import TelegramClient
@@ -21,21 +22,53 @@ API_HASH = os.environ.get('API_HASH')
 SESSION = os.environ.get('TG_SESSION', 'tg_gateway')
 
 
-async def fetch_history(chat_id: int, limit: int = None):
+# 作为库导入、多次调用 fetch_history 时复用同一个已登录的客户端，避免每次重新连接和鉴权
+_client = None
+
+
+async def _get_client() -> TelegramClient:
+    global _client
     if not API_ID or not API_HASH:
         raise RuntimeError('API_ID and API_HASH must be set in environment (.env)')
+    if _client is None:
+        _client = TelegramClient(SESSION, int(API_ID), API_HASH)
+        await _client.start()
+    return _client
+
+
+async def close_client():
+    """断开共享客户端（调用方完成全部抓取后调用）"""
+    global _client
+    if _client is not None:
+        await _client.disconnect()
+        _client = None
+
+
+# 每累计这么多行写一次 stdout，而不是每条消息 print 一次
+_WRITE_BATCH = 1000
 
-    client = TelegramClient(SESSION, int(API_ID), API_HASH)
-    await client.start()
+
+async def fetch_history(chat_id: int, limit: int = None):
+    client = await _get_client()
+    buf = []
+    # iterate messages from oldest to newest
+    async for msg in client.iter_messages(chat_id, reverse=True, limit=limit):
+        # msg.sender_id may be None for system messages
+        text = msg.text or ''
+        dt = msg.date.isoformat() if msg.date else ''
+        buf.append("\t".join((str(msg.id), dt, str(msg.sender_id), text)))
+        if len(buf) >= _WRITE_BATCH:
+            sys.stdout.write("\n".join(buf) + "\n")
+            buf.clear()
+    if buf:
+        sys.stdout.write("\n".join(buf) + "\n")
+
+
+async def _run(chat_id: int, limit: int = None):
     try:
-        # iterate messages from oldest to newest
-        async for msg in client.iter_messages(chat_id, reverse=True, limit=limit):
-            # msg.sender_id may be None for system messages
-            text = msg.text or ''
-            dt = msg.date.isoformat() if msg.date else ''
-            print(f"{msg.id}\t{dt}\t{msg.sender_id}\t{text}")
+        await fetch_history(chat_id, limit=limit)
     finally:
-        await client.disconnect()
+        await close_client()
 
 
 def main():
@@ -45,10 +78,8 @@ def main():
     args = p.parse_args()
 
     chat = int(args.chat)
-    asyncio.run(fetch_history(chat, limit=args.limit))
+    asyncio.run(_run(chat, limit=args.limit))
 
 
 if __name__ == '__main__':
     main()
-
-
@@ -1,14 +1,23 @@
 import os
 import sys
+import json
 import asyncio
-import requests
+from collections import OrderedDict
+from typing import List, Optional
 from telethon import TelegramClient, events
 import logging
 import logging.config
+import aiohttp
 from aiohttp import web # 导入 aiohttp
 
+try:
+    import orjson  # 转发消息时使用 C 实现的 JSON 编码器
+except ImportError:
+    orjson = None
+
 from config import (
     BACKEND_WEBHOOK,
+    BACKEND_WEBHOOK_BATCH,
     BACKEND_INTERNAL_SESSIONS,
     GATEWAY_SECRET,
     API_ID,
@@ -27,7 +36,34 @@ try:
 except ValueError:
     API_ID = 0
 
-async def forward_to_backend(chat_id, from_id, text, user_id=None, gateway_secret=None):
+# 转发消息到后端共用的 HTTP 会话（保持连接复用），在 start_web_server 中创建
+_http_session: Optional[aiohttp.ClientSession] = None
+_FORWARD_TIMEOUT = aiohttp.ClientTimeout(total=5)
+_FORWARD_BATCH_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+        )
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+def _dumps(payload) -> bytes:
+    """将转发内容编码为 JSON 字节串，直接作为请求体发送"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
+def _build_forward_payload(chat_id, from_id, text, user_id=None, gateway_secret=None):
     payload = {
         'chat_id': str(chat_id),
         'from_id': str(from_id),
@@ -37,25 +73,193 @@ async def forward_to_backend(chat_id, from_id, text, user_id=None, gateway_secre
         payload['user_id'] = user_id
     if gateway_secret:
         payload['gateway_secret'] = gateway_secret
+    return payload
+
+async def forward_to_backend(chat_id, from_id, text, user_id=None, gateway_secret=None):
+    payload = _build_forward_payload(chat_id, from_id, text, user_id, gateway_secret)
     try:
-        resp = requests.post(BACKEND_WEBHOOK, json=payload, timeout=5)
-        logger.info('POST -> %s %d', BACKEND_WEBHOOK, resp.status_code)
+        async with get_http_session().post(BACKEND_WEBHOOK, data=_dumps(payload), headers=_JSON_HEADERS, timeout=_FORWARD_TIMEOUT) as resp:
+            logger.info('POST -> %s %d', BACKEND_WEBHOOK, resp.status)
     except Exception as e:
         logger.error('Failed to POST to backend: %s', e)
 
+async def forward_batch_to_backend(items):
+    """
+    把多条待转发消息合并为一次 POST。
+    批量请求返回非 2xx、超时或出错时改为逐条转发；超时时后端可能已部分保存，逐条重发可能产生重复消息。
+    """
+    if len(items) == 1:
+        await forward_to_backend(*items[0])
+        return
+    payload = {'batch': [_build_forward_payload(*item) for item in items]}
+    try:
+        async with get_http_session().post(BACKEND_WEBHOOK_BATCH, data=_dumps(payload), headers=_JSON_HEADERS, timeout=_FORWARD_BATCH_TIMEOUT) as resp:
+            logger.info('POST -> %s %d (%d messages)', BACKEND_WEBHOOK_BATCH, resp.status, len(items))
+            if 200 <= resp.status < 300:
+                try:
+                    body = await resp.json(content_type=None)
+                except Exception:
+                    body = None
+                results = body.get('results') if isinstance(body, dict) else None
+                for result in results or []:
+                    if isinstance(result, dict) and result.get('status') != 'ok':
+                        logger.warning('Backend rejected batched message: %s', result.get('detail'))
+                return
+            logger.warning('Batch webhook returned %d, forwarding %d messages one by one', resp.status, len(items))
+    except Exception as e:
+        logger.error('Failed to POST batch to backend: %s, forwarding %d messages one by one', e, len(items))
+    for item in items:
+        await forward_to_backend(*item)
+
+# 待转发消息队列：Telethon 处理函数只负责入队，由后台 worker 转发到后端。
+# 按 chat_id 分片，每个分片一个队列和一个 worker，同一会话的消息按到达顺序转发
+_FORWARD_QUEUE_SIZE = 1000
+_FORWARD_WORKERS = 4
+# 每次最多合并的消息数，以及收到第一条后等待后续消息的时间（秒）
+_FORWARD_BATCH_MAX = 64
+_FORWARD_BATCH_WAIT = 0.02
+# 停止时等待队列中剩余消息转发完成的最长时间（秒）
+_FORWARD_DRAIN_TIMEOUT = 10
+_forward_queues: List[asyncio.Queue] = []
+_forward_tasks = []
+# worker 启动前转发用的后台任务；保留引用，避免任务在完成前被回收
+_background_tasks = set()
+
+def _on_background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background forward failed: %s', task.exception())
+
+def enqueue_forward(chat_id, from_id, text, user_id=None, gateway_secret=None):
+    item = (chat_id, from_id, text, user_id, gateway_secret)
+    if not _forward_queues:
+        # worker 未启动时直接在后台转发
+        task = asyncio.ensure_future(forward_to_backend(*item))
+        _background_tasks.add(task)
+        task.add_done_callback(_on_background_task_done)
+        return
+    queue = _forward_queues[hash(str(chat_id)) % len(_forward_queues)]
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # 队列满时丢弃最早的一条，保证新消息能入队
+        try:
+            dropped = queue.get_nowait()
+            queue.task_done()
+            logger.warning('Forward queue full, dropped oldest message from chat %s', dropped[0])
+        except asyncio.QueueEmpty:
+            pass
+        queue.put_nowait(item)
+
+async def _forward_worker(queue: asyncio.Queue):
+    while True:
+        batch = [await queue.get()]
+        try:
+            while len(batch) < _FORWARD_BATCH_MAX:
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=_FORWARD_BATCH_WAIT))
+                except asyncio.TimeoutError:
+                    break
+            await forward_batch_to_backend(batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+def start_forward_workers():
+    if not _forward_queues:
+        for _ in range(_FORWARD_WORKERS):
+            queue = asyncio.Queue(maxsize=_FORWARD_QUEUE_SIZE)
+            _forward_queues.append(queue)
+            _forward_tasks.append(asyncio.ensure_future(_forward_worker(queue)))
+
+async def stop_forward_workers():
+    # 先等待已入队的消息转发完成，超时后再取消 worker
+    queues = list(_forward_queues)
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in queues)), timeout=_FORWARD_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning('Forward queue not drained within %ds, %d messages dropped',
+                       _FORWARD_DRAIN_TIMEOUT, sum(queue.qsize() for queue in queues))
+    _forward_queues.clear()
+    for task in _forward_tasks:
+        task.cancel()
+    await asyncio.gather(*_forward_tasks, return_exceptions=True)
+    _forward_tasks.clear()
+
 clients = {}
 
-# 新增一个字典来存储 bot 客户端
-bot_clients = {}
+# 存储 bot 客户端，按最近使用排序；超过上限时断开最久未用的客户端
+MAX_BOT_CLIENTS = 128
+bot_clients: "OrderedDict[str, TelegramClient]" = OrderedDict()
 
 async def get_bot_client(bot_token: str, api_id: int, api_hash: str):
-    if bot_token not in bot_clients:
-        # 使用 bot token 创建新的客户端实例
-        client = TelegramClient(bot_token, api_id, api_hash)
-        await client.connect()
-        bot_clients[bot_token] = client
-        logger.info(f'Bot client created for token: {bot_token[:5]}...')
-    return bot_clients[bot_token]
+    client = bot_clients.get(bot_token)
+    if client is not None:
+        bot_clients.move_to_end(bot_token)
+        return client
+    # 使用 bot token 创建新的客户端实例
+    client = TelegramClient(bot_token, api_id, api_hash)
+    await client.connect()
+    bot_clients[bot_token] = client
+    logger.info('Bot client created for token: %s...', bot_token[:5])
+    while len(bot_clients) > MAX_BOT_CLIENTS:
+        evicted_token, evicted = bot_clients.popitem(last=False)
+        logger.info('Evicting idle bot client for token: %s...', evicted_token[:5])
+        try:
+            await evicted.disconnect()
+        except Exception:
+            pass
+    return client
+
+# 用户会话已解析的实体：(user_id, chat_id) -> entity，按最近使用淘汰
+_ENTITY_CACHE_SIZE = 10000
+_entity_cache: "OrderedDict[tuple, object]" = OrderedDict()
+
+def _to_peer(chat_id):
+    """纯数字（含负号的群组 ID）转为整数，其余（用户名、电话号码）保持字符串"""
+    peer = str(chat_id).strip()
+    return int(peer) if peer.lstrip('-').isdigit() else peer
+
+def _cache_entity(key, entity):
+    _entity_cache[key] = entity
+    _entity_cache.move_to_end(key)
+    if len(_entity_cache) > _ENTITY_CACHE_SIZE:
+        _entity_cache.popitem(last=False)
+
+async def send_via_session(session_client, user_id, chat_id, message):
+    key = (user_id, str(chat_id))
+    entity = _entity_cache.get(key)
+    if entity is not None:
+        _entity_cache.move_to_end(key)
+        try:
+            return await session_client.send_message(entity, message)
+        except Exception:
+            _entity_cache.pop(key, None)
+            raise
+
+    peer = _to_peer(chat_id)
+    try:
+        return await session_client.send_message(peer, message)
+    except Exception as entity_error:
+        logger.warning("Failed to send to %s directly, trying to resolve entity: %s", chat_id, entity_error)
+        try:
+            # 尝试通过用户名或电话号码解析，解析结果缓存供后续发送直接使用
+            entity = await session_client.get_entity(peer)
+            result = await session_client.send_message(entity, message)
+        except Exception as resolve_error:
+            logger.error("Failed to resolve entity %s: %s", chat_id, resolve_error)
+            raise resolve_error
+        _cache_entity(key, entity)
+        return result
+
+async def get_account_label(client):
+    """网关账号的显示名，首次调用时通过 get_me() 获取后缓存在客户端上"""
+    label = getattr(client, '_gateway_account_label', None)
+    if label is None:
+        me = await client.get_me()
+        label = getattr(me,'username', None) or getattr(me,'first_name', None) or getattr(me,'id', None)
+        client._gateway_account_label = label
+    return label
 
 async def create_client_for_session(session_name, api_id, api_hash, string_session, user_id=None, gateway_secret=None):
     try:
@@ -69,23 +273,23 @@ async def create_client_for_session(session_name, api_id, api_hash, string_sessi
             chat_id = event.chat_id
             from_id = sender.id if sender else None
             text = event.message.message or ''
-            logger.info("New TG msg from %s in chat %s: %s", from_id, chat_id, text[:100])
-            try:
-                me = await client.get_me()
-                logger.info("Gateway session active as: %s", 
-                    getattr(me,'username', None) or getattr(me,'first_name', None) or getattr(me,'id', None))
-            except Exception:
-                logger.warning('Failed to fetch gateway account info')
-            await forward_to_backend(chat_id, from_id, text, user_id, gateway_secret=gateway_secret) # 传递 user_id
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("New TG msg from %s in chat %s: %s", from_id, chat_id, text[:100])
+            enqueue_forward(chat_id, from_id, text, user_id, gateway_secret=gateway_secret) # 传递 user_id
 
         await client.connect()
+        try:
+            # 连接后获取一次账号信息，消息处理时不再请求
+            logger.info("Gateway session active as: %s", await get_account_label(client))
+        except Exception:
+            logger.warning('Failed to fetch gateway account info for %s', session_name)
         clients[session_name] = client
         logger.info('Client started for session: %s (User ID: %s)', session_name, user_id)
     except Exception as e:
         logger.error('Failed to create client for %s: %s', session_name, e)
 
 
-def start_local_single_client():
+async def start_local_single_client():
     try:
         if not API_ID or not API_HASH: # SESSION_NAME in API_ID is not a valid condition for single client mode
             logger.warning('No API_ID/API_HASH configured for single-client mode')
@@ -98,17 +302,16 @@ def start_local_single_client():
             chat_id = event.chat_id
             from_id = sender.id if sender else None
             text = event.message.message or ''
-            logger.info("New TG msg from %s in chat %s: %s", from_id, chat_id, text[:100])
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("New TG msg from %s in chat %s: %s", from_id, chat_id, text[:100])
+            enqueue_forward(chat_id, from_id, text, None, gateway_secret=GATEWAY_SECRET)
+
+        async with client: # 使用 'async with' 语句确保客户端正确连接和断开
             try:
-                me = await client.get_me()
-                logger.info("Gateway session active as: %s",
-                    getattr(me,'username', None) or getattr(me,'first_name', None) or getattr(me,'id', None))
+                logger.info("Gateway session active as: %s", await get_account_label(client))
             except Exception:
                 pass
-            await forward_to_backend(chat_id, from_id, text, None, gateway_secret=GATEWAY_SECRET)
-
-        with client: # 使用 'with' 语句确保客户端正确连接和断开
-            client.run_until_disconnected()
+            await client.run_until_disconnected()
     except Exception as e:
         logger.error('Single-client mode failed: %s', e)
 
@@ -145,28 +348,15 @@ async def send_message_handler(request):
             session_client = clients.get(session_name)
 
         if session_client:
-            logger.info(f"Sending message via user session '{session_name}' to {chat_id}")
-            try:
-                # 尝试解析实体，如果是数字ID，先转换为整数
-                if chat_id.isdigit():
-                    chat_id = int(chat_id)
-                await session_client.send_message(chat_id, message)
-            except Exception as entity_error:
-                logger.warning(f"Failed to send to {chat_id} directly, trying to resolve entity: {entity_error}")
-                try:
-                    # 尝试通过用户名或电话号码解析
-                    entity = await session_client.get_entity(chat_id)
-                    await session_client.send_message(entity, message)
-                except Exception as resolve_error:
-                    logger.error(f"Failed to resolve entity {chat_id}: {resolve_error}")
-                    raise resolve_error
+            logger.info("Sending message via user session '%s' to %s", session_name, chat_id)
+            await send_via_session(session_client, user_id, chat_id, message)
         elif client: # 使用 bot 客户端发送
-            logger.info(f"Sending message via bot client to {chat_id}")
+            logger.info("Sending message via bot client to %s", chat_id)
             await client.send_message(chat_id, message)
         else:
             return web.json_response({'status': 'error', 'message': 'No Telegram client available to send message'}, status=500)
 
-        logger.info(f'Sent Telegram message to {chat_id} using bot_token {bot_token[:5]}...')
+        logger.info('Sent Telegram message to %s using bot_token %s...', chat_id, bot_token[:5] if bot_token else None)
         return web.json_response({'status': 'success', 'telegram_message_id': 'unknown'})
 
     except Exception as e:
@@ -187,15 +377,12 @@ async def status_handler(request):
         if API_ID == 0:
             status_text.append("API_ID is 0, only bot clients might be active")
 
-        # 检查所有用户客户端的连接状态
+        # 检查所有客户端的连接状态；Telethon 的 is_connected() 是同步方法，
+        # 只读取本地连接标志，不产生网络请求，无需逐个 await
         for session_name, client in clients.items():
-            is_connected = await client.is_connected()
-            status_text.append(f"User session {session_name} connected: {is_connected}")
-
-        # 检查所有 Bot 客户端的连接状态
+            status_text.append(f"User session {session_name} connected: {client.is_connected()}")
         for bot_tok, client in bot_clients.items():
-            is_connected = await client.is_connected()
-            status_text.append(f"Bot client {bot_tok[:5]}... connected: {is_connected}")
+            status_text.append(f"Bot client {bot_tok[:5]}... connected: {client.is_connected()}")
 
         return web.json_response({
             'status': 'success',
@@ -207,7 +394,9 @@ async def status_handler(request):
         logger.error('Failed to get Telegram gateway status: %s', e)
         return web.json_response({'status': 'error', 'message': str(e)}, status=500)
 
-async def start_web_server(loop):
+async def start_web_server():
+    get_http_session()
+    start_forward_workers()
     app = web.Application()
     app.router.add_post('/send', send_message_handler)
     app.router.add_get('/status', status_handler)
@@ -217,66 +406,67 @@ async def start_web_server(loop):
     await site.start()
     logger.info('Telegram Gateway web server started on 0.0.0.0:4000')
 
-def main():
-    logger.info('Starting Telethon gateway...')
-
-    # 创建一个新的 asyncio 事件循环
-    loop = asyncio.get_event_loop()
-
-    # 启动 web 服务器
-    loop.run_until_complete(start_web_server(loop))
-
-    # 如果 BACKEND_INTERNAL_SESSIONS 已设置，尝试从后端获取会话
+async def bootstrap_sessions():
+    """从后端获取已保存的会话，并发创建各会话的客户端"""
     try:
-        if BACKEND_INTERNAL_SESSIONS:
-            headers = {}
-            if GATEWAY_SECRET:
-                headers['X-GATEWAY-SECRET'] = GATEWAY_SECRET
-            resp = requests.get(BACKEND_INTERNAL_SESSIONS, headers=headers, timeout=5)
-            if resp.ok:
-                data = resp.json()
-                for s in data.get('sessions', []):
-                    session_name = f"tg_{s['user_id']}"
-                    # 在当前运行的事件循环中创建客户端
-                    loop.run_until_complete(
-                        create_client_for_session(
-                            session_name, 
-                            s['api_id'], 
-                            s['api_hash'], 
-                            s['string_session'],
-                            user_id=s['user_id'], # 传递 user_id
-                            gateway_secret=GATEWAY_SECRET
-                        )
-                    )
-            else:
-                logger.error('Failed to fetch internal sessions: %d', resp.status_code)
+        headers = {}
+        if GATEWAY_SECRET:
+            headers['X-GATEWAY-SECRET'] = GATEWAY_SECRET
+        async with get_http_session().get(BACKEND_INTERNAL_SESSIONS, headers=headers, timeout=_FORWARD_TIMEOUT) as resp:
+            if not resp.ok:
+                logger.error('Failed to fetch internal sessions: %d', resp.status)
+                return
+            data = await resp.json()
+
+        # 各会话的 connect() 相互独立，并发建立连接；create_client_for_session 自行记录失败
+        await asyncio.gather(*(
+            create_client_for_session(
+                f"tg_{s['user_id']}",
+                s['api_id'],
+                s['api_hash'],
+                s['string_session'],
+                user_id=s['user_id'], # 传递 user_id
+                gateway_secret=GATEWAY_SECRET
+            )
+            for s in data.get('sessions', [])
+        ), return_exceptions=True)
     except Exception as e:
         logger.error('Error fetching internal sessions: %s', e)
 
-    # 如果没有客户端启动，回退到单客户端模式
-    if not clients and not bot_clients:
-        logger.info("No user or bot clients started, falling back to local single client mode.")
-        start_local_single_client()
+async def run_gateway():
+    # web 服务器与会话获取互不依赖，同时启动
+    startup = [start_web_server()]
+    # 如果 BACKEND_INTERNAL_SESSIONS 已设置，尝试从后端获取会话
+    if BACKEND_INTERNAL_SESSIONS:
+        startup.append(bootstrap_sessions())
+    await asyncio.gather(*startup)
 
-    # 保持 asyncio 循环运行
     try:
-        loop.run_forever()
-    except KeyboardInterrupt:
+        # 如果没有客户端启动，回退到单客户端模式
+        if not clients and not bot_clients:
+            logger.info("No user or bot clients started, falling back to local single client mode.")
+            await start_local_single_client()
+
+        # 保持运行，直到进程被中断
+        await asyncio.Event().wait()
+    finally:
         logger.info('Gateway stopping...')
-        for name, c in clients.items():
-            try:
-                c.disconnect()
-            except Exception:
-                pass
-        for token, c in bot_clients.items():
-            try:
-                c.disconnect()
-            except Exception:
-                pass
+        await asyncio.gather(
+            *(c.disconnect() for c in list(clients.values()) + list(bot_clients.values())),
+            return_exceptions=True
+        )
+        await stop_forward_workers()
+        await close_http_session()
+
+def main():
+    logger.info('Starting Telethon gateway...')
+    try:
+        asyncio.run(run_gateway())
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         logger.error('Gateway error: %s', e)
         sys.exit(1)
 
-
 if __name__ == '__main__':
     main()
\ No newline at end of file
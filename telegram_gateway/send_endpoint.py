@@ -1,5 +1,5 @@
-from flask import Flask, request, jsonify
 import os
+from aiohttp import web
 from telethon import TelegramClient
 from dotenv import load_dotenv
 
@@ -9,24 +9,36 @@ API_ID = int(os.environ.get('API_ID', '0'))
 API_HASH = os.environ.get('API_HASH', '')
 SESSION = os.environ.get('TG_SESSION', 'tg_gateway')
 
-app = Flask(__name__)
 client = TelegramClient(SESSION, API_ID, API_HASH)
 
-@app.route('/send', methods=['POST'])
-def send():
-    data = request.get_json() or {}
+async def send(request):
+    try:
+        data = await request.json()
+    except Exception:
+        data = {}
     chat_id = data.get('chat_id')
     text = data.get('text')
     if not chat_id or not text:
-        return jsonify({'error': 'chat_id and text required'}), 400
+        return web.json_response({'error': 'chat_id and text required'}, status=400)
     try:
-        with client:
-            client.loop.run_until_complete(client.send_message(int(chat_id), text))
-        return jsonify({'status': 'ok'})
+        await client.send_message(int(chat_id), text)
+        return web.json_response({'status': 'ok'})
     except Exception as e:
-        return jsonify({'status': 'error', 'error': str(e)}), 500
+        return web.json_response({'status': 'error', 'error': str(e)}, status=500)
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('TG_SEND_PORT', 4001)))
+# 客户端在服务启动时连接一次并保持，避免每个请求都重新建立 MTProto 连接
+async def connect_client(app):
+    await client.connect()
 
+async def disconnect_client(app):
+    await client.disconnect()
 
+def create_app():
+    app = web.Application()
+    app.router.add_post('/send', send)
+    app.on_startup.append(connect_client)
+    app.on_cleanup.append(disconnect_client)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('TG_SEND_PORT', 4001)))